@@ -0,0 +1,194 @@
+"""
+Content-addressed store for encrypted blobs.
+
+Ciphertext is written once under BLOB_DIR, named by its SHA-256 digest, and
+tracked in the `blobs` table with a reference count. File and BackupStorage
+rows only hold the digest, so a file and its backup share one copy on disk
+and identical content is never stored twice. A chunk manifest (see
+chunkstore.py) holds a reference on each of its chunks, dropped when the
+manifest's own last reference goes.
+
+A blob's row is written before its file is moved into place, but the file
+lands before the transaction commits; a rollback leaves it behind with no
+row. `collect_orphans` (run by the sweeper) removes blob files that have
+had no row for SECUREPLUS_BLOB_ORPHAN_GRACE seconds, along with temporary
+files abandoned by writers that died (after SECUREPLUS_BLOB_PART_GRACE).
+"""
+
+import hashlib
+import os
+import time
+import uuid
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .models import Blob
+
+BLOB_DIR = os.environ.get("SECUREPLUS_BLOB_DIR", "uploads")
+ORPHAN_GRACE = float(os.environ.get("SECUREPLUS_BLOB_ORPHAN_GRACE", 3600))  # seconds
+# A streamed upload keeps its finished chunks' temporary files until the whole upload is in
+PART_GRACE = float(os.environ.get("SECUREPLUS_BLOB_PART_GRACE", 24 * 3600))
+ORPHAN_BATCH_SIZE = 500
+
+
+def blob_path(digest: str) -> str:
+    # Fan out into 256 subdirectories so no single directory grows too large
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+class BlobWriter:
+    """Streams ciphertext into a temporary file while hashing it.
+
+    `commit()` moves the data to its content address and takes a reference
+    on it; `discard()` throws it away.
+    """
+
+    def __init__(self):
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        self._tmp_path = os.path.join(BLOB_DIR, f".{uuid.uuid4().hex}.part")
+        self._file = open(self._tmp_path, "wb")
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.content_size = None  # plaintext size, when the writer encrypted it
+
+    def write(self, data: bytes):
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self, db: Session) -> str:
+        self._file.close()
+        digest = self._hash.hexdigest()
+        acquire(db, digest, self.size)
+        _place(self._tmp_path, digest)
+        return digest
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def put_bytes(db: Session, data: bytes) -> str:
+    """Store a ciphertext held in memory and return its digest (with one reference taken)."""
+    writer = BlobWriter()
+    try:
+        writer.write(data)
+        return writer.commit(db)
+    except BaseException:
+        writer.discard()
+        raise
+
+
+def put_file(db: Session, path: str, digest: str, size: int) -> str:
+    """Move a finished ciphertext file whose digest is already known into the store (one reference taken)."""
+    acquire(db, digest, size)
+    _place(path, digest)
+    return digest
+
+
+def _place(path: str, digest: str):
+    # Called after acquire(), whose write lock keeps collect_orphans() off this digest until commit
+    target = blob_path(digest)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Identical content gives an identical file, so replacing is harmless
+    os.replace(path, target)
+    # A file written long ago (an upload chunk) must not look old enough to collect
+    os.utime(target)
+
+
+def acquire(db: Session, digest: str, size: Optional[int] = None):
+    """Take a reference on a blob, creating its row on first use."""
+    # The increment is a bulk UPDATE; flush any pending release() of this blob first
+    db.flush()
+    updated = db.query(Blob).filter(Blob.hash == digest).update(
+        {Blob.refcount: Blob.refcount + 1}, synchronize_session=False
+    )
+    if not updated:
+        if size is None:
+            size = os.path.getsize(blob_path(digest))
+        db.add(Blob(hash=digest, size=size, refcount=1))
+        db.flush()
+
+
+def release(db: Session, digest: Optional[str]):
+    """Drop a reference on a blob; the file is removed once the last reference is committed."""
+    if not digest:
+        return
+    # Sessions don't autoflush: write out pending releases, then reload the row,
+    # which acquire() may have bumped behind the session's back
+    db.flush()
+    blob = db.query(Blob).populate_existing().filter(Blob.hash == digest).first()
+    if blob is None:
+        return
+    blob.refcount -= 1
+    if blob.refcount > 0:
+        return
+    db.delete(blob)
+    from .chunkstore import referenced_blobs
+    for chunk in referenced_blobs(digest):
+        release(db, chunk)
+
+    def _unlink(session):
+        path = blob_path(digest)
+        if os.path.exists(path):
+            os.remove(path)
+
+    event.listen(db, "after_commit", _unlink, once=True)
+
+
+def collect_orphans(db: Session, grace: float = ORPHAN_GRACE, part_grace: float = PART_GRACE) -> Dict[str, int]:
+    """Remove blob files without a row for `grace` seconds, and temporary files untouched for `part_grace`."""
+    if not os.path.isdir(BLOB_DIR):
+        return {"blob_files": 0}
+    cutoff = time.time() - grace
+    part_cutoff = time.time() - part_grace
+    removed = 0
+    old = []
+    for entry in os.scandir(BLOB_DIR):
+        if entry.is_dir():
+            old.extend(f.path for f in os.scandir(entry.path) if f.is_file() and f.stat().st_mtime < cutoff)
+        elif entry.name.endswith(".part") and entry.stat().st_mtime < part_cutoff:
+            _remove(entry.path)
+            removed += 1
+    for start in range(0, len(old), ORPHAN_BATCH_SIZE):
+        paths = {os.path.basename(path): path for path in old[start:start + ORPHAN_BATCH_SIZE]}
+        known = {digest for digest, in db.query(Blob.hash).filter(Blob.hash.in_(paths))}
+        candidates = [digest for digest in paths if digest not in known]
+        db.rollback()
+        if not candidates:
+            continue
+        # Check again under the write lock: a writer takes it in acquire() before placing the file
+        db.query(Blob).filter(Blob.hash.in_(candidates)).update(
+            {Blob.refcount: Blob.refcount}, synchronize_session=False
+        )
+        known = {digest for digest, in db.query(Blob.hash).filter(Blob.hash.in_(candidates))}
+        for digest in candidates:
+            path = paths[digest]
+            if digest not in known and os.path.exists(path) and os.path.getmtime(path) < cutoff:
+                _remove(path)
+                removed += 1
+        db.commit()
+    return {"blob_files": removed}
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def open_blob(digest: str):
+    return open(blob_path(digest), "rb")
+
+
+def blob_size(digest: str) -> int:
+    return os.path.getsize(blob_path(digest))
+
+
+def read_blob(digest: str) -> bytes:
+    with open_blob(digest) as f:
+        return f.read()
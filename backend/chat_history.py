@@ -0,0 +1,264 @@
+"""
+Chess-room chat history.
+
+Each room keeps its latest SECUREPLUS_CHAT_RING_SIZE messages in a
+fixed-capacity ring buffer, which is what a joining player is replayed, so
+memory per room stays constant however long the game runs. At most
+SECUREPLUS_CHAT_MAX_ROOMS rings are kept; the least recently used room's
+ring is dropped and rebuilt from the database if the room speaks again.
+
+Every message is also queued for a background writer that group-commits
+the queue to `ChatMessage` every SECUREPLUS_CHAT_FLUSH_INTERVAL seconds,
+or as soon as SECUREPLUS_CHAT_BATCH_SIZE messages are waiting: one
+transaction per batch instead of one per message. Message text is
+encrypted at rest with the server chat key (SECUREPLUS_CHAT_KEY, hex, or
+derived from SECRET_KEY) and a per-message IV.
+
+`page` serves older history: the ring first, then the database, newest
+first. Its cursor is the last message's timestamp and row id, so messages
+sent in the same microsecond are never skipped at a page boundary; a page
+that needs a cursor for a message still queued writes the queue out first.
+A cold room's ring is loaded outside the lock, so one room's database read
+never stalls chat in the others, and takes in messages still queued for
+that room. With several workers each ring holds what its own worker saw;
+the database has every message once it is flushed.
+"""
+
+import atexit
+import datetime
+import hashlib
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import tuple_
+
+from .crypto import decrypt_data, encrypt_data
+from .models import ChatMessage, SessionLocal, ReadSessionLocal
+
+logger = logging.getLogger(__name__)
+
+RING_SIZE = int(os.environ.get("SECUREPLUS_CHAT_RING_SIZE", 100))
+MAX_ROOMS = int(os.environ.get("SECUREPLUS_CHAT_MAX_ROOMS", 1024))
+BATCH_SIZE = int(os.environ.get("SECUREPLUS_CHAT_BATCH_SIZE", 200))
+FLUSH_INTERVAL = float(os.environ.get("SECUREPLUS_CHAT_FLUSH_INTERVAL", 0.5))
+MAX_PAGE = 200
+
+_key_hex = os.environ.get("SECUREPLUS_CHAT_KEY")
+CHAT_KEY = bytes.fromhex(_key_hex) if _key_hex else hashlib.sha256(
+    b"secureplus-chat:" + os.environ.get("SECRET_KEY", "your_secret_key_here").encode()
+).digest()
+
+Entry = Dict[str, str]
+Cursor = Tuple[datetime.datetime, float]  # (sent_at, row id); a bare timestamp sorts before its own rows
+
+
+class _Message:
+    """A message as the rings and the write queue hold it; `id` is set once its row is inserted."""
+
+    __slots__ = ("room_id", "entry", "sent_at", "id")
+
+    def __init__(self, room_id: str, entry: Entry, sent_at: datetime.datetime, row_id: Optional[int] = None):
+        self.room_id = room_id
+        self.entry = entry
+        self.sent_at = sent_at
+        self.id = row_id
+
+    def key(self) -> Cursor:
+        # Not yet inserted means newer than every row
+        return self.sent_at, math.inf if self.id is None else self.id
+
+    def cursor(self) -> str:
+        return self.entry['timestamp'] if self.id is None else f"{self.entry['timestamp']}/{self.id}"
+
+
+def _timestamp(sent_at: datetime.datetime) -> str:
+    return sent_at.isoformat()
+
+
+def parse_cursor(before: str) -> Cursor:
+    """A `page` cursor; a bare timestamp (the old format) means strictly before it. Raises ValueError."""
+    timestamp, _, row_id = before.partition("/")
+    return datetime.datetime.fromisoformat(timestamp), int(row_id) if row_id else -math.inf
+
+
+class ChatHistory:
+    def __init__(self, ring_size: int = RING_SIZE, max_rooms: int = MAX_ROOMS,
+                 batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.ring_size = ring_size
+        self.max_rooms = max_rooms
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rooms: "OrderedDict[str, deque]" = OrderedDict()
+        self._pending: List[_Message] = []
+        self._flushing: List[_Message] = []  # the batch being written
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        self.flushed = 0
+        self.batches = 0
+
+    def _ring(self, room_id: str) -> deque:
+        """The room's ring, loading the latest messages from the database on first use."""
+        with self._lock:
+            ring = self._rooms.get(room_id)
+            if ring is not None:
+                self._rooms.move_to_end(room_id)
+                return ring
+        loaded = self._load(room_id, None, self.ring_size)
+        with self._lock:
+            ring = self._rooms.get(room_id)
+            if ring is not None:
+                # Another thread loaded the room meanwhile
+                self._rooms.move_to_end(room_id)
+                return ring
+            # Queued messages may not be in the database yet, or have been written since the read
+            loaded_ids = {message.id for message in loaded}
+            queued = [message for message in self._flushing + self._pending
+                      if message.room_id == room_id and message.id not in loaded_ids]
+            ring = self._rooms[room_id] = deque(sorted(loaded + queued, key=_Message.key), maxlen=self.ring_size)
+            if len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+            return ring
+
+    def append(self, room_id: str, username: str, message: str) -> Entry:
+        sent_at = datetime.datetime.utcnow()
+        entry = {'username': username, 'message': message, 'timestamp': _timestamp(sent_at)}
+        ring = self._ring(room_id)
+        with self._lock:
+            queued = _Message(room_id, entry, sent_at)
+            ring.append(queued)
+            self._pending.append(queued)
+            full = len(self._pending) >= self.batch_size
+        self._ensure_writer()
+        if full:
+            self._wake.set()
+        return entry
+
+    def recent(self, room_id: str) -> List[Entry]:
+        """The ring's messages, oldest first, for replay to a joining player."""
+        ring = self._ring(room_id)
+        with self._lock:
+            return [message.entry for message in ring]
+
+    def page(self, room_id: str, before: Optional[str] = None, limit: int = 50) -> Tuple[List[Entry], Optional[str]]:
+        """
+        Up to `limit` messages sent before the `before` cursor, newest first,
+        and the cursor for the next page (None when there is no more).
+        Raises ValueError for a malformed cursor.
+        """
+        limit = max(1, min(limit, MAX_PAGE))
+        cursor = parse_cursor(before) if before else None
+        ring = self._ring(room_id)
+        with self._lock:
+            messages = sorted(ring, key=_Message.key)
+        if any(message.id is None for message in messages):
+            # Cursors carry row ids; a failed write leaves these ordered last, by timestamp
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("chat history flush failed")
+        newer = [message for message in reversed(messages) if cursor is None or message.key() < cursor]
+        # One extra message tells whether there is another page
+        page = newer[:limit + 1]
+        if len(page) <= limit:
+            # The database holds everything older than the ring
+            bound = messages[0].key() if messages else None
+            if cursor is not None and (bound is None or cursor < bound):
+                bound = cursor
+            page += self._load(room_id, bound, limit - len(page) + 1)
+        more = len(page) > limit
+        page = page[:limit]
+        return [message.entry for message in page], page[-1].cursor() if more and page else None
+
+    def _load(self, room_id: str, before: Optional[Cursor], limit: int) -> List[_Message]:
+        """Persisted messages ordered before `before`, newest first."""
+        db = ReadSessionLocal()
+        try:
+            query = db.query(ChatMessage).filter(ChatMessage.room_id == room_id)
+            if before is not None:
+                sent_at, row_id = before
+                # The plain bound lets SQLite seek the (room_id, sent_at, id) index
+                query = query.filter(ChatMessage.sent_at <= sent_at,
+                                     tuple_(ChatMessage.sent_at, ChatMessage.id) < tuple_(sent_at, row_id))
+            rows = query.order_by(ChatMessage.sent_at.desc(), ChatMessage.id.desc()).limit(limit).all()
+        finally:
+            db.close()
+        return [_Message(room_id,
+                         {'username': row.sender_name,
+                          'message': decrypt_data(row.content, CHAT_KEY, row.iv).decode(),
+                          'timestamp': _timestamp(row.sent_at)},
+                         row.sent_at, row.id) for row in rows]
+
+    def flush(self) -> int:
+        """Write every queued message in one transaction; returns how many."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._flushing = batch
+            if not batch:
+                return 0
+            rows = []
+            for message in batch:
+                encrypted = encrypt_data(message.entry['message'].encode(), CHAT_KEY)
+                rows.append(ChatMessage(room_id=message.room_id, sender_name=message.entry['username'],
+                                        sent_at=message.sent_at, content=encrypted['encrypted_data'],
+                                        iv=encrypted['iv']))
+            db = SessionLocal()
+            try:
+                db.add_all(rows)
+                db.flush()
+                # Before the commit, so a ring loading the room after it can tell these rows apart
+                with self._lock:
+                    for message, row in zip(batch, rows):
+                        message.id = row.id
+                db.commit()
+            except Exception:
+                db.rollback()
+                # Put the batch back in front so nothing is lost or reordered
+                with self._lock:
+                    for message in batch:
+                        message.id = None
+                    self._pending[:0] = batch
+                    self._flushing = []
+                raise
+            finally:
+                db.close()
+            with self._lock:
+                self._flushing = []
+            self.flushed += len(rows)
+            self.batches += 1
+            return len(rows)
+
+    def _run_writer(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # The batch was requeued; retried on the next pass
+                logger.exception("chat history flush failed")
+
+    def _ensure_writer(self):
+        if self._writer is None:
+            with self._flush_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run_writer, name="chat-writer", daemon=True)
+                    self._writer.start()
+                    atexit.register(self.flush)
+
+    def drop(self, room_id: str):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"rooms": len(self._rooms), "pending": len(self._pending),
+                "flushed": self.flushed, "batches": self.batches}
+
+
+chat_history = ChatHistory()
@@ -0,0 +1,44 @@
+"""
+Chess-sequence secrets.
+
+A login sequence is canonicalised first, so "E2-E4, e7e5" and
+"e2-e4 e7-e5" are the same secret, and only a keyed HMAC-SHA256 of the
+canonical form is stored, in the fixed-width indexed
+`ChessMove.sequence_digest` column. Verification is then one indexed point
+lookup and the database never holds the sequence itself.
+
+The HMAC key comes from SECUREPLUS_CHESS_DIGEST_KEY (falling back to
+SECRET_KEY); changing it invalidates every registered sequence.
+"""
+
+import hashlib
+import hmac
+import os
+import re
+
+DIGEST_KEY = os.environ.get(
+    "SECUREPLUS_CHESS_DIGEST_KEY", os.environ.get("SECRET_KEY", "your_secret_key_here")
+).encode()
+
+# Coordinate notation with any separator, optional promotion: e2-e4, e2e4, E7xE8=Q
+_COORDINATE_MOVE = re.compile(r"^([a-h][1-8])[-x:]?([a-h][1-8])=?([qrbn])?$")
+_SEPARATORS = re.compile(r"[\s,;]+")
+
+
+def canonical_move(move: str) -> str:
+    """Coordinate moves become "e2-e4" / "e7-e8q"; anything else (SAN) is kept as typed."""
+    match = _COORDINATE_MOVE.match(move.lower())
+    if not match:
+        return move
+    origin, target, promotion = match.groups()
+    return f"{origin}-{target}{promotion or ''}"
+
+
+def canonicalize(sequence: str) -> str:
+    moves = [canonical_move(move) for move in _SEPARATORS.split(sequence.strip()) if move]
+    return ",".join(moves)
+
+
+def sequence_digest(sequence: str) -> str:
+    """Hex HMAC-SHA256 of the canonical sequence (64 characters)."""
+    return hmac.new(DIGEST_KEY, canonicalize(sequence).encode(), hashlib.sha256).hexdigest()
@@ -0,0 +1,381 @@
+"""
+Bitboard chess engine for validating and playing moves server-side.
+
+The position is twelve 64-bit piece bitboards (one per colour and piece
+type, square 0 = a1, 63 = h8) plus a mailbox for "what is on this square"
+lookups. Knight, king and pawn attacks come from precomputed tables;
+sliding attacks walk precomputed rays and stop at the first blocker found
+with a bit scan. Moves are applied incrementally (`push` / `pop`), and the
+legality test is "make the move, is our king attacked, unmake it".
+
+    board = Board()                 # or Board(fen)
+    board.play("e2-e4")             # raises IllegalMove
+    board.fen(), board.outcome()    # "active", "check", "checkmate", "stalemate", "draw"
+
+`benchmarks/perft.py` checks move generation against the standard perft
+positions.
+"""
+
+import re
+from typing import List, NamedTuple, Optional
+
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+EMPTY = -1
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+PIECE_LETTERS = "pnbrqk"
+WK, WQ, BK, BQ = 1, 2, 4, 8
+
+
+class IllegalMove(ValueError):
+    pass
+
+
+def square_name(sq: int) -> str:
+    return "abcdefgh"[sq & 7] + str((sq >> 3) + 1)
+
+
+def parse_square(name: str) -> int:
+    return (int(name[1]) - 1) * 8 + "abcdefgh".index(name[0])
+
+
+class Move(NamedTuple):
+    from_sq: int
+    to_sq: int
+    promotion: Optional[int] = None
+
+    def __str__(self):
+        promotion = PIECE_LETTERS[self.promotion] if self.promotion else ""
+        return f"{square_name(self.from_sq)}-{square_name(self.to_sq)}{promotion}"
+
+
+def _bits(bb: int):
+    while bb:
+        lsb = bb & -bb
+        yield lsb.bit_length() - 1
+        bb ^= lsb
+
+
+def _step_table(steps):
+    table = []
+    for sq in range(64):
+        f, r = sq & 7, sq >> 3
+        bb = 0
+        for df, dr in steps:
+            if 0 <= f + df < 8 and 0 <= r + dr < 8:
+                bb |= 1 << ((r + dr) * 8 + f + df)
+        table.append(bb)
+    return table
+
+
+def _ray_table(df, dr):
+    table = []
+    for sq in range(64):
+        f, r = (sq & 7) + df, (sq >> 3) + dr
+        bb = 0
+        while 0 <= f < 8 and 0 <= r < 8:
+            bb |= 1 << (r * 8 + f)
+            f, r = f + df, r + dr
+        table.append(bb)
+    return table
+
+
+KNIGHT_ATTACKS = _step_table([(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)])
+KING_ATTACKS = _step_table([(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)])
+PAWN_ATTACKS = (_step_table([(-1, 1), (1, 1)]), _step_table([(-1, -1), (1, -1)]))
+
+# Rays towards higher squares stop at their lowest blocker, the others at their highest
+_ROOK_UP = (_ray_table(0, 1), _ray_table(1, 0))
+_ROOK_DOWN = (_ray_table(0, -1), _ray_table(-1, 0))
+_BISHOP_UP = (_ray_table(1, 1), _ray_table(-1, 1))
+_BISHOP_DOWN = (_ray_table(1, -1), _ray_table(-1, -1))
+
+
+def _slide(sq: int, occ: int, up, down) -> int:
+    attacks = 0
+    for rays in up:
+        ray = rays[sq]
+        blockers = ray & occ
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+    for rays in down:
+        ray = rays[sq]
+        blockers = ray & occ
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+
+def rook_attacks(sq: int, occ: int) -> int:
+    return _slide(sq, occ, _ROOK_UP, _ROOK_DOWN)
+
+
+def bishop_attacks(sq: int, occ: int) -> int:
+    return _slide(sq, occ, _BISHOP_UP, _BISHOP_DOWN)
+
+
+# Castling rights kept when a piece moves from or to each square
+CASTLE_MASK = [15] * 64
+CASTLE_MASK[4] &= ~(WK | WQ)
+CASTLE_MASK[7] &= ~WK
+CASTLE_MASK[0] &= ~WQ
+CASTLE_MASK[60] &= ~(BK | BQ)
+CASTLE_MASK[63] &= ~BK
+CASTLE_MASK[56] &= ~BQ
+
+_MOVE_TEXT = re.compile(r"^([a-h][1-8])[-x:]?([a-h][1-8])=?([qrbn])?$")
+
+
+class Board:
+    def __init__(self, fen: str = START_FEN):
+        self.set_fen(fen)
+
+    # -- FEN ---------------------------------------------------------------
+
+    def set_fen(self, fen: str):
+        try:
+            placement, turn, castling, ep, *counters = fen.split()
+            self.bb = [0] * 12
+            self.squares = [EMPTY] * 64
+            ranks = placement.split("/")
+            if len(ranks) != 8:
+                raise ValueError
+            for r, row in enumerate(ranks):
+                f = 0
+                for ch in row:
+                    if ch.isdigit():
+                        f += int(ch)
+                        continue
+                    piece = (WHITE if ch.isupper() else BLACK) * 6 + PIECE_LETTERS.index(ch.lower())
+                    sq = (7 - r) * 8 + f
+                    self.bb[piece] |= 1 << sq
+                    self.squares[sq] = piece
+                    f += 1
+                if f != 8:
+                    raise ValueError
+            self.turn = WHITE if turn == "w" else BLACK
+            self.castling = sum(bit for ch, bit in zip("KQkq", (WK, WQ, BK, BQ)) if ch in castling)
+            self.ep = None if ep == "-" else parse_square(ep)
+            self.halfmove = int(counters[0]) if counters else 0
+            self.fullmove = int(counters[1]) if len(counters) > 1 else 1
+        except (ValueError, IndexError):
+            raise ValueError(f"Invalid FEN: {fen!r}")
+        self.occ = [sum(self.bb[0:6]), sum(self.bb[6:12])]
+        self._stack = []
+
+    def fen(self) -> str:
+        rows = []
+        for r in range(7, -1, -1):
+            row, empty = "", 0
+            for f in range(8):
+                piece = self.squares[r * 8 + f]
+                if piece == EMPTY:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                letter = PIECE_LETTERS[piece % 6]
+                row += letter.upper() if piece < 6 else letter
+            rows.append(row + (str(empty) if empty else ""))
+        castling = "".join(ch for ch, bit in zip("KQkq", (WK, WQ, BK, BQ)) if self.castling & bit) or "-"
+        ep = square_name(self.ep) if self.ep is not None else "-"
+        return f"{'/'.join(rows)} {'wb'[self.turn]} {castling} {ep} {self.halfmove} {self.fullmove}"
+
+    # -- attacks -----------------------------------------------------------
+
+    def attacked(self, sq: int, by: int) -> bool:
+        bb = self.bb
+        o = by * 6
+        if PAWN_ATTACKS[1 - by][sq] & bb[o + PAWN] or KNIGHT_ATTACKS[sq] & bb[o + KNIGHT] \
+                or KING_ATTACKS[sq] & bb[o + KING]:
+            return True
+        occ = self.occ[0] | self.occ[1]
+        diagonal = bb[o + BISHOP] | bb[o + QUEEN]
+        if diagonal and bishop_attacks(sq, occ) & diagonal:
+            return True
+        straight = bb[o + ROOK] | bb[o + QUEEN]
+        return bool(straight and rook_attacks(sq, occ) & straight)
+
+    def king_square(self, color: int) -> int:
+        return self.bb[color * 6 + KING].bit_length() - 1
+
+    def is_check(self) -> bool:
+        return self.attacked(self.king_square(self.turn), 1 - self.turn)
+
+    # -- move generation ---------------------------------------------------
+
+    def pseudo_legal_moves(self) -> List[Move]:
+        us, them = self.turn, 1 - self.turn
+        bb = self.bb
+        own, enemy = self.occ[us], self.occ[them]
+        occ = own | enemy
+        o = us * 6
+        moves = []
+
+        forward, start_rank, last_rank = (8, 1, 7) if us == WHITE else (-8, 6, 0)
+        for frm in _bits(bb[o + PAWN]):
+            targets = PAWN_ATTACKS[us][frm] & enemy
+            to = frm + forward
+            if not occ >> to & 1:
+                targets |= 1 << to
+                if frm >> 3 == start_rank and not occ >> (to + forward) & 1:
+                    moves.append(Move(frm, to + forward))
+            if self.ep is not None and PAWN_ATTACKS[us][frm] >> self.ep & 1:
+                targets |= 1 << self.ep
+            for to in _bits(targets):
+                if to >> 3 == last_rank:
+                    moves.extend(Move(frm, to, promotion) for promotion in (QUEEN, ROOK, BISHOP, KNIGHT))
+                else:
+                    moves.append(Move(frm, to))
+
+        not_own = ~own
+        for frm in _bits(bb[o + KNIGHT]):
+            moves.extend(Move(frm, to) for to in _bits(KNIGHT_ATTACKS[frm] & not_own))
+        for frm in _bits(bb[o + BISHOP] | bb[o + QUEEN]):
+            moves.extend(Move(frm, to) for to in _bits(bishop_attacks(frm, occ) & not_own))
+        for frm in _bits(bb[o + ROOK] | bb[o + QUEEN]):
+            moves.extend(Move(frm, to) for to in _bits(rook_attacks(frm, occ) & not_own))
+        king = self.king_square(us)
+        moves.extend(Move(king, to) for to in _bits(KING_ATTACKS[king] & not_own))
+
+        # Castling: path empty, king not in check and not passing through an attacked square
+        # (the landing square is checked with every other move below)
+        base = 0 if us == WHITE else 56
+        kingside, queenside = (WK, WQ) if us == WHITE else (BK, BQ)
+        if self.castling & (kingside | queenside) and king == base + 4 and not self.attacked(king, them):
+            rooks = bb[o + ROOK]
+            if self.castling & kingside and rooks >> (base + 7) & 1 \
+                    and not occ & (0b11 << (base + 5)) and not self.attacked(base + 5, them):
+                moves.append(Move(king, base + 6))
+            if self.castling & queenside and rooks >> base & 1 \
+                    and not occ & (0b111 << (base + 1)) and not self.attacked(base + 3, them):
+                moves.append(Move(king, base + 2))
+        return moves
+
+    def legal_moves(self) -> List[Move]:
+        us, them = self.turn, 1 - self.turn
+        legal = []
+        for move in self.pseudo_legal_moves():
+            self.push(move)
+            if not self.attacked(self.king_square(us), them):
+                legal.append(move)
+            self.pop()
+        return legal
+
+    def has_legal_move(self) -> bool:
+        us, them = self.turn, 1 - self.turn
+        for move in self.pseudo_legal_moves():
+            self.push(move)
+            safe = not self.attacked(self.king_square(us), them)
+            self.pop()
+            if safe:
+                return True
+        return False
+
+    # -- making moves ------------------------------------------------------
+
+    def push(self, move: Move):
+        """Apply a (pseudo-legal) move; `pop` undoes it."""
+        bb, squares, occ = self.bb, self.squares, self.occ
+        self._stack.append((bb[:], squares[:], occ[:], self.castling, self.ep, self.halfmove, self.fullmove))
+        frm, to, promotion = move
+        us, them = self.turn, 1 - self.turn
+        piece = squares[frm]
+        kind = piece % 6
+        self.halfmove += 1
+
+        captured = squares[to]
+        if captured != EMPTY:
+            bb[captured] ^= 1 << to
+            occ[them] ^= 1 << to
+            self.halfmove = 0
+        if kind == PAWN:
+            self.halfmove = 0
+            if to == self.ep:
+                victim = to - 8 if us == WHITE else to + 8
+                bb[them * 6 + PAWN] ^= 1 << victim
+                occ[them] ^= 1 << victim
+                squares[victim] = EMPTY
+
+        from_to = (1 << frm) | (1 << to)
+        bb[piece] ^= from_to
+        occ[us] ^= from_to
+        squares[frm] = EMPTY
+        squares[to] = piece
+        if promotion:
+            bb[piece] ^= 1 << to
+            bb[us * 6 + promotion] |= 1 << to
+            squares[to] = us * 6 + promotion
+        elif kind == KING and abs(to - frm) == 2:
+            rook_from, rook_to = (frm + 3, frm + 1) if to > frm else (frm - 4, frm - 1)
+            rook = us * 6 + ROOK
+            mask = (1 << rook_from) | (1 << rook_to)
+            bb[rook] ^= mask
+            occ[us] ^= mask
+            squares[rook_from] = EMPTY
+            squares[rook_to] = rook
+
+        self.castling &= CASTLE_MASK[frm] & CASTLE_MASK[to]
+        self.ep = (frm + to) // 2 if kind == PAWN and abs(to - frm) == 16 else None
+        if us == BLACK:
+            self.fullmove += 1
+        self.turn = them
+
+    def pop(self):
+        self.bb, self.squares, self.occ, self.castling, self.ep, self.halfmove, self.fullmove = self._stack.pop()
+        self.turn = 1 - self.turn
+
+    def parse_move(self, text: str) -> Move:
+        """Find the legal move written as "e2-e4", "e2e4", "e7-e8q", "e7e8=Q" or "O-O"/"O-O-O"."""
+        text = text.strip().lower().replace("0", "o")
+        if text in ("o-o", "o-o-o"):
+            base = 0 if self.turn == WHITE else 56
+            origin, target, promotion = base + 4, base + (6 if text == "o-o" else 2), None
+        else:
+            match = _MOVE_TEXT.match(text)
+            if not match:
+                raise IllegalMove(f"Unrecognised move {text!r}")
+            origin, target = parse_square(match.group(1)), parse_square(match.group(2))
+            promotion = PIECE_LETTERS.index(match.group(3)) if match.group(3) else None
+        candidates = [m for m in self.legal_moves() if m.from_sq == origin and m.to_sq == target]
+        if not candidates:
+            raise IllegalMove(f"Illegal move {text!r}")
+        for move in candidates:
+            # A promotion without a piece letter promotes to a queen
+            if move.promotion == (promotion if promotion is not None else candidates[0].promotion):
+                return move
+        raise IllegalMove(f"Illegal move {text!r}")
+
+    def play(self, text: str) -> Move:
+        move = self.parse_move(text)
+        self.push(move)
+        self._stack.clear()
+        return move
+
+    # -- game state --------------------------------------------------------
+
+    def outcome(self) -> str:
+        in_check = self.is_check()
+        if not self.has_legal_move():
+            return "checkmate" if in_check else "stalemate"
+        if self.halfmove >= 100:
+            return "draw"
+        return "check" if in_check else "active"
+
+    def perft(self, depth: int) -> int:
+        if depth == 0:
+            return 1
+        moves = self.legal_moves()
+        if depth == 1:
+            return len(moves)
+        nodes = 0
+        for move in moves:
+            self.push(move)
+            nodes += self.perft(depth - 1)
+            self.pop()
+        return nodes
@@ -0,0 +1,83 @@
+"""
+Incremental matcher for chess authentication sequences.
+
+All sequences are kept in one prefix trie, with a root per starting
+position. A game only holds a cursor, the integer id of the trie node its
+moves so far have reached, so each move costs one dict lookup however many
+moves were played or sequences are registered. Cursors are plain ints and
+can live in any game-state store.
+
+A sequence matches when a game's moves, from the start position, begin
+with it (the same rule the per-move rescan used). A completed sequence may
+be the prefix of a longer one, so the walk carries on into the longer
+branch; once a move leaves the trie the cursor settles on the last
+sequence completed along the way (found through the parent links) and
+every later move still reports that match. A move that leaves the trie
+before any sequence completed kills the cursor.
+"""
+
+import threading
+from typing import Dict, Hashable, Iterable, List, Optional
+
+from .chess_auth import canonical_move
+
+DEAD = -1
+
+
+def _settled(node: int) -> int:
+    # Cursors below DEAD are finished matches: -2 is node 0, -3 node 1, ...
+    return DEAD - 1 - node
+
+
+class SequenceMatcher:
+    def __init__(self):
+        self._children: List[Dict[str, int]] = []
+        self._parents: List[int] = []
+        self._accepts: Dict[int, Hashable] = {}
+        self._roots: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _new_node(self, parent: int = DEAD) -> int:
+        self._children.append({})
+        self._parents.append(parent)
+        return len(self._children) - 1
+
+    def add(self, position: str, moves: Iterable[str], value: Hashable = True):
+        """Register a sequence; `value` is what a completed match reports."""
+        with self._lock:
+            node = self._roots.get(position)
+            if node is None:
+                node = self._roots[position] = self._new_node()
+            for move in moves:
+                move = canonical_move(move)
+                child = self._children[node].get(move)
+                if child is None:
+                    child = self._children[node][move] = self._new_node(node)
+                node = child
+            self._accepts[node] = value
+
+    def start(self, position: str) -> int:
+        """Cursor for a game starting at `position` (DEAD if no sequence starts there)."""
+        return self._roots.get(position, DEAD)
+
+    def advance(self, cursor: int, move: str) -> int:
+        if cursor <= DEAD:
+            # Dead, or settled on a match that no later move can undo
+            return cursor
+        child = self._children[cursor].get(canonical_move(move))
+        if child is not None:
+            return child
+        # Off the trie: the longest sequence completed on the way here, if any
+        node = cursor
+        while node != DEAD and node not in self._accepts:
+            node = self._parents[node]
+        return DEAD if node == DEAD else _settled(node)
+
+    def matched(self, cursor: int) -> Optional[Hashable]:
+        """The value of the sequence completed at this cursor, if any."""
+        if cursor < DEAD:
+            cursor = _settled(cursor)
+        return self._accepts.get(cursor)
+
+    def __len__(self):
+        return len(self._accepts)
@@ -0,0 +1,277 @@
+"""
+Chunked storage for large files.
+
+A chunked file's blob is a small manifest instead of ciphertext: the list of
+its chunks in order, each a separate blob encrypted with the file's key and
+its own random IV. Alongside each chunk the manifest keeps its length and a
+keyed MAC of its plaintext, which is what lets an update tell, without
+decrypting anything, which chunks of the new content are unchanged.
+
+An update keeps the file's key and walks the old manifest from both ends:
+old chunks whose MAC matches the new content at the same offset from the
+start (the unchanged prefix) or from the end (the unchanged suffix, which
+may have moved) are reused as they are, and only the content between them
+is cut into SECUREPLUS_STORAGE_CHUNK_SIZE chunks and encrypted. A small edit
+to a large file therefore writes a chunk or two plus the new manifest, and
+since the file row only holds the manifest's digest, switching versions is
+a single-column update committed with everything else.
+
+Manifests are blobs too, so backups share them exactly as they share plain
+file blobs. Each manifest holds one reference on each of its chunks; the
+blob store releases those when the manifest's own last reference goes.
+
+Each chunk is compressed on its own before encryption when the compression
+policy allows it, and its codec is recorded in the manifest, so a range
+read still decompresses only the chunks it covers.
+
+Files of at least SECUREPLUS_CHUNKED_MIN_BYTES are chunked when their
+content is next replaced. Uploads that large are chunked as they arrive
+when their content is compressible (ManifestWriter), since a single
+compressed stream could only be range-read from its start; other uploads
+and smaller files keep using a single blob.
+"""
+
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import uuid
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from . import blobstore, compression
+from .crypto import crypto_executor, decrypt_data, encrypt_data, generate_iv
+from .delta import splice_delta
+from .models import Blob
+
+MAGIC = b"SPM1\n"
+CHUNK_SIZE = int(os.environ.get("SECUREPLUS_STORAGE_CHUNK_SIZE", 1024 * 1024))
+CHUNKED_THRESHOLD = int(os.environ.get("SECUREPLUS_CHUNKED_MIN_BYTES", 8 * 1024 * 1024))
+
+
+class Chunk(NamedTuple):
+    hash: str     # blob digest of the ciphertext
+    length: int   # plaintext length
+    iv: bytes
+    mac: bytes    # keyed MAC of the plaintext
+    codec: Optional[str] = None  # compression applied before encryption
+
+
+def derive_mac_key(key: bytes) -> bytes:
+    return hmac.digest(key, b"secureplus-chunk-mac", "sha256")
+
+
+def chunk_mac(mac_key: bytes, data) -> bytes:
+    return hmac.digest(mac_key, data, "sha256")[:16]
+
+
+class Manifest:
+    def __init__(self, chunks: List[Chunk]):
+        self.chunks = chunks
+        self.offsets = []
+        size = 0
+        for chunk in chunks:
+            self.offsets.append(size)
+            size += chunk.length
+        self.size = size
+
+    def encode(self) -> bytes:
+        return MAGIC + json.dumps(
+            {"chunks": [[c.hash, c.length, c.iv.hex(), c.mac.hex()] + ([c.codec] if c.codec else [])
+                        for c in self.chunks]},
+            separators=(",", ":"),
+        ).encode()
+
+    @classmethod
+    def decode(cls, data: bytes) -> "Manifest":
+        body = json.loads(data[len(MAGIC):])
+        return cls([Chunk(h, length, bytes.fromhex(iv), bytes.fromhex(mac), *rest)
+                    for h, length, iv, mac, *rest in body["chunks"]])
+
+    # open_ciphertext() hands a Manifest out where it would a file object
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _decrypt(self, index: int, key: bytes) -> bytes:
+        chunk = self.chunks[index]
+        return compression.decompress(chunk.codec, decrypt_data(blobstore.read_blob(chunk.hash), key, chunk.iv))
+
+    def read(self, key: bytes) -> bytes:
+        """The whole plaintext, chunks decrypted in parallel."""
+        if len(self.chunks) <= 1:
+            return b"".join(self._decrypt(i, key) for i in range(len(self.chunks)))
+        return b"".join(crypto_executor.map(lambda i: self._decrypt(i, key), range(len(self.chunks))))
+
+    def iter_range(self, key: bytes, start: int, length: int) -> Iterator[bytes]:
+        """Yield `length` plaintext bytes from `start`, decrypting only the chunks they fall in."""
+        end = min(start + length, self.size)
+        index = bisect.bisect_right(self.offsets, start) - 1
+        while start < end and index < len(self.chunks):
+            offset = self.offsets[index]
+            plain = self._decrypt(index, key)
+            yield plain[start - offset:end - offset]
+            start = offset + len(plain)
+            index += 1
+
+
+def load(digest: Optional[str]) -> Optional[Manifest]:
+    """The manifest stored under `digest`, or None if that blob is plain ciphertext."""
+    if not digest:
+        return None
+    with blobstore.open_blob(digest) as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        return Manifest.decode(MAGIC + f.read())
+
+
+def referenced_blobs(digest: str) -> List[str]:
+    """Chunks a blob holds references on (none unless it is a manifest)."""
+    try:
+        manifest = load(digest)
+    except FileNotFoundError:
+        return []
+    return [chunk.hash for chunk in manifest.chunks] if manifest else []
+
+
+class Splice(NamedTuple):
+    """How new content relates to the old manifest: kept prefix, rewritten middle, kept suffix."""
+    prefix: int
+    old_middle: List[int]  # indexes of the old chunks the middle replaces
+    suffix_offset: int     # where the kept suffix starts in the old content
+    suffix: int
+
+
+def encrypt_chunk(key: bytes, mac_key: bytes, data, file_type: Optional[str] = None) -> Tuple[bytes, Chunk]:
+    """Compress (if worthwhile) and encrypt one chunk; the Chunk's hash is left for the caller to fill in."""
+    iv = generate_iv()
+    payload, codec = compression.pack(bytes(data), file_type)
+    return encrypt_data(payload, key, iv)["encrypted_data"], Chunk("", len(data), iv, chunk_mac(mac_key, data), codec)
+
+
+class ManifestWriter:
+    """Builds a manifest from plaintext chunks arriving in order, e.g. from an upload.
+
+    `encrypt()` is safe to run on the crypto pool, several chunks at once;
+    `append()` its results in order. Ciphertext waits in temporary files in
+    the blob directory until `commit()` (a database operation) stores the
+    chunks and the manifest and returns its digest; `discard()` throws them
+    away. Like blobstore.BlobWriter, `content_size` is the plaintext size.
+    """
+
+    def __init__(self, key: bytes, file_type: Optional[str] = None):
+        self.key = key
+        self.mac_key = derive_mac_key(key)
+        self.file_type = file_type
+        self.content_size = 0
+        self._pending: List[Tuple[str, Chunk]] = []
+
+    def encrypt(self, data: bytes) -> Tuple[str, Chunk]:
+        ciphertext, chunk = encrypt_chunk(self.key, self.mac_key, data, self.file_type)
+        os.makedirs(blobstore.BLOB_DIR, exist_ok=True)
+        path = os.path.join(blobstore.BLOB_DIR, f".{uuid.uuid4().hex}.part")
+        with open(path, "wb") as f:
+            f.write(ciphertext)
+        return path, chunk._replace(hash=hashlib.sha256(ciphertext).hexdigest())
+
+    def append(self, encrypted: Tuple[str, Chunk]):
+        self._pending.append(encrypted)
+        self.content_size += encrypted[1].length
+
+    def commit(self, db: Session) -> str:
+        chunks = []
+        for path, chunk in self._pending:
+            blobstore.put_file(db, path, chunk.hash, os.path.getsize(path))
+            chunks.append(chunk)
+        self._pending = []
+        return store_manifest(db, Manifest(chunks))
+
+    def discard(self):
+        for path, _ in self._pending:
+            if os.path.exists(path):
+                os.remove(path)
+        self._pending = []
+
+
+def _match(previous: Manifest, mac_key: bytes, view: memoryview) -> Tuple[int, int]:
+    """Indexes splitting `previous` into chunks unchanged at the start, the rest, and chunks unchanged at the end."""
+    chunks = previous.chunks
+    head = 0
+    while head < len(chunks):
+        offset, length = previous.offsets[head], chunks[head].length
+        if offset + length > len(view) or chunk_mac(mac_key, view[offset:offset + length]) != chunks[head].mac:
+            break
+        head += 1
+    prefix = previous.offsets[head] if head < len(chunks) else previous.size
+    tail = len(chunks)
+    while tail > head:
+        chunk = chunks[tail - 1]
+        new_offset = len(view) - (previous.size - previous.offsets[tail - 1])
+        if new_offset < prefix or chunk_mac(mac_key, view[new_offset:new_offset + chunk.length]) != chunk.mac:
+            break
+        tail -= 1
+    return head, tail
+
+
+def write(db: Session, key: bytes, content: bytes, previous: Optional[Manifest] = None,
+          chunk_size: int = CHUNK_SIZE, file_type: Optional[str] = None) -> Tuple[str, Optional[Splice]]:
+    """
+    Store `content` as a manifest (one reference taken on it) and return its
+    digest, plus the Splice against `previous` when there was one. Chunks of
+    `previous` that are unchanged are shared, not rewritten; `key` must be
+    the one `previous` was written with.
+    """
+    mac_key = derive_mac_key(key)
+    view = memoryview(content)
+    splice = None
+    kept_head, kept_tail = [], []
+    middle_start, middle_end = 0, len(content)
+    if previous is not None:
+        head, tail = _match(previous, mac_key, view)
+        suffix = sum(chunk.length for chunk in previous.chunks[tail:])
+        # A short middle would leave a fragment behind every edit; rewrite the next chunk along with it
+        if tail < len(previous.chunks) and len(content) - suffix - previous.offsets[head] < chunk_size // 2:
+            suffix -= previous.chunks[tail].length
+            tail += 1
+        kept_head, kept_tail = previous.chunks[:head], previous.chunks[tail:]
+        middle_start, middle_end = sum(chunk.length for chunk in kept_head), len(content) - suffix
+        splice = Splice(middle_start, list(range(head, tail)), previous.size - suffix, suffix)
+
+    pieces = [view[o:min(o + chunk_size, middle_end)] for o in range(middle_start, middle_end, chunk_size)]
+    if len(pieces) > 1 and len(pieces[-1]) < chunk_size // 2:
+        # Likewise a short last piece joins the one before (chunks stay under 1.5x chunk_size)
+        pieces[-2:] = [view[middle_end - len(pieces[-2]) - len(pieces[-1]):middle_end]]
+    if len(pieces) > 1:
+        encrypted = list(crypto_executor.map(lambda piece: encrypt_chunk(key, mac_key, piece, file_type), pieces))
+    else:
+        encrypted = [encrypt_chunk(key, mac_key, piece, file_type) for piece in pieces]
+
+    # The new manifest holds a reference on every chunk it lists
+    fresh = [chunk._replace(hash=blobstore.put_bytes(db, ciphertext)) for ciphertext, chunk in encrypted]
+    for chunk in kept_head + kept_tail:
+        blobstore.acquire(db, chunk.hash)
+    return store_manifest(db, Manifest(kept_head + fresh + kept_tail)), splice
+
+
+def store_manifest(db: Session, manifest: Manifest) -> str:
+    """Store a manifest whose chunk references the caller holds; returns its digest (one reference taken)."""
+    encoded = manifest.encode()
+    digest = hashlib.sha256(encoded).hexdigest()
+    if db.query(Blob.hash).filter(Blob.hash == digest).first() is not None:
+        # This exact manifest is already stored and holds its own chunk references
+        for chunk in manifest.chunks:
+            blobstore.release(db, chunk.hash)
+        blobstore.acquire(db, digest)
+        return digest
+    return blobstore.put_bytes(db, encoded)
+
+
+def splice_changes(previous: Manifest, key: bytes, splice: Splice, content: bytes) -> bytes:
+    """A versioning delta from the old content to `content`, decrypting only the replaced old chunks."""
+    old_middle = b"".join(previous._decrypt(i, key) for i in splice.old_middle)
+    new_middle = content[splice.prefix:len(content) - splice.suffix]
+    return splice_delta(splice.prefix, old_middle, new_middle, splice.suffix_offset, splice.suffix)
@@ -0,0 +1,223 @@
+"""
+Per-document collaboration rooms for /ws/document.
+
+Every connection editing a file joins that file's room. Joining is where
+access is decided: `join` takes the authenticated principal and only
+accepts the socket if the user is active and owns the file, so nothing is
+ever broadcast to a connection that could not read the file over REST.
+A broadcast never
+awaits a socket: it puts the message on each peer's bounded send queue and
+returns, and each peer has its own writer task draining its queue, so a
+slow client only delays itself and the sender's receive loop keeps going.
+
+When a peer's queue is full (SECUREPLUS_COLLAB_QUEUE_SIZE messages) the
+room's policy, SECUREPLUS_COLLAB_POLICY, decides:
+
+    drop_oldest  discard the oldest queued message (the default)
+    drop_newest  discard the incoming message
+    coalesce     replace the queued message with the same coalescing key,
+                 JSON messages whose "type" is one of
+                 SECUREPLUS_COLLAB_COALESCE_TYPES (cursor and presence
+                 updates, where only the latest matters), keyed by type and
+                 sender; otherwise drop the oldest
+    disconnect   close the slow connection
+
+A send that takes longer than SECUREPLUS_COLLAB_SEND_TIMEOUT seconds
+closes the connection either way. Queue depths, drops and send latency
+(queued to written) are served by /metrics/collab.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Set, Tuple
+
+from .db import run_db
+from .models import File, ReadSessionLocal
+from .principals import Principal
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = int(os.environ.get("SECUREPLUS_COLLAB_QUEUE_SIZE", 256))
+POLICY = os.environ.get("SECUREPLUS_COLLAB_POLICY", "drop_oldest")
+COALESCE_TYPES = frozenset(os.environ.get("SECUREPLUS_COLLAB_COALESCE_TYPES", "cursor,selection,presence").split(","))
+SEND_TIMEOUT = float(os.environ.get("SECUREPLUS_COLLAB_SEND_TIMEOUT", 10))
+POLICIES = ("drop_oldest", "drop_newest", "coalesce", "disconnect")
+LATENCY_SAMPLES = 2048
+
+
+def owns_file(principal: Principal, file_id: Any) -> bool:
+    db = ReadSessionLocal()
+    try:
+        return db.query(File.id).filter(File.id == file_id, File.owner_id == principal.id).first() is not None
+    finally:
+        db.close()
+
+
+def coalesce_key(data: str, sender: Hashable) -> Optional[Hashable]:
+    """Key under which a newer message supersedes an older one, or None."""
+    if not data.startswith("{"):
+        return None
+    try:
+        message = json.loads(data)
+    except ValueError:
+        return None
+    kind = message.get("type") if isinstance(message, dict) else None
+    return (kind, sender) if kind in COALESCE_TYPES else None
+
+
+class Peer:
+    def __init__(self, websocket, user_id: Any, room: "Room"):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.room = room
+        # (queued at, coalescing key, text)
+        self.queue: Deque[Tuple[float, Optional[Hashable], str]] = deque()
+        self._ready = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.create_task(self._write())
+
+    def offer(self, data: str, key: Optional[Hashable]):
+        """Queue a message without waiting, applying the room's policy when full."""
+        if self.closed:
+            return
+        stats = self.room.manager.counters
+        entry = (time.perf_counter(), key, data)
+        if len(self.queue) >= self.room.manager.queue_size:
+            policy = self.room.manager.policy
+            if policy == "disconnect":
+                stats["disconnected"] += 1
+                self.close()
+                return
+            if policy == "drop_newest":
+                stats["dropped"] += 1
+                return
+            if policy == "coalesce" and key is not None:
+                for i, (queued_at, queued_key, _) in enumerate(self.queue):
+                    if queued_key == key:
+                        # Keep the slot and its age; only the content is newer
+                        self.queue[i] = (queued_at, key, data)
+                        stats["coalesced"] += 1
+                        return
+            self.queue.popleft()
+            stats["dropped"] += 1
+        self.queue.append(entry)
+        self._ready.set()
+
+    async def _write(self):
+        manager = self.room.manager
+        try:
+            while True:
+                while not self.queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                queued_at, _, data = self.queue.popleft()
+                await asyncio.wait_for(self.websocket.send_text(data), manager.send_timeout)
+                manager.latencies.append(time.perf_counter() - queued_at)
+                manager.counters["sent"] += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Timed out or the socket went away; the receive loop notices and leaves
+            logger.info("closing collaborator %s on file %s after a failed send", self.user_id, self.room.file_id)
+            manager.counters["send_failures"] += 1
+            self.closed = True
+            self.queue.clear()
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.task.cancel()
+        asyncio.ensure_future(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close()
+        except Exception:
+            pass
+
+
+class Room:
+    def __init__(self, file_id: Any, manager: "RoomManager"):
+        self.file_id = file_id
+        self.manager = manager
+        self.peers: Set[Peer] = set()
+
+    def broadcast(self, data: str, sender: Optional[Peer] = None):
+        key = coalesce_key(data, sender.user_id if sender else None) if self.manager.policy == "coalesce" else None
+        for peer in list(self.peers):
+            if peer is not sender:
+                peer.offer(data, key)
+        self.manager.counters["broadcasts"] += 1
+
+
+class RoomManager:
+    def __init__(self, queue_size: int = QUEUE_SIZE, policy: str = POLICY, send_timeout: float = SEND_TIMEOUT,
+                 authorize: Callable[[Principal, Any], bool] = owns_file):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown collaboration policy {policy!r}; expected one of {', '.join(POLICIES)}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.authorize = authorize  # blocking; run in the database worker pool
+        self.rooms: Dict[Any, Room] = {}
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.counters = {"broadcasts": 0, "sent": 0, "dropped": 0, "coalesced": 0,
+                         "disconnected": 0, "send_failures": 0, "refused": 0}
+
+    async def join(self, file_id: Any, websocket, principal: Optional[Principal]) -> Peer:
+        """
+        Accept the socket into the file's room. Raises PermissionError, leaving
+        the socket unaccepted, unless `principal` is active and may edit the file.
+        """
+        if principal is None or principal.disabled or not await run_db(self.authorize, principal, file_id):
+            self.counters["refused"] += 1
+            raise PermissionError(f"Not allowed to edit file {file_id}")
+        await websocket.accept()
+        room = self.rooms.get(file_id)
+        if room is None:
+            room = self.rooms[file_id] = Room(file_id, self)
+        peer = Peer(websocket, principal.id, room)
+        room.peers.add(peer)
+        return peer
+
+    async def leave(self, peer: Peer):
+        room = peer.room
+        room.peers.discard(peer)
+        if not room.peers and self.rooms.get(room.file_id) is room:
+            del self.rooms[room.file_id]
+        peer.closed = True
+        peer.task.cancel()
+        try:
+            await peer.task
+        except asyncio.CancelledError:
+            pass
+
+    def broadcast(self, file_id: Any, data: str, sender: Optional[Peer] = None):
+        room = self.rooms.get(file_id)
+        if room is not None:
+            room.broadcast(data, sender)
+
+    def stats(self) -> Dict[str, Any]:
+        depths = [len(peer.queue) for room in self.rooms.values() for peer in room.peers]
+        latencies = sorted(self.latencies)
+        percentile = lambda q: round(1000 * latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3)
+        return {
+            "policy": self.policy,
+            "rooms": len(self.rooms),
+            "connections": len(depths),
+            "queue_depth_max": max(depths, default=0),
+            "queue_depth_total": sum(depths),
+            "send_latency_ms": {"p50": percentile(0.5), "p99": percentile(0.99)} if latencies else None,
+            **self.counters,
+        }
+
+
+collab_rooms = RoomManager()
@@ -0,0 +1,138 @@
+"""
+Compression stage in front of encryption.
+
+Ciphertext does not compress, so anything worth shrinking has to be
+compressed before AES sees it. Writers ask `choose_codec()` for a codec
+given the file type and the first bytes of the content; types that are
+already compressed (images, archives, Office files, media) are stored as
+they are, as are payloads under SECUREPLUS_COMPRESSION_MIN_BYTES and any
+that would not get smaller. Streams that cannot be checked afterwards
+(uploads) are judged by compressing a sample of their first bytes instead.
+A compressed stream can only be decoded from its start, so large content is
+compressed chunk by chunk in a chunk manifest (see chunkstore.py) rather
+than as one stream, keeping range reads and parallel crypto.
+The codec name is recorded next to the ciphertext (File.compression,
+BackupStorage.compression, Email.compression, or per chunk in a manifest)
+and None means stored raw, which is also what every row written before
+this stage reads as.
+
+Codecs are looked up by name, so rows keep decoding after the default
+changes. zlib is the default (SECUREPLUS_COMPRESSION, "none" to turn the
+stage off, level SECUREPLUS_COMPRESSION_LEVEL); bz2 and lzma from the
+standard library are registered too, and `register_codec()` adds others.
+Every codec provides incremental compressor and decompressor objects, so
+uploads compress as they stream and downloads decompress as they stream.
+"""
+
+import bz2
+import lzma
+import os
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+DEFAULT_CODEC = os.environ.get("SECUREPLUS_COMPRESSION", "zlib")
+LEVEL = int(os.environ.get("SECUREPLUS_COMPRESSION_LEVEL", 1))
+MIN_BYTES = int(os.environ.get("SECUREPLUS_COMPRESSION_MIN_BYTES", 256))
+SKIP_TYPES = frozenset(
+    t.strip().lower() for t in os.environ.get(
+        "SECUREPLUS_COMPRESSION_SKIP",
+        "png,jpg,jpeg,gif,webp,heic,zip,gz,tgz,bz2,xz,zst,7z,rar,docx,xlsx,pptx,odt,ods,odp,"
+        "pdf,mp3,mp4,m4a,mov,avi,mkv,webm,ogg,flac",
+    ).split(",") if t.strip()
+)
+
+# Streams whose sample compresses worse than this are stored raw
+PROBE_RATIO = 0.9
+PROBE_MIN_BYTES = 4096
+SAMPLE_BYTES = 64 * 1024
+
+# Magic numbers of compressed formats, for content whose type says nothing
+_COMPRESSED_MAGIC = (
+    b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"PK\x03\x04", b"\x1f\x8b", b"BZh", b"\xfd7zXZ",
+    b"\x28\xb5\x2f\xfd", b"7z\xbc\xaf", b"Rar!", b"%PDF", b"OggS", b"fLaC",
+)
+
+
+class Codec(NamedTuple):
+    name: str
+    compressor: Callable[[], object]    # object with compress(data) and flush()
+    decompressor: Callable[[], object]  # object with decompress(data); flush() optional
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(name: str, compressor: Callable[[], object], decompressor: Callable[[], object]):
+    CODECS[name] = Codec(name, compressor, decompressor)
+
+
+register_codec("zlib", lambda: zlib.compressobj(LEVEL), zlib.decompressobj)
+register_codec("bz2", lambda: bz2.BZ2Compressor(min(max(LEVEL, 1), 9)), bz2.BZ2Decompressor)
+register_codec("lzma", lambda: lzma.LZMACompressor(preset=min(LEVEL, 9)), lzma.LZMADecompressor)
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec {name!r}")
+
+
+def choose_codec(file_type: Optional[str] = None, head: bytes = b"", size: Optional[int] = None) -> Optional[str]:
+    """The codec to store a payload with, or None to store it raw.
+
+    `head` is the start of the payload; given a few KiB of it, the default
+    codec is tried on them and content that barely shrinks is stored raw.
+    """
+    if DEFAULT_CODEC in ("", "none") or DEFAULT_CODEC not in CODECS:
+        return None
+    if file_type and file_type.lower().lstrip(".") in SKIP_TYPES:
+        return None
+    if head.startswith(_COMPRESSED_MAGIC):
+        return None
+    if size is not None and size < MIN_BYTES:
+        return None
+    if len(head) >= PROBE_MIN_BYTES and len(compress(DEFAULT_CODEC, head)) > PROBE_RATIO * len(head):
+        return None
+    return DEFAULT_CODEC
+
+
+def compress(name: str, data: bytes) -> bytes:
+    compressor = get_codec(name).compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+def pack(data: bytes, file_type: Optional[str] = None) -> Tuple[bytes, Optional[str]]:
+    """Compress `data` if the policy allows and it pays; returns (payload, codec or None)."""
+    # On large payloads a sample is cheap insurance against compressing noise in full
+    head = data[:SAMPLE_BYTES] if len(data) > 4 * SAMPLE_BYTES else data[:16]
+    codec = choose_codec(file_type, head, len(data))
+    if codec is None:
+        return data, None
+    packed = compress(codec, data)
+    if len(packed) >= len(data):
+        return data, None
+    return packed, codec
+
+
+def decompress(name: Optional[str], data: bytes) -> bytes:
+    if name is None:
+        return data
+    return b"".join(iter_decompressed(name, (data,)))
+
+
+def iter_decompressed(name: Optional[str], chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Decompress a stream of payload chunks as it arrives."""
+    if name is None:
+        yield from chunks
+        return
+    decompressor = get_codec(name).decompressor()
+    for chunk in chunks:
+        plain = decompressor.decompress(chunk)
+        if plain:
+            yield plain
+    flush = getattr(decompressor, "flush", None)
+    if flush is not None:
+        tail = flush()
+        if tail:
+            yield tail
@@ -0,0 +1,109 @@
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+import asyncio
+import hashlib
+import hmac
+import os
+
+# Encryption functions
+def generate_key():
+    return os.urandom(32)  # 256 bits
+
+def generate_iv():
+    return os.urandom(16)  # 128 bits
+
+def new_cipher(key: bytes, iv: bytes) -> Cipher:
+    return Cipher(algorithms.AES(key), modes.CFB(iv), backend=default_backend())
+
+def encrypt_data(data: bytes, key: bytes = None, iv: bytes = None) -> Dict[str, bytes]:
+    if key is None:
+        key = generate_key()
+    if iv is None:
+        iv = generate_iv()
+
+    encryptor = new_cipher(key, iv).encryptor()
+    encrypted_data = encryptor.update(data) + encryptor.finalize()
+
+    return {
+        "encrypted_data": encrypted_data,
+        "key": key,
+        "iv": iv
+    }
+
+def decrypt_data(encrypted_data: bytes, key: bytes, iv: bytes) -> bytes:
+    decryptor = new_cipher(key, iv).decryptor()
+    decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
+    return decrypted_data
+
+# Crypto worker pool
+#
+# The cryptography backend releases the GIL while it encrypts, so large
+# payloads are encrypted on a thread pool instead of whichever thread asked
+# for them. Payloads above PARALLEL_THRESHOLD are split into independently
+# keyed segments of SEGMENT_SIZE bytes that are encrypted in parallel. CFB
+# ciphertext is exactly as long as its plaintext, so segment i always
+# covers bytes [i * SEGMENT_SIZE, (i + 1) * SEGMENT_SIZE) of both.
+CRYPTO_WORKERS = int(os.environ.get("SECUREPLUS_CRYPTO_WORKERS", os.cpu_count() or 1))
+OFFLOAD_THRESHOLD = int(os.environ.get("SECUREPLUS_CRYPTO_OFFLOAD_BYTES", 256 * 1024))
+SEGMENT_SIZE = int(os.environ.get("SECUREPLUS_CRYPTO_SEGMENT_SIZE", 4 * 1024 * 1024))
+PARALLEL_THRESHOLD = int(os.environ.get("SECUREPLUS_CRYPTO_PARALLEL_BYTES", 16 * 1024 * 1024))
+
+crypto_executor = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix="secureplus-crypto")
+
+def choose_segment_size(size: Optional[int]) -> int:
+    """Segment size to use for a payload of `size` bytes (None if not known yet); 0 means one stream."""
+    if SEGMENT_SIZE and (size is None or size > PARALLEL_THRESHOLD):
+        return SEGMENT_SIZE
+    return 0
+
+def segment_params(key: bytes, iv: bytes, index: int):
+    """Key and IV of one segment, derived from the file's key and IV."""
+    counter = iv + index.to_bytes(8, "big")
+    segment_key = hmac.new(key, b"k" + counter, hashlib.sha256).digest()
+    segment_iv = hmac.new(key, b"i" + counter, hashlib.sha256).digest()[:16]
+    return segment_key, segment_iv
+
+def crypt_segment(data: bytes, key: bytes, iv: bytes, index: int, encrypt: bool = True) -> bytes:
+    segment_key, segment_iv = segment_params(key, iv, index)
+    cipher = new_cipher(segment_key, segment_iv)
+    context = cipher.encryptor() if encrypt else cipher.decryptor()
+    return context.update(data) + context.finalize()
+
+def _crypt_segments(data: bytes, key: bytes, iv: bytes, segment_size: int, encrypt: bool) -> bytes:
+    view = memoryview(data)
+    offsets = range(0, len(data), segment_size)
+    if len(offsets) <= 1 or CRYPTO_WORKERS <= 1:
+        return b"".join(crypt_segment(view[o:o + segment_size], key, iv, i, encrypt) for i, o in enumerate(offsets))
+    futures = [
+        crypto_executor.submit(crypt_segment, view[o:o + segment_size], key, iv, i, encrypt)
+        for i, o in enumerate(offsets)
+    ]
+    return b"".join(future.result() for future in futures)
+
+def encrypt_payload(data: bytes, key: bytes = None, iv: bytes = None, segment_size: int = None) -> Dict[str, Any]:
+    """Like encrypt_data(), but large payloads are segmented and encrypted in parallel."""
+    if segment_size is None:
+        segment_size = choose_segment_size(len(data))
+    if not segment_size:
+        return dict(encrypt_data(data, key, iv), segment_size=0)
+    key = key or generate_key()
+    iv = iv or generate_iv()
+    return {
+        "encrypted_data": _crypt_segments(data, key, iv, segment_size, encrypt=True),
+        "key": key,
+        "iv": iv,
+        "segment_size": segment_size
+    }
+
+def decrypt_payload(encrypted_data: bytes, key: bytes, iv: bytes, segment_size: int = 0) -> bytes:
+    if not segment_size:
+        return decrypt_data(encrypted_data, key, iv)
+    return _crypt_segments(encrypted_data, key, iv, segment_size, encrypt=False)
+
+async def run_crypto(fn, *args, size: int = 0):
+    """Run a crypto call inline if it is small, otherwise on the crypto pool."""
+    if size < OFFLOAD_THRESHOLD:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(crypto_executor, fn, *args)
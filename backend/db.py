@@ -0,0 +1,49 @@
+"""
+Database access from the async FastAPI app without blocking the event loop.
+
+SQLAlchemy sessions are synchronous, so every query has to run off the
+event loop thread. Endpoints that only talk to the database are plain
+`def` functions, which FastAPI already runs in its worker thread pool;
+async code that needs the database in between awaits (uploads) goes
+through `run_db`, which uses the same pool. The pool size is set by
+SECUREPLUS_DB_THREADS.
+
+Endpoints that only read take `get_read_db`, whose sessions are bound to
+the read-only pool; anything that writes takes `get_db`.
+"""
+
+import os
+
+import anyio.to_thread
+from starlette.concurrency import run_in_threadpool
+
+from .models import SessionLocal, ReadSessionLocal
+
+DB_THREADS = int(os.environ.get("SECUREPLUS_DB_THREADS", 40))
+
+
+def configure_threadpool(threads: int = DB_THREADS):
+    """Size the worker pool shared by sync endpoints, sync dependencies and run_db()."""
+    anyio.to_thread.current_default_thread_limiter().total_tokens = threads
+
+
+# Database dependency
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking database function in the worker pool and await its result."""
+    return await run_in_threadpool(fn, *args, **kwargs)
@@ -0,0 +1,165 @@
+"""
+Binary delta encoding between two versions of a file.
+
+A delta is a list of COPY (offset, length into the old version) and INSERT
+(literal bytes) instructions. The common prefix and suffix are matched
+directly, and the middle is matched against a block index of the old
+version, which keeps typical document edits cheap to encode.
+
+Format: MAGIC, varint(new length), then instructions
+    0x01 varint(offset) varint(length)   copy from old
+    0x02 varint(length) bytes            insert literal
+"""
+
+MAGIC = b"SPD1"
+BLOCK_SIZE = 32
+
+_COPY = 1
+_INSERT = 2
+
+
+def _put_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+class _Encoder:
+    def __init__(self, new_length: int):
+        self.out = bytearray(MAGIC)
+        _put_varint(self.out, new_length)
+
+    def copy(self, offset: int, length: int):
+        if length:
+            self.out.append(_COPY)
+            _put_varint(self.out, offset)
+            _put_varint(self.out, length)
+
+    def insert(self, data: bytes):
+        if data:
+            self.out.append(_INSERT)
+            _put_varint(self.out, len(data))
+            self.out += data
+
+
+def _common_prefix(a, b, limit: int) -> int:
+    n = 0
+    step = 4096
+    # Compare large slices first; slice equality runs at memcmp speed
+    while step:
+        while n + step <= limit and a[n:n + step] == b[n:n + step]:
+            n += step
+        step //= 8
+    return n
+
+
+def _common_suffix(a, b, limit: int) -> int:
+    n = 0
+    step = 4096
+    while step:
+        while n + step <= limit and a[len(a) - n - step:len(a) - n] == b[len(b) - n - step:len(b) - n]:
+            n += step
+        step //= 8
+    return n
+
+
+def make_delta(old: bytes, new: bytes, block_size: int = BLOCK_SIZE) -> bytes:
+    """Encode `new` as a delta against `old`."""
+    encoder = _Encoder(len(new))
+    old_view = memoryview(old)
+    new_view = memoryview(new)
+    prefix = _common_prefix(old_view, new_view, min(len(old), len(new)))
+    suffix = _common_suffix(old_view, new_view, min(len(old), len(new)) - prefix)
+
+    old_mid_end = len(old) - suffix
+    new_mid_end = len(new) - suffix
+    encoder.copy(0, prefix)
+
+    # Index the old middle section by aligned blocks
+    index = {}
+    for offset in range(prefix, old_mid_end - block_size + 1, block_size):
+        index.setdefault(old[offset:offset + block_size], offset)
+
+    literal_start = prefix
+    i = prefix
+    while index and i + block_size <= new_mid_end:
+        offset = index.get(new[i:i + block_size])
+        if offset is None:
+            i += 1
+            continue
+        # Extend the match forwards as far as it goes
+        length = block_size + _common_prefix(
+            old_view[offset + block_size:old_mid_end],
+            new_view[i + block_size:new_mid_end],
+            min(old_mid_end - offset, new_mid_end - i) - block_size,
+        )
+        encoder.insert(new_view[literal_start:i])
+        encoder.copy(offset, length)
+        i += length
+        literal_start = i
+
+    encoder.insert(new_view[literal_start:new_mid_end])
+    encoder.copy(old_mid_end, suffix)
+    return bytes(encoder.out)
+
+
+def _instructions(delta: bytes):
+    """Yield (_COPY, offset, length) and (_INSERT, data, length) in order."""
+    pos = len(MAGIC)
+    _, pos = _get_varint(delta, pos)
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op == _COPY:
+            offset, pos = _get_varint(delta, pos)
+            length, pos = _get_varint(delta, pos)
+            yield _COPY, offset, length
+        elif op == _INSERT:
+            length, pos = _get_varint(delta, pos)
+            yield _INSERT, delta[pos:pos + length], length
+            pos += length
+        else:
+            raise ValueError(f"Unknown delta instruction {op}")
+
+
+def splice_delta(prefix: int, old_middle: bytes, new_middle: bytes, suffix_offset: int, suffix: int) -> bytes:
+    """
+    Encode a new version made of the old one's first `prefix` bytes,
+    `new_middle`, and `suffix` old bytes from `suffix_offset`, when only the
+    old bytes between them (`old_middle`) are at hand.
+    """
+    encoder = _Encoder(prefix + len(new_middle) + suffix)
+    encoder.copy(0, prefix)
+    for op, arg, length in _instructions(make_delta(old_middle, new_middle)):
+        if op == _COPY:
+            encoder.copy(prefix + arg, length)
+        else:
+            encoder.insert(arg)
+    encoder.copy(suffix_offset, suffix)
+    return bytes(encoder.out)
+
+
+def apply_delta(old: bytes, delta: bytes) -> bytes:
+    """Rebuild the new version from `old` and a delta made by make_delta()."""
+    if delta[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a delta")
+    new_length, _ = _get_varint(delta, len(MAGIC))
+    out = bytearray()
+    for op, arg, length in _instructions(delta):
+        out += old[arg:arg + length] if op == _COPY else arg
+    if len(out) != new_length:
+        raise ValueError("Delta produced the wrong length")
+    return bytes(out)
@@ -0,0 +1,96 @@
+"""
+SQLAlchemy engine factory with SQLite tuning profiles.
+
+The profile is picked with SECUREPLUS_DB_PROFILE:
+
+    production  WAL journal, synchronous=NORMAL, mmap, a larger page cache,
+                busy_timeout and in-memory temp tables; separate pools for
+                writers and read-only connections (the default)
+    legacy      rollback journal and SQLite defaults, one shared pool
+
+In WAL mode readers never block on the writer and a commit appends to the
+log instead of fsyncing the database file, which is what makes
+synchronous=NORMAL safe: a power cut can lose the last commits but cannot
+corrupt the database.
+"""
+
+import os
+from typing import Dict, NamedTuple
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+DATABASE_URL = os.environ.get("SECUREPLUS_DATABASE_URL", "sqlite:///database/secureplus.db")
+DB_PROFILE = os.environ.get("SECUREPLUS_DB_PROFILE", "production")
+
+PROFILES: Dict[str, Dict] = {
+    "production": {
+        "pragmas": {
+            # First: it only takes effect on an empty database (existing ones switch at
+            # their next full VACUUM)
+            "auto_vacuum": "INCREMENTAL",
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": int(os.environ.get("SECUREPLUS_DB_MMAP_BYTES", 256 * 1024 * 1024)),
+            "cache_size": -int(os.environ.get("SECUREPLUS_DB_CACHE_KB", 64 * 1024)),  # negative means KiB
+            "busy_timeout": int(os.environ.get("SECUREPLUS_DB_BUSY_TIMEOUT_MS", 5000)),
+            "temp_store": "MEMORY",
+        },
+        "write_pool_size": int(os.environ.get("SECUREPLUS_DB_WRITE_POOL", 4)),
+        "read_pool_size": int(os.environ.get("SECUREPLUS_DB_READ_POOL", 16)),
+        "split_reads": True,
+    },
+    "legacy": {
+        "pragmas": {},
+        "write_pool_size": 5,
+        "read_pool_size": 5,
+        "split_reads": False,
+    },
+}
+
+
+class Engines(NamedTuple):
+    write: Engine
+    read: Engine
+
+
+def _apply_pragmas(engine: Engine, pragmas: Dict, query_only: bool = False):
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        if query_only:
+            cursor.execute("PRAGMA query_only=1")
+        cursor.close()
+
+
+def make_engines(url: str = DATABASE_URL, profile: str = DB_PROFILE) -> Engines:
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown database profile {profile!r}; expected one of {', '.join(PROFILES)}")
+    settings = PROFILES[profile]
+    is_sqlite = url.startswith("sqlite")
+    connect_args = {"check_same_thread": False} if is_sqlite else {}
+
+    write = create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=settings["write_pool_size"],
+        max_overflow=0 if settings["split_reads"] else 10,
+        pool_pre_ping=not is_sqlite,
+    )
+    if is_sqlite:
+        _apply_pragmas(write, settings["pragmas"])
+    if not settings["split_reads"]:
+        return Engines(write=write, read=write)
+
+    read = create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=settings["read_pool_size"],
+        max_overflow=settings["read_pool_size"],
+        pool_pre_ping=not is_sqlite,
+    )
+    if is_sqlite:
+        _apply_pragmas(read, settings["pragmas"], query_only=True)
+    return Engines(write=write, read=read)
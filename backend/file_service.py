@@ -0,0 +1,161 @@
+"""
+Unit of work for file writes.
+
+Writing a file touches three places: the File row, its key material and its
+backup history. They are staged in one session and committed once, so a
+write costs a single journal flush and a failure part-way leaves nothing
+behind (no file row without keys, no keys without a backup).
+
+Large files are rewritten chunk-wise (see chunkstore.py): the file keeps its
+key, only the chunks an update touches are encrypted and written, and the
+backup delta is built from those chunks alone. Content is compressed
+before encryption where the compression policy allows (see compression.py),
+and the codec is stored on the file row.
+"""
+
+import datetime
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from . import blobstore, chunkstore, compression, storage, versioning
+from .crypto import encrypt_payload, generate_iv, generate_key
+from .keystore import key_store
+from .models import File
+
+
+class FileWriteService:
+    def __init__(self, db: Session):
+        self.db = db
+
+    def _commit(self, file_id: Optional[int]):
+        try:
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            # The key cache was filled while staging; don't let it outlive the rollback
+            if file_id is not None:
+                key_store.forget(file_id)
+            raise
+
+    def create(self, user_id: int, filename: str, file_type: str, blob_hash: str,
+               key: bytes, iv: bytes, segment_size: int = 0, codec: Optional[str] = None,
+               content_size: Optional[int] = None) -> File:
+        """Record a file whose ciphertext is already in the blob store (one reference held)."""
+        new_file = File(
+            filename=filename,
+            file_type=file_type,
+            blob_hash=blob_hash,
+            compression=codec,
+            content_size=content_size,
+            owner_id=user_id
+        )
+        self.db.add(new_file)
+        try:
+            # Flush for the new id; nothing is committed until everything is staged
+            self.db.flush()
+            key_store.put(self.db, new_file, user_id, key, iv, segment_size)
+            # The first version is a snapshot sharing the file's blob
+            versioning.record_version(self.db, new_file, user_id, key, iv, segment_size=segment_size,
+                                      compression=codec)
+        except BaseException:
+            self.db.rollback()
+            raise
+        self._commit(new_file.id)
+        return new_file
+
+    def create_from_bytes(self, user_id: int, filename: str, file_type: str, content: bytes) -> File:
+        if len(content) >= chunkstore.CHUNKED_THRESHOLD:
+            # Chunks carry their own codecs; a single compressed stream could not be range-read
+            key, iv = generate_key(), generate_iv()
+            blob_hash, _ = chunkstore.write(self.db, key, content, file_type=file_type)
+            return self.create(user_id, filename, file_type, blob_hash, key, iv, content_size=len(content))
+        payload, codec = compression.pack(content, file_type)
+        encryption_result = encrypt_payload(payload)
+        blob_hash = blobstore.put_bytes(self.db, encryption_result["encrypted_data"])
+        return self.create(user_id, filename, file_type, blob_hash, encryption_result["key"],
+                           encryption_result["iv"], encryption_result["segment_size"], codec, len(content))
+
+    def replace_content(self, file: File, user_id: int, content: bytes) -> File:
+        # Current keys, if still held, give us the previous version for the backup delta
+        material = key_store.get(self.db, file, user_id)
+        previous_manifest = chunkstore.load(file.blob_hash) if material else None
+        if previous_manifest is not None or len(content) >= chunkstore.CHUNKED_THRESHOLD:
+            return self._replace_chunked(file, user_id, content, material, previous_manifest)
+        previous_content = None
+        if material:
+            previous_content = storage.read_decrypted(
+                file.blob_hash, file.content, material.key, material.iv, material.segment_size, file.compression
+            )
+
+        payload, codec = compression.pack(content, file.file_type)
+        encryption_result = encrypt_payload(payload)
+        try:
+            if material:
+                versioning.adopt_legacy_backups(
+                    self.db, file, user_id, material.key, material.iv, material.segment_size
+                )
+            blob_hash = blobstore.put_bytes(self.db, encryption_result["encrypted_data"])
+            blobstore.release(self.db, file.blob_hash)
+            file.blob_hash = blob_hash
+            file.content = None
+            file.compression = codec
+            file.content_size = len(content)
+            file.updated_at = datetime.datetime.utcnow()
+
+            key_store.put(self.db, file, user_id, encryption_result["key"], encryption_result["iv"],
+                          encryption_result["segment_size"])
+            versioning.record_version(
+                self.db, file, user_id, encryption_result["key"], encryption_result["iv"],
+                content=content, previous_content=previous_content,
+                segment_size=encryption_result["segment_size"], compression=codec
+            )
+        except BaseException:
+            self.db.rollback()
+            key_store.forget(file.id)
+            raise
+        self._commit(file.id)
+        return file
+
+    def _replace_chunked(self, file: File, user_id: int, content: bytes, material,
+                         previous_manifest: Optional[chunkstore.Manifest]) -> File:
+        previous_content = None
+        if previous_manifest is not None:
+            # Unchanged chunks are shared with the previous manifest, so the key stays
+            key, iv = material.key, material.iv
+        else:
+            key, iv = generate_key(), generate_iv()
+            if material:
+                previous_content = storage.read_decrypted(
+                    file.blob_hash, file.content, material.key, material.iv, material.segment_size,
+                    file.compression
+                )
+        try:
+            if material:
+                versioning.adopt_legacy_backups(
+                    self.db, file, user_id, material.key, material.iv, material.segment_size
+                )
+            blob_hash, splice = chunkstore.write(self.db, key, content, previous_manifest,
+                                                 file_type=file.file_type)
+            blobstore.release(self.db, file.blob_hash)
+            file.blob_hash = blob_hash
+            file.content = None
+            # The manifest records a codec per chunk
+            file.compression = None
+            file.content_size = len(content)
+            file.updated_at = datetime.datetime.utcnow()
+
+            key_store.put(self.db, file, user_id, key, iv, 0)
+            delta = None
+            if splice is not None:
+                delta = chunkstore.splice_changes(previous_manifest, key, splice, content)
+            versioning.record_version(
+                self.db, file, user_id, key, iv,
+                content=content, previous_content=previous_content, delta=delta
+            )
+        except BaseException:
+            self.db.rollback()
+            key_store.forget(file.id)
+            raise
+        self._commit(file.id)
+        return file
@@ -0,0 +1,250 @@
+"""
+Game-state store for chess sessions.
+
+Live games used to be a dict inside one server process, so a second worker
+could not see them. The store keeps one compact record per game (the game
+dict, JSON-encoded without whitespace) plus a version number, behind one
+interface with two backends, picked with SECUREPLUS_GAME_STORE:
+
+    memory  a dict guarded by a lock; single process only (the default)
+    sqlite  a table in a separate SQLite file (SECUREPLUS_GAME_STORE_URL) in
+            WAL mode, shared by every worker process on the machine
+
+Writes are optimistic: `save` only succeeds if the record still has the
+version it was loaded at, otherwise it raises VersionConflict. `update`
+wraps load, change and save in a retry loop, so two workers playing a move
+in the same game at once end up applying them one after the other, each
+against the position the other left.
+
+Games not written for SECUREPLUS_GAME_IDLE_TTL seconds are evicted; callers
+invoke `maybe_evict` on their own requests and it runs at most once every
+SECUREPLUS_GAME_EVICT_INTERVAL seconds.
+"""
+
+import abc
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import text
+
+from .engine import make_engines
+
+GAME_STORE = os.environ.get("SECUREPLUS_GAME_STORE", "memory")
+GAME_STORE_URL = os.environ.get("SECUREPLUS_GAME_STORE_URL", "sqlite:///database/games.db")
+GAME_IDLE_TTL = float(os.environ.get("SECUREPLUS_GAME_IDLE_TTL", 6 * 3600))
+GAME_EVICT_INTERVAL = float(os.environ.get("SECUREPLUS_GAME_EVICT_INTERVAL", 300))
+UPDATE_RETRIES = 16
+
+Game = Dict[str, Any]
+
+
+class GameNotFound(KeyError):
+    pass
+
+
+class VersionConflict(Exception):
+    """The game was saved by someone else since it was loaded."""
+
+
+def pack(game: Game) -> str:
+    return json.dumps(game, separators=(",", ":"))
+
+
+def unpack(record: str) -> Game:
+    return json.loads(record)
+
+
+class GameStore(abc.ABC):
+    def __init__(self, idle_ttl: float = GAME_IDLE_TTL, evict_interval: float = GAME_EVICT_INTERVAL):
+        self.idle_ttl = idle_ttl
+        self.evict_interval = evict_interval
+        self._next_eviction = time.monotonic() + evict_interval
+        self.conflicts = 0
+
+    @abc.abstractmethod
+    def create(self, game_id: str, game: Game) -> int:
+        """Store a new game at version 1."""
+
+    @abc.abstractmethod
+    def load(self, game_id: str) -> Optional[Tuple[Game, int]]:
+        """The game and its version, or None. The dict is a private copy."""
+
+    @abc.abstractmethod
+    def save(self, game_id: str, game: Game, version: int) -> int:
+        """Replace the game if it is still at `version`; returns the new version."""
+
+    @abc.abstractmethod
+    def delete(self, game_id: str):
+        """Remove the game; a missing game is not an error."""
+
+    @abc.abstractmethod
+    def evict_idle(self, idle_ttl: Optional[float] = None) -> int:
+        """Drop games not written for `idle_ttl` seconds; returns how many."""
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        """How many games are stored."""
+
+    def __contains__(self, game_id: str) -> bool:
+        return self.load(game_id) is not None
+
+    def update(self, game_id: str, change: Callable[[Game, int], Any],
+               retries: int = UPDATE_RETRIES) -> Tuple[Game, int, Any]:
+        """
+        Load, `change(game, version)` in place, save; reloads and calls `change`
+        again on a version conflict. Returns (game, new version, change's result).
+        An exception from `change` aborts without saving.
+        """
+        for _ in range(retries):
+            loaded = self.load(game_id)
+            if loaded is None:
+                raise GameNotFound(game_id)
+            game, version = loaded
+            result = change(game, version)
+            try:
+                return game, self.save(game_id, game, version), result
+            except VersionConflict:
+                self.conflicts += 1
+        raise VersionConflict(f"Game {game_id} kept changing; gave up after {retries} attempts")
+
+    def maybe_evict(self) -> int:
+        now = time.monotonic()
+        if self.evict_interval <= 0 or now < self._next_eviction:
+            return 0
+        self._next_eviction = now + self.evict_interval
+        return self.evict_idle()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__, "games": len(self), "conflicts": self.conflicts}
+
+
+class MemoryGameStore(GameStore):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # game_id -> (packed record, version, last write)
+        self._games: Dict[str, Tuple[str, int, float]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, game_id, game):
+        with self._lock:
+            self._games[game_id] = (pack(game), 1, time.time())
+        return 1
+
+    def load(self, game_id):
+        entry = self._games.get(game_id)
+        if entry is None:
+            return None
+        return unpack(entry[0]), entry[1]
+
+    def save(self, game_id, game, version):
+        record = pack(game)
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is None:
+                raise GameNotFound(game_id)
+            if entry[1] != version:
+                raise VersionConflict(game_id)
+            self._games[game_id] = (record, version + 1, time.time())
+        return version + 1
+
+    def delete(self, game_id):
+        with self._lock:
+            self._games.pop(game_id, None)
+
+    def evict_idle(self, idle_ttl=None):
+        cutoff = time.time() - (self.idle_ttl if idle_ttl is None else idle_ttl)
+        with self._lock:
+            idle = [game_id for game_id, (_, _, written) in self._games.items() if written < cutoff]
+            for game_id in idle:
+                del self._games[game_id]
+        return len(idle)
+
+    def __len__(self):
+        return len(self._games)
+
+
+class SQLiteGameStore(GameStore):
+    """
+    Games in their own SQLite file, so that chess traffic never queues on the
+    main database's write lock. The version check is part of the UPDATE, so
+    it holds across processes without any locking of our own.
+    """
+
+    def __init__(self, url: str = GAME_STORE_URL, **kwargs):
+        super().__init__(**kwargs)
+        self.engine = make_engines(url, "production").write
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS chess_games ("
+                " game_id TEXT PRIMARY KEY,"
+                " record TEXT NOT NULL,"
+                " version INTEGER NOT NULL,"
+                " written_at REAL NOT NULL"
+                ") WITHOUT ROWID"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_chess_games_written_at ON chess_games (written_at)"
+            ))
+
+    def create(self, game_id, game):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("INSERT OR REPLACE INTO chess_games (game_id, record, version, written_at) "
+                     "VALUES (:game_id, :record, 1, :now)"),
+                {"game_id": game_id, "record": pack(game), "now": time.time()},
+            )
+        return 1
+
+    def load(self, game_id):
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                text("SELECT record, version FROM chess_games WHERE game_id = :game_id"),
+                {"game_id": game_id},
+            ).first()
+        if row is None:
+            return None
+        return unpack(row.record), row.version
+
+    def save(self, game_id, game, version):
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                text("UPDATE chess_games SET record = :record, version = version + 1, written_at = :now "
+                     "WHERE game_id = :game_id AND version = :version"),
+                {"game_id": game_id, "record": pack(game), "now": time.time(), "version": version},
+            )
+            if result.rowcount == 1:
+                return version + 1
+            exists = conn.execute(
+                text("SELECT 1 FROM chess_games WHERE game_id = :game_id"), {"game_id": game_id}
+            ).first()
+        raise VersionConflict(game_id) if exists else GameNotFound(game_id)
+
+    def delete(self, game_id):
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM chess_games WHERE game_id = :game_id"), {"game_id": game_id})
+
+    def evict_idle(self, idle_ttl=None):
+        cutoff = time.time() - (self.idle_ttl if idle_ttl is None else idle_ttl)
+        with self.engine.begin() as conn:
+            return conn.execute(
+                text("DELETE FROM chess_games WHERE written_at < :cutoff"), {"cutoff": cutoff}
+            ).rowcount
+
+    def __len__(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT count(*) FROM chess_games")).scalar()
+
+
+BACKENDS = {
+    "memory": MemoryGameStore,
+    "sqlite": SQLiteGameStore,
+}
+
+
+def make_game_store(backend: str = GAME_STORE, **kwargs) -> GameStore:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown game store {backend!r}; expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[backend](**kwargs)
@@ -0,0 +1,135 @@
+"""
+Per-file key material.
+
+Keys live in the `file_keys` table as fixed-width binary columns, with a
+bounded LRU/TTL cache in front so hot files resolve their key without a
+database round trip or any JSON/base64 decoding.
+
+Re-keying a file (an update, op-log compaction, a restore) bumps the key's
+epoch, and the file row carries it too (File.key_epoch). Callers look keys
+up with the file row they already loaded, and the cache is keyed by that
+epoch, so a re-key committed by another worker is seen on the next read
+rather than after the TTL. Nothing in AES-CFB would catch a stale key; it
+would only decrypt to garbage.
+
+Each key is stamped with its owner's `key_epoch`. Logging out bumps the
+epoch, which makes every older key unreadable at once; the rows themselves
+are deleted later by the reaper in backend/maintenance.py.
+"""
+
+import base64
+import json
+import os
+from typing import NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from .cache import LRUCache
+from .models import File, FileKey, TempStorage, User
+
+KEY_CACHE_SIZE = int(os.environ.get("SECUREPLUS_KEY_CACHE_SIZE", 4096))
+KEY_CACHE_TTL = float(os.environ.get("SECUREPLUS_KEY_CACHE_TTL", 300))
+
+
+class KeyMaterial(NamedTuple):
+    user_id: int
+    key: bytes
+    iv: bytes
+    epoch: int
+    segment_size: int = 0
+    user_epoch: int = 0
+
+
+class KeyStore:
+    def __init__(self, cache: LRUCache):
+        self.cache = cache
+
+    def get(self, db: Session, file: File, user_id: int, key_epoch: Optional[int] = None) -> Optional[KeyMaterial]:
+        """Key material for a file owned by user_id, unless it predates the user's key epoch."""
+        material = self.cache.get(_cache_key(file))
+        if material is None:
+            row = db.query(FileKey).filter(FileKey.file_id == file.id).first()
+            if row is None:
+                return None
+            material = KeyMaterial(row.user_id, row.key, row.iv, row.epoch, row.segment_size or 0, row.user_epoch or 0)
+            # A file row read before a re-key disagrees with the key row; serve it, don't cache it
+            if material.epoch == (file.key_epoch or 0):
+                self.cache.put(_cache_key(file), material)
+        if material.user_id != user_id:
+            return None
+        if key_epoch is None:
+            key_epoch = user_key_epoch(db, user_id)
+        if material.user_epoch < key_epoch:
+            return None
+        return material
+
+    def put(self, db: Session, file: File, user_id: int, key: bytes, iv: bytes,
+            segment_size: int = 0, key_epoch: Optional[int] = None) -> KeyMaterial:
+        """Store new key material for a file, bumping its epoch if it already had one.
+
+        The caller commits; on rollback it must `forget()` the file.
+        """
+        if key_epoch is None:
+            key_epoch = user_key_epoch(db, user_id)
+        row = db.query(FileKey).filter(FileKey.file_id == file.id).first()
+        if row is None:
+            row = FileKey(file_id=file.id, user_id=user_id, key=key, iv=iv, epoch=0, segment_size=segment_size,
+                          user_epoch=key_epoch)
+            db.add(row)
+        else:
+            row.user_id = user_id
+            row.key = key
+            row.iv = iv
+            row.epoch += 1
+            row.segment_size = segment_size
+            row.user_epoch = key_epoch
+        file.key_epoch = row.epoch
+        material = KeyMaterial(user_id, key, iv, row.epoch, segment_size, key_epoch)
+        self.cache.put(_cache_key(file), material)
+        return material
+
+    def delete(self, db: Session, file_id: int):
+        db.query(FileKey).filter(FileKey.file_id == file_id).delete(synchronize_session=False)
+        self.forget(file_id)
+
+    def forget(self, file_id: int):
+        """Drop every cached key of a file, e.g. after rolling back a put()."""
+        self.cache.discard_where(lambda cache_key, material: cache_key[0] == file_id)
+
+    def evict_user(self, user_id: int):
+        """Drop a user's keys from the cache; their rows are already dead by epoch."""
+        self.cache.discard_where(lambda cache_key, material: material.user_id == user_id)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def _cache_key(file: File):
+    # Ids are reused once the newest file is deleted; created_at tells the two apart
+    return file.id, file.key_epoch or 0, file.created_at
+
+
+key_store = KeyStore(LRUCache(maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL))
+
+
+def user_key_epoch(db: Session, user_id: int) -> int:
+    return db.query(User.key_epoch).filter(User.id == user_id).scalar() or 0
+
+
+def migrate_temp_storage_keys(db: Session) -> int:
+    """Move file keys stored as JSON in TempStorage into the key table (flushed, not committed)."""
+    rows = db.query(TempStorage).filter(TempStorage.file_id.isnot(None)).all()
+    for row in rows:
+        keys_data = json.loads(row.temp_content.decode())
+        if db.query(FileKey).filter(FileKey.file_id == row.file_id).first() is None:
+            db.add(FileKey(
+                file_id=row.file_id,
+                user_id=row.user_id,
+                key=base64.b64decode(keys_data["key"]),
+                iv=base64.b64decode(keys_data["iv"]),
+                epoch=0,
+                segment_size=0
+            ))
+        db.delete(row)
+    db.flush()
+    return len(rows)
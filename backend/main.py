@@ -1,32 +1,54 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Form, File as FastAPIFile, UploadFile, WebSocket, WebSocketDisconnect  # File for uploads
+from fastapi import FastAPI, Depends, HTTPException, status, Form, File as FastAPIFile, UploadFile, WebSocket, WebSocketDisconnect, Header, Query, Request  # File for uploads
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import Dict, Optional, List, Any
+from contextlib import asynccontextmanager
 import jwt
 import datetime
 import os
 import base64
 import uuid
 import shutil
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+import mimetypes
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
-from sqlalchemy.orm import Session
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import Session, undefer
 import pyotp
 import json
 from .models import (
-    SessionLocal, engine, Base,
+    SessionLocal, ReadSessionLocal, engine, Base,
     User, File as DBFile, Email, ChatMessage,  # File is the SQLAlchemy model
-    TempStorage, BackupStorage, UserSession, ChessMove
+    TempStorage, BackupStorage, UserSession, ChessMove, DocumentOp, FILE_NAME_SORT_KEY
 )
-
-# Ensure database tables exist
-Base.metadata.create_all(bind=engine)
-
-app = FastAPI(title="SecurePlus API", description="Secure Google Drive Alternative with RAM-based operations")
+from .crypto import generate_key, generate_iv, encrypt_data, decrypt_data, choose_segment_size, run_crypto
+from . import storage, blobstore, chunkstore, versioning, compression, uploads
+from .keystore import key_store
+from .principals import Principal, principal_cache
+from .chess_auth import canonicalize, sequence_digest
+from .db import get_db, get_read_db, run_db, configure_threadpool
+from .file_service import FileWriteService
+from .migrations import run_migrations
+from . import maintenance
+from .collab import collab_rooms
+from .oplog import document_log, InvalidOperation, SequenceConflict
+
+# Ensure database tables exist and existing ones are up to date
+run_migrations(engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Blocking database work runs in the worker thread pool, never on the event loop
+    configure_threadpool()
+    # Reaper for rows killed by epoch bumps, TTL sweeper for expired sessions / temp storage
+    tasks = maintenance.start_background_tasks()
+    yield
+    for task in tasks:
+        task.cancel()
+
+app = FastAPI(title="SecurePlus API", description="Secure Google Drive Alternative with RAM-based operations", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -41,7 +63,7 @@ app.add_middleware(
 SECRET_KEY = os.environ.get("SECRET_KEY", "your_secret_key_here")
 ALGORITHM = "HS256"
 
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 
 @app.get("/")
 def read_index():
@@ -113,14 +135,6 @@ class ChessMoveResponse(ChessMoveBase):
     class Config:
         orm_mode = True
 
-# Database dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 # Helper functions for password hashing (replace with a proper hashing lib in production)
 def verify_password(plain_password, hashed_password):
     # In a real app, use passlib or bcrypt
@@ -154,12 +168,16 @@ def create_access_token(data: dict, expires_delta: Optional[datetime.timedelta]
     return encoded_jwt
 
 # User dependency
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # A token seen recently resolves without decoding or touching the users table
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -168,45 +186,23 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         token_data = TokenData(username=username)
     except jwt.PyJWTError:
         raise credentials_exception
+    # Read before the user row, so a logout committed in between outdates what we cache
+    generation = principal_cache.generation(token_data.username)
     user = get_user(db, username=token_data.username)
     if user is None:
         raise credentials_exception
-    return user
+    # Tokens issued before the last logout carry an older session epoch
+    if payload.get("sep", 0) != (user.session_epoch or 0):
+        raise credentials_exception
+    principal = Principal.from_user(user)
+    principal_cache.put(token, principal, payload.get("exp"), generation)
+    return principal
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
-# Encryption functions
-def generate_key():
-    return os.urandom(32)  # 256 bits
-
-def generate_iv():
-    return os.urandom(16)  # 128 bits
-
-def encrypt_data(data: bytes, key: bytes = None, iv: bytes = None) -> Dict[str, bytes]:
-    if key is None:
-        key = generate_key()
-    if iv is None:
-        iv = generate_iv()
-    
-    cipher = Cipher(algorithms.AES(key), modes.CFB(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
-    encrypted_data = encryptor.update(data) + encryptor.finalize()
-    
-    return {
-        "encrypted_data": encrypted_data,
-        "key": key,
-        "iv": iv
-    }
-
-def decrypt_data(encrypted_data: bytes, key: bytes, iv: bytes) -> bytes:
-    cipher = Cipher(algorithms.AES(key), modes.CFB(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
-    decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
-    return decrypted_data
-
 # Endpoints
 
 @app.get("/")
@@ -215,7 +211,7 @@ async def read_root():
 
 # User registration and authentication
 @app.post("/register", response_model=UserResponse)
-async def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
+def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
     db_user = get_user(db, username=user_data.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
@@ -232,7 +228,7 @@ async def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
     return new_user
 
 @app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
@@ -247,7 +243,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     
     access_token_expires = datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": user.username, "sep": user.session_epoch or 0}, expires_delta=access_token_expires
     )
     
     # Create a new session
@@ -255,7 +251,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     new_session = UserSession(
         user_id=user.id,
         session_id=session_id,
-        expires_at=datetime.datetime.utcnow() + access_token_expires
+        expires_at=datetime.datetime.utcnow() + access_token_expires,
+        epoch=user.session_epoch or 0
     )
     db.add(new_session)
     db.commit()
@@ -268,261 +265,512 @@ async def read_users_me(current_user: User = Depends(get_current_active_user)):
 
 # Chess-based authentication
 @app.post("/chess/register-sequence", response_model=ChessMoveResponse)
-async def register_chess_sequence(
+def register_chess_sequence(
     move_data: ChessMoveBase,
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
+    # Only the keyed digest of the canonical sequence is stored
+    digest = sequence_digest(move_data.move_sequence)
+    
     # Check if user already has a move sequence
-    existing_move = db.query(ChessMove).filter(ChessMove.user_id == current_user.id).first()
-    if existing_move:
-        existing_move.move_sequence = move_data.move_sequence
-        db.commit()
-        db.refresh(existing_move)
-        return existing_move
-    
-    # Create new move sequence
-    new_move = ChessMove(
-        move_sequence=move_data.move_sequence,
-        user_id=current_user.id
-    )
-    db.add(new_move)
+    chess_move = db.query(ChessMove).filter(ChessMove.user_id == current_user.id).first()
+    if chess_move:
+        chess_move.sequence_digest = digest
+        chess_move.move_sequence = None
+    else:
+        # Create new move sequence
+        chess_move = ChessMove(
+            sequence_digest=digest,
+            user_id=current_user.id
+        )
+        db.add(chess_move)
     db.commit()
-    db.refresh(new_move)
-    return new_move
+    return {"id": chess_move.id, "move_sequence": canonicalize(move_data.move_sequence)}
 
 @app.post("/chess/verify-sequence")
-async def verify_chess_sequence(move_data: ChessMoveBase, db: Session = Depends(get_db)):
-    # Find a user with this chess sequence
-    chess_move = db.query(ChessMove).filter(ChessMove.move_sequence == move_data.move_sequence).first()
-    if not chess_move:
+def verify_chess_sequence(move_data: ChessMoveBase, db: Session = Depends(get_read_db)):
+    # Find a user with this chess sequence: one point lookup on the digest index
+    row = db.query(User.username).join(ChessMove, ChessMove.user_id == User.id).filter(
+        ChessMove.sequence_digest == sequence_digest(move_data.move_sequence)
+    ).first()
+    if not row:
         raise HTTPException(status_code=400, detail="Invalid chess sequence")
     
     # Return username for login form
-    user = db.query(User).filter(User.id == chess_move.user_id).first()
-    return {"username": user.username}
+    return {"username": row.username}
 
 # File management endpoints
+def save_upload(db: Session, user_id: int, filename: str, file_type: str, writer, key: bytes, iv: bytes,
+                segment_size: int, codec: Optional[str] = None) -> DBFile:
+    blob_hash = writer.commit(db)
+    return FileWriteService(db).create(user_id, filename, file_type, blob_hash, key, iv, segment_size,
+                                       codec, writer.content_size)
+
 @app.post("/files/upload", response_model=FileResponse)
 async def upload_file(
     file: UploadFile = FastAPIFile(...),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    # Read file content
-    file_content = await file.read()
-    
     # Get file extension
     filename = file.filename
     file_type = filename.split('.')[-1] if '.' in filename else ''
     
-    # Encrypt the file content
-    encryption_result = encrypt_data(file_content)
-    
-    # Create a new file record
-    new_file = File(
-        filename=filename,
-        file_type=file_type,
-        content=encryption_result["encrypted_data"],
-        owner_id=current_user.id
-    )
-    db.add(new_file)
-    db.commit()
-    db.refresh(new_file)
-    
-    # Store encryption keys securely (in a real system, this would be more secure)
-    # In RAM-only mode, we store this in a temporary session
-    session_id = str(uuid.uuid4())
-    temp_storage = TempStorage(
-        user_id=current_user.id,
-        file_id=new_file.id,
-        temp_content=json.dumps({
-            "key": base64.b64encode(encryption_result["key"]).decode(),
-            "iv": base64.b64encode(encryption_result["iv"]).decode()
-        }).encode(),
-        session_id=session_id
-    )
-    db.add(temp_storage)
-    db.commit()
-    
-    # Create a backup
-    backup = BackupStorage(
-        user_id=current_user.id,
-        file_id=new_file.id,
-        backup_content=encryption_result["encrypted_data"]
-    )
-    db.add(backup)
-    db.commit()
-    
-    return new_file
+    # Encrypt the upload chunk by chunk straight to disk
+    key = generate_key()
+    iv = generate_iv()
+    # Compressible content is compressed on the way in; the type and a sample of it decide
+    head = await file.read(compression.SAMPLE_BYTES)
+    await file.seek(0)
+    size = getattr(file, "size", None)
+    codec = compression.choose_codec(file_type, head, size)
+    if codec and (size is None or size >= chunkstore.CHUNKED_THRESHOLD):
+        # Large ones become a chunk manifest, compressed and encrypted chunk by chunk in
+        # parallel, so range reads and later edits touch only the chunks they cover
+        writer = await storage.encrypt_upload_chunked(file, key, file_type)
+        codec, segment_size = None, 0
+    else:
+        # Otherwise large uploads are split into segments encrypted in parallel
+        segment_size = 0 if codec else choose_segment_size(size)
+        writer = await storage.encrypt_upload(file, key, iv, segment_size, compression=codec)
+    try:
+        return await run_db(save_upload, db, current_user.id, filename, file_type, writer, key, iv, segment_size,
+                            codec)
+    except BaseException:
+        writer.discard()
+        raise
+
+# Sortable listing columns; the cursor carries the last row's value for the column plus its id
+LIST_SORT_COLUMNS = {
+    "updated_at": DBFile.updated_at,
+    "created_at": DBFile.created_at,
+    "filename": FILE_NAME_SORT_KEY,
+}
+
+def encode_cursor(file, sort: str) -> str:
+    value = getattr(file, sort) or ""
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return f"{value},{file.id}"
+
+def decode_cursor(cursor: str, sort: str):
+    value, _, last_id = cursor.rpartition(",")
+    try:
+        last_id = int(last_id)
+        if sort != "filename":
+            value = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, last_id
 
 @app.get("/files", response_model=List[FileResponse])
-async def list_files(
-    db: Session = Depends(get_db),
+def list_files(
+    response: Response,
+    after: Optional[str] = Query(None, description="Cursor from the previous page's X-Next-Cursor header"),
+    limit: int = Query(100, ge=1, le=1000),
+    sort: str = Query("updated_at", regex="^(updated_at|created_at|filename)$"),
+    order: str = Query("desc", regex="^(asc|desc)$"),
+    file_type: Optional[str] = None,
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    files = db.query(File).filter(File.owner_id == current_user.id).all()
+    # File.content is deferred, so this reads metadata only
+    column = LIST_SORT_COLUMNS[sort]
+    query = db.query(DBFile).filter(DBFile.owner_id == current_user.id)
+    if file_type:
+        query = query.filter(DBFile.file_type == file_type)
+    if after:
+        value, last_id = decode_cursor(after, sort)
+        # The bound on the column alone is what lets SQLite seek to the cursor in the index
+        # (it will not range-scan a row value over the filename expression)
+        if order == "desc":
+            query = query.filter(column <= value, tuple_(column, DBFile.id) < tuple_(value, last_id))
+        else:
+            query = query.filter(column >= value, tuple_(column, DBFile.id) > tuple_(value, last_id))
+    if order == "desc":
+        query = query.order_by(column.desc(), DBFile.id.desc())
+    else:
+        query = query.order_by(column.asc(), DBFile.id.asc())
+    
+    # One extra row tells us whether there is a next page
+    files = query.limit(limit + 1).all()
+    if len(files) > limit:
+        files = files[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(files[-1], sort)
     return files
 
+def load_file_keys(db: Session, file: DBFile, user: Principal):
+    material = key_store.get(db, file, user.id, user.key_epoch)
+    if not material:
+        raise HTTPException(status_code=404, detail="File keys not found in temporary storage")
+    return material
+
+def parse_range(range_header: Optional[str], size: int):
+    """Parse a single `bytes=` range into (start, end) inclusive, or None for the whole file."""
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec:
+        # Multiple ranges are optional to support; serve the full body instead
+        return None
+    first, _, last = spec.partition("-")
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                raise ValueError
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, min(end, size - 1)
+
 @app.get("/files/{file_id}")
-async def get_file(
+def get_file(
     file_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_active_user)
 ):
     # Get the file
-    file = db.query(File).filter(File.id == file_id, File.owner_id == current_user.id).first()
+    file = db.query(DBFile).options(undefer(DBFile.content)).filter(DBFile.id == file_id, DBFile.owner_id == current_user.id).first()
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Get the encryption keys from temp storage
-    temp_storage = db.query(TempStorage).filter(
-        TempStorage.file_id == file_id,
-        TempStorage.user_id == current_user.id
-    ).first()
-    
-    if not temp_storage:
-        raise HTTPException(status_code=404, detail="File keys not found in temporary storage")
-    
-    # Decrypt the keys
-    keys_data = json.loads(temp_storage.temp_content.decode())
-    key = base64.b64decode(keys_data["key"])
-    iv = base64.b64decode(keys_data["iv"])
-    
-    # Decrypt the file
-    decrypted_content = decrypt_data(file.content, key, iv)
+    # Get the encryption keys from the key store
+    keys = load_file_keys(db, file, current_user)
     
-    # Update last accessed
-    temp_storage.last_accessed = datetime.datetime.utcnow()
-    db.commit()
+    # Pushed operations not yet compacted into the blob are replayed on top of it
+    document = document_log.content(db, file)
+    if document is not None:
+        decrypted_content, seq = document.text.encode("utf-8"), document.seq
+    else:
+        decrypted_content = storage.read_decrypted(file.blob_hash, file.content, keys.key, keys.iv, keys.segment_size,
+                                                   file.compression)
+        seq = file.op_seq or 0
     
     return {
         "filename": file.filename,
         "content": base64.b64encode(decrypted_content).decode(),
-        "file_type": file.file_type
+        "file_type": file.file_type,
+        "seq": seq
     }
 
-@app.put("/files/{file_id}", response_model=FileResponse)
-async def update_file(
+@app.get("/files/{file_id}/download")
+def download_file(
     file_id: int,
-    file_content: bytes = FastAPIFile(...),
-    db: Session = Depends(get_db),
+    range_header: Optional[str] = Header(None, alias="Range"),
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_active_user)
 ):
     # Get the file
-    file = db.query(File).filter(File.id == file_id, File.owner_id == current_user.id).first()
+    file = db.query(DBFile).options(undefer(DBFile.content)).filter(DBFile.id == file_id, DBFile.owner_id == current_user.id).first()
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Encrypt the new content
-    encryption_result = encrypt_data(file_content)
+    keys = load_file_keys(db, file, current_user)
     
-    # Update the file
-    file.content = encryption_result["encrypted_data"]
-    file.updated_at = datetime.datetime.utcnow()
-    db.commit()
-    db.refresh(file)
-    
-    # Update temp storage with new keys
-    temp_storage = db.query(TempStorage).filter(
-        TempStorage.file_id == file_id,
-        TempStorage.user_id == current_user.id
-    ).first()
-    
-    if temp_storage:
-        temp_storage.temp_content = json.dumps({
-            "key": base64.b64encode(encryption_result["key"]).decode(),
-            "iv": base64.b64encode(encryption_result["iv"]).decode()
-        }).encode()
-        temp_storage.last_accessed = datetime.datetime.utcnow()
-        db.commit()
-    else:
-        # Create new temp storage if not exists
-        session_id = str(uuid.uuid4())
-        new_temp = TempStorage(
-            user_id=current_user.id,
-            file_id=file.id,
-            temp_content=json.dumps({
-                "key": base64.b64encode(encryption_result["key"]).decode(),
-                "iv": base64.b64encode(encryption_result["iv"]).decode()
-            }).encode(),
-            session_id=session_id
-        )
-        db.add(new_temp)
-        db.commit()
+    size = file.content_size if file.content_size is not None else storage.ciphertext_size(file.blob_hash, file.content)
+    byte_range = parse_range(range_header, size)
+    start, end = byte_range if byte_range else (0, size - 1)
+    length = end - start + 1 if size else 0
     
-    # Update backup
-    backup = db.query(BackupStorage).filter(
-        BackupStorage.file_id == file_id,
-        BackupStorage.user_id == current_user.id
-    ).first()
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(length),
+        "Content-Disposition": f'attachment; filename="{file.filename}"',
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    media_type = mimetypes.guess_type(file.filename or "")[0] or "application/octet-stream"
+    
+    source = storage.open_ciphertext(file.blob_hash, file.content)
+    
+    def stream():
+        with source:
+            yield from storage.iter_decrypted_range(source, keys.key, keys.iv, start, length, keys.segment_size,
+                                                    compression=file.compression)
+    
+    return StreamingResponse(
+        stream(),
+        status_code=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+        headers=headers,
+        media_type=media_type,
+    )
+
+@app.put("/files/{file_id}", response_model=FileResponse)
+def update_file(
+    file_id: int,
+    file_content: bytes = FastAPIFile(...),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    # Get the file
+    file = db.query(DBFile).filter(DBFile.id == file_id, DBFile.owner_id == current_user.id).first()
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
     
-    if backup:
-        backup.backup_content = encryption_result["encrypted_data"]
-        backup.backup_at = datetime.datetime.utcnow()
-        db.commit()
-    else:
-        new_backup = BackupStorage(
-            user_id=current_user.id,
-            file_id=file.id,
-            backup_content=encryption_result["encrypted_data"]
-        )
-        db.add(new_backup)
-        db.commit()
+    # Supersedes any pushed operations
+    return document_log.replace(db, file, file_content)
+
+# Operation-based editing, see backend/oplog.py
+class OperationPush(BaseModel):
+    base: int  # sequence number the operations were made against
+    ops: List[Dict[str, Any]]
+
+def push_ops(db: Session, file_id: int, user_id: int, push: OperationPush) -> int:
+    file = db.query(DBFile).filter(DBFile.id == file_id, DBFile.owner_id == user_id).first()
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        return document_log.push(db, file, user_id, push.base, push.ops)
+    except SequenceConflict as exc:
+        raise HTTPException(status_code=409, detail={"message": "Document has moved on; rebase and retry", "seq": exc.seq})
+    except InvalidOperation as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except LookupError:
+        raise HTTPException(status_code=404, detail="File keys not found in temporary storage")
+
+@app.post("/files/{file_id}/ops")
+async def push_document_ops(
+    file_id: int,
+    push: OperationPush,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    seq = await run_db(push_ops, db, file_id, current_user.id, push)
+    # Everyone editing the file sees the accepted operations
+    collab_rooms.broadcast(file_id, json.dumps({"type": "ops", "seq": seq, "user_id": current_user.id, "ops": push.ops}))
+    return {"seq": seq}
+
+@app.get("/files/{file_id}/ops")
+def get_document_ops(
+    file_id: int,
+    since: int = Query(..., ge=0),
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    file = db.query(DBFile).filter(DBFile.id == file_id, DBFile.owner_id == current_user.id).first()
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    pushes = document_log.since(db, file, since)
+    if pushes is None:
+        # Already compacted; the client reloads the document
+        raise HTTPException(status_code=410, detail={"message": "Operations compacted; reload the file", "seq": file.op_seq})
+    return pushes
+
+# Resumable uploads, see backend/uploads.py
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int
+    chunk_size: Optional[int] = None
+
+def load_upload(db: Session, upload_id: str, user: User):
+    session = uploads.get_session(db, upload_id, user)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+@app.post("/uploads")
+def create_upload(
+    request: UploadSessionCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    try:
+        session = uploads.create_session(db, current_user, request.filename, request.size, request.chunk_size)
+    except uploads.UploadError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return uploads.describe(db, session)
+
+@app.get("/uploads/{upload_id}")
+def get_upload(
+    upload_id: str,
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    # Lists the chunks received so far, which is where a client resumes from
+    return uploads.describe(db, load_upload(db, upload_id, current_user))
+
+@app.put("/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(
+    upload_id: str,
+    index: int,
+    request: Request,
+    checksum: str = Header(..., alias="X-Chunk-SHA256"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    session = await run_db(load_upload, db, upload_id, current_user)
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > session.chunk_size:
+        raise HTTPException(status_code=413, detail=f"Chunks are at most {session.chunk_size} bytes")
+    data = await request.body()
+    # Checked and encrypted on the crypto pool, then recorded
+    try:
+        chunk = await run_crypto(uploads.store_chunk, session, index, data, checksum, size=len(data))
+    except uploads.UploadError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    try:
+        await run_db(uploads.record_chunk, db, chunk)
+    except LookupError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return {"upload_id": upload_id, "index": index, "length": chunk.length}
+
+@app.post("/uploads/{upload_id}/finalize", response_model=FileResponse)
+def finalize_upload(
+    upload_id: str,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    session = load_upload(db, upload_id, current_user)
+    try:
+        return uploads.finalize(db, session)
+    except uploads.UploadIncomplete as exc:
+        raise HTTPException(status_code=409, detail={"message": "Chunks missing", "missing": exc.missing[:1000]})
+    except LookupError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+@app.delete("/uploads/{upload_id}")
+def abort_upload(
+    upload_id: str,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    uploads.abort(db, load_upload(db, upload_id, current_user))
+    return {"message": "Upload aborted"}
+
+# Backup history
+class FileVersionResponse(BaseModel):
+    version: int
+    is_snapshot: bool
+    content_size: Optional[int]
+    backup_at: datetime.datetime
     
-    return file
+    class Config:
+        orm_mode = True
+
+@app.get("/files/{file_id}/versions", response_model=List[FileVersionResponse])
+def list_file_versions(
+    file_id: int,
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    file = db.query(DBFile).filter(DBFile.id == file_id, DBFile.owner_id == current_user.id).first()
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    return versioning.list_versions(db, file_id, current_user.id)
+
+@app.get("/files/{file_id}/versions/{version}")
+def get_file_version(
+    file_id: int,
+    version: int,
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    file = db.query(DBFile).filter(DBFile.id == file_id, DBFile.owner_id == current_user.id).first()
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    content = versioning.reconstruct(db, file_id, current_user.id, version)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Version not found")
+    media_type = mimetypes.guess_type(file.filename or "")[0] or "application/octet-stream"
+    return Response(content=content, media_type=media_type)
+
+@app.post("/files/{file_id}/versions/{version}/restore", response_model=FileResponse)
+def restore_file_version(
+    file_id: int,
+    version: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    file = db.query(DBFile).filter(DBFile.id == file_id, DBFile.owner_id == current_user.id).first()
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found")
+    content = versioning.reconstruct(db, file_id, current_user.id, version)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Version not found")
+    # Restoring is itself a new version, so the history stays linear
+    return document_log.replace(db, file, content)
 
 @app.delete("/files/{file_id}")
-async def delete_file(
+def delete_file(
     file_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     # Get the file
-    file = db.query(File).filter(File.id == file_id, File.owner_id == current_user.id).first()
+    file = db.query(DBFile).filter(DBFile.id == file_id, DBFile.owner_id == current_user.id).first()
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Delete temp storage
-    temp_storage = db.query(TempStorage).filter(
-        TempStorage.file_id == file_id,
-        TempStorage.user_id == current_user.id
-    ).delete()
+    # Delete the file's keys and any pushed operations
+    key_store.delete(db, file_id)
+    db.query(DocumentOp).filter(DocumentOp.file_id == file_id).delete(synchronize_session=False)
+    document_log.forget(file_id)
     
-    # Delete backup
-    backup = db.query(BackupStorage).filter(
+    # Delete backup, dropping its blob reference
+    backups = db.query(BackupStorage).filter(
         BackupStorage.file_id == file_id,
         BackupStorage.user_id == current_user.id
-    ).delete()
+    ).all()
+    for backup in backups:
+        blobstore.release(db, backup.blob_hash)
+        db.delete(backup)
     
     # Delete the file
+    blobstore.release(db, file.blob_hash)
     db.delete(file)
     db.commit()
     
     return {"message": "File deleted successfully"}
 
+# Cache metrics, for sizing the in-process caches
+@app.get("/metrics/caches")
+async def cache_metrics(current_user: User = Depends(get_current_active_user)):
+    return {"file_keys": key_store.stats(), "principals": principal_cache.stats()}
+
+@app.get("/metrics/collab")
+async def collab_metrics(current_user: User = Depends(get_current_active_user)):
+    return collab_rooms.stats()
+
+@app.get("/metrics/maintenance")
+async def maintenance_metrics(current_user: User = Depends(get_current_active_user)):
+    return maintenance.last_reports
+
 # Session management
+def retire_user_epochs(db: Session, user_id: int, username: str):
+    """Bump a user's session and key epochs, invalidating everything stamped with the old ones."""
+    db.query(User).filter(User.id == user_id).update({
+        User.session_epoch: func.coalesce(User.session_epoch, 0) + 1,
+        User.key_epoch: func.coalesce(User.key_epoch, 0) + 1,
+    }, synchronize_session=False)
+    db.commit()
+    # A bulk update bypasses the attribute events, so drop the caches by hand
+    principal_cache.invalidate_user(user_id, username)
+    key_store.evict_user(user_id)
+
 @app.post("/logout")
-async def logout(
+def logout(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    # Deactivate all user sessions
-    db.query(UserSession).filter(
-        UserSession.user_id == current_user.id,
-        UserSession.is_active == True
-    ).update({UserSession.is_active: False})
-    db.commit()
-    
-    # Clear all temp storage
-    db.query(TempStorage).filter(TempStorage.user_id == current_user.id).delete()
-    db.commit()
+    # Every session, token and file key of the user dies with one row update
+    retire_user_epochs(db, current_user.id, current_user.username)
     
     return {"message": "Logged out successfully"}
 
 # Document editing endpoints (simulating Word, Excel, etc.)
 @app.post("/documents/create", response_model=FileResponse)
-async def create_document(
+def create_document(
     doc_type: str = Form(...),
     doc_name: str = Form(...),
     db: Session = Depends(get_db),
@@ -542,60 +790,26 @@ async def create_document(
         content = b""
         file_type = "txt"
     
-    # Encrypt the content
-    encryption_result = encrypt_data(content)
-    
-    # Create a new file record
+    # Encrypt and store the file, its keys and its first backup in one transaction
     filename = f"{doc_name}.{file_type}"
-    new_file = File(
-        filename=filename,
-        file_type=file_type,
-        content=encryption_result["encrypted_data"],
-        owner_id=current_user.id
-    )
-    db.add(new_file)
-    db.commit()
-    db.refresh(new_file)
-    
-    # Store encryption keys in temp storage
-    session_id = str(uuid.uuid4())
-    temp_storage = TempStorage(
-        user_id=current_user.id,
-        file_id=new_file.id,
-        temp_content=json.dumps({
-            "key": base64.b64encode(encryption_result["key"]).decode(),
-            "iv": base64.b64encode(encryption_result["iv"]).decode()
-        }).encode(),
-        session_id=session_id
-    )
-    db.add(temp_storage)
-    db.commit()
-    
-    # Create backup
-    backup = BackupStorage(
-        user_id=current_user.id,
-        file_id=new_file.id,
-        backup_content=encryption_result["encrypted_data"]
-    )
-    db.add(backup)
-    db.commit()
-    
-    return new_file
+    return FileWriteService(db).create_from_bytes(current_user.id, filename, file_type, content)
 
 # Internal email system
 @app.post("/emails/send", response_model=EmailResponse)
-async def send_email(
+def send_email(
     email_data: EmailBase,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    # Encrypt email content
-    encryption_result = encrypt_data(email_data.content.encode())
+    # Compress, then encrypt the email content
+    payload, codec = compression.pack(email_data.content.encode())
+    encryption_result = encrypt_data(payload)
     
     # Create new email
     new_email = Email(
         subject=email_data.subject,
         content=encryption_result["encrypted_data"],
+        compression=codec,
         user_id=current_user.id,
         sender=current_user.username,
         recipient=email_data.recipient
@@ -614,7 +828,8 @@ async def send_email(
             "type": "email",
             "email_id": new_email.id
         }).encode(),
-        session_id=session_id
+        session_id=session_id,
+        epoch=current_user.key_epoch
     )
     db.add(temp_storage)
     db.commit()
@@ -622,8 +837,8 @@ async def send_email(
     return new_email
 
 @app.get("/emails", response_model=List[EmailResponse])
-async def list_emails(
-    db: Session = Depends(get_db),
+def list_emails(
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_active_user)
 ):
     # Get emails where user is sender or recipient
@@ -637,54 +852,57 @@ async def list_emails(
 
 # Clear all local traces when app is closed
 @app.post("/clear-traces")
-async def clear_traces(
+def clear_traces(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    # Mark all sessions as inactive
-    db.query(UserSession).filter(
-        UserSession.user_id == current_user.id,
-        UserSession.is_active == True
-    ).update({UserSession.is_active: False})
-    
-    # Remove all temp storage
-    db.query(TempStorage).filter(TempStorage.user_id == current_user.id).delete()
-    
-    db.commit()
+    # Sessions, temp storage and file keys are dropped by epoch; the reaper deletes the rows
+    retire_user_epochs(db, current_user.id, current_user.username)
     
     return {"message": "All local traces cleared successfully"}
 
-# WebSocket for real-time editing 
-active_connections: Dict[int, List[WebSocket]] = {}
+def websocket_principal(token: Optional[str]) -> Optional[Principal]:
+    """The bearer token's user, or None."""
+    if not token:
+        return None
+    db = ReadSessionLocal()
+    try:
+        return get_current_user(token, db)
+    except HTTPException:
+        return None
+    finally:
+        db.close()
 
+# WebSocket for real-time editing: one room per file, see backend/collab.py
 @app.websocket("/ws/document/{file_id}")
 async def websocket_document_endpoint(
     websocket: WebSocket,
     file_id: int,
-    user_id: int
+    token: Optional[str] = Query(None),
+    authorization: Optional[str] = Header(None)
 ):
-    await websocket.accept()
-    
-    # Add connection to active connections
-    if user_id not in active_connections:
-        active_connections[user_id] = []
-    active_connections[user_id].append(websocket)
+    # Browsers cannot set headers on a WebSocket, so the bearer token may also come as ?token=
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    principal = await run_db(websocket_principal, token)
+    try:
+        # Checks ownership before the handshake completes, so nobody else's edits reach this socket
+        peer = await collab_rooms.join(file_id, websocket, principal)
+    except PermissionError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
     
     try:
         while True:
             # Receive document changes
             data = await websocket.receive_text()
             
-            # Broadcast to all connected clients for this user
-            for connection in active_connections.get(user_id, []):
-                if connection != websocket:
-                    await connection.send_text(data)
+            # Queue for every other editor of this file; never waits on a peer's socket
+            collab_rooms.broadcast(file_id, data, sender=peer)
     except WebSocketDisconnect:
-        # Remove connection when disconnected
-        if user_id in active_connections:
-            active_connections[user_id].remove(websocket)
-            if not active_connections[user_id]:
-                del active_connections[user_id]
+        pass
+    finally:
+        await collab_rooms.leave(peer)
 
 # Serve static files (frontend)
 app.mount("/static", StaticFiles(directory="frontend"), name="static")
@@ -0,0 +1,211 @@
+"""
+Background database maintenance.
+
+Periodic tasks run from the FastAPI lifespan. The first two delete a
+small batch per transaction so the SQLite write lock is never held long:
+
+reaper     Logout and clear-traces only bump the user's session and key
+           epochs, so they cost one row update however much the user owns.
+           Rows stamped with an older epoch are dead from that moment (token
+           and key lookups reject them); the reaper deletes them, including
+           backup versions, whose blob references it releases.
+           Every SECUREPLUS_REAPER_INTERVAL seconds.
+
+sweeper    Purges UserSession rows past `expires_at` and TempStorage rows not
+           accessed for SECUREPLUS_TEMP_STORAGE_TTL seconds, at most
+           SECUREPLUS_SWEEP_MAX_ROWS per table per pass, then gives free
+           pages back with an incremental VACUUM and runs PRAGMA optimize.
+           Resumable uploads idle for SECUREPLUS_UPLOAD_SESSION_TTL seconds
+           are deleted with their partial chunks (see backend/uploads.py),
+           and blob files a rolled-back write left without a row are
+           removed (see backend/blobstore.py).
+           Every SECUREPLUS_SWEEP_INTERVAL seconds.
+
+compactor  Folds documents' pending operation-log pushes into a new
+           encrypted snapshot (see backend/oplog.py).
+           Every SECUREPLUS_OPLOG_COMPACT_INTERVAL seconds.
+
+An interval of 0 disables a task. The last report of each is kept in
+`last_reports` and served by /metrics/maintenance.
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, or_, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import blobstore, uploads
+from .db import run_db
+from .models import SessionLocal, engine, User, UserSession, TempStorage, FileKey, UploadSession, BackupStorage
+from .oplog import COMPACT_INTERVAL, compact_once
+
+logger = logging.getLogger(__name__)
+
+REAPER_INTERVAL = float(os.environ.get("SECUREPLUS_REAPER_INTERVAL", 30))
+REAPER_BATCH_SIZE = int(os.environ.get("SECUREPLUS_REAPER_BATCH_SIZE", 500))
+REAPER_BATCH_PAUSE = float(os.environ.get("SECUREPLUS_REAPER_BATCH_PAUSE", 0.01))  # seconds between batches
+
+SWEEP_INTERVAL = float(os.environ.get("SECUREPLUS_SWEEP_INTERVAL", 300))
+SWEEP_BATCH_SIZE = int(os.environ.get("SECUREPLUS_SWEEP_BATCH_SIZE", 500))
+SWEEP_MAX_ROWS = int(os.environ.get("SECUREPLUS_SWEEP_MAX_ROWS", 20000))  # per table per pass
+SWEEP_BATCH_PAUSE = float(os.environ.get("SECUREPLUS_SWEEP_BATCH_PAUSE", 0.05))
+SWEEP_VACUUM_PAGES = int(os.environ.get("SECUREPLUS_SWEEP_VACUUM_PAGES", 2000))  # per pass
+TEMP_STORAGE_TTL = float(os.environ.get("SECUREPLUS_TEMP_STORAGE_TTL", 24 * 3600))
+
+# (table, its primary key, the epoch stamped on the row, the user epoch it is checked against)
+EPOCH_TABLES = (
+    (UserSession, UserSession.id, UserSession.epoch, "session_epoch"),
+    (TempStorage, TempStorage.id, TempStorage.epoch, "key_epoch"),
+    (FileKey, FileKey.file_id, FileKey.user_epoch, "key_epoch"),
+    (UploadSession, UploadSession.id, UploadSession.epoch, "key_epoch"),
+)
+
+last_reports: Dict[str, Dict] = {}
+
+
+def _delete_in_batches(db: Session, model, pk, condition, batch_size: int, pause: float,
+                       max_rows: Optional[int] = None) -> int:
+    deleted = 0
+    while max_rows is None or deleted < max_rows:
+        limit = batch_size if max_rows is None else min(batch_size, max_rows - deleted)
+        ids = [row[0] for row in db.query(pk).filter(condition).limit(limit).all()]
+        if not ids:
+            return deleted
+        db.query(model).filter(pk.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        deleted += len(ids)
+        if len(ids) < limit:
+            return deleted
+        time.sleep(pause)
+    return deleted
+
+
+def _reap_backups(db: Session, user_id: int, key_epoch: int, batch_size: int, pause: float) -> int:
+    """Delete a user's backup versions from before key_epoch, releasing their blobs."""
+    deleted = 0
+    while True:
+        rows = db.query(BackupStorage).filter(
+            BackupStorage.user_id == user_id, BackupStorage.user_epoch < key_epoch
+        ).limit(batch_size).all()
+        if not rows:
+            return deleted
+        # Not a bulk delete: each row holds a blob reference
+        for row in rows:
+            blobstore.release(db, row.blob_hash)
+            db.delete(row)
+        db.commit()
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+def reap_stale_rows(db: Session, batch_size: int = REAPER_BATCH_SIZE,
+                    pause: float = REAPER_BATCH_PAUSE) -> Dict[str, int]:
+    """Delete sessions, temp storage, keys and backup versions left behind by an epoch bump."""
+    counts = {model.__tablename__: 0 for model, _, _, _ in EPOCH_TABLES}
+    counts[BackupStorage.__tablename__] = 0
+    users = db.query(User.id, User.session_epoch, User.key_epoch).filter(
+        or_(User.session_epoch > 0, User.key_epoch > 0)
+    ).all()
+    db.commit()
+    for user_id, session_epoch, key_epoch in users:
+        epochs = {"session_epoch": session_epoch or 0, "key_epoch": key_epoch or 0}
+        for model, pk, column, user_epoch in EPOCH_TABLES:
+            condition = (model.user_id == user_id) & (func.coalesce(column, 0) < epochs[user_epoch])
+            counts[model.__tablename__] += _delete_in_batches(db, model, pk, condition, batch_size, pause)
+        counts[BackupStorage.__tablename__] += _reap_backups(db, user_id, epochs["key_epoch"], batch_size, pause)
+    return counts
+
+
+def sweep_expired_rows(db: Session, batch_size: int = SWEEP_BATCH_SIZE, max_rows: int = SWEEP_MAX_ROWS,
+                       pause: float = SWEEP_BATCH_PAUSE, temp_ttl: float = TEMP_STORAGE_TTL,
+                       now: Optional[datetime.datetime] = None) -> Dict[str, int]:
+    """Delete expired sessions and idle temp storage, at most max_rows of each."""
+    now = now or datetime.datetime.utcnow()
+    expired = (
+        (UserSession, UserSession.id, UserSession.expires_at < now),
+        (TempStorage, TempStorage.id, TempStorage.last_accessed < now - datetime.timedelta(seconds=temp_ttl)),
+    )
+    return {
+        model.__tablename__: _delete_in_batches(db, model, pk, condition, batch_size, pause, max_rows)
+        for model, pk, condition in expired
+    }
+
+
+def reclaim_space(bind: Engine = engine, max_pages: int = SWEEP_VACUUM_PAGES) -> int:
+    """Return up to max_pages free pages to the filesystem and refresh planner stats.
+
+    Incremental VACUUM needs auto_vacuum=INCREMENTAL, which the production
+    profile sets on new databases; older ones get it at their next full
+    VACUUM (`python -m backend.migrate_blobs --vacuum`). Returns pages freed.
+    """
+    if bind.dialect.name != "sqlite":
+        return 0
+    freed = 0
+    with bind.begin() as conn:
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2:
+            before = conn.execute(text("PRAGMA freelist_count")).scalar()
+            # The sqlite3 module steps a statement that returns no rows only once,
+            # and each step frees one page, so issue it once per page
+            for _ in range(min(before, max_pages)):
+                conn.execute(text("PRAGMA incremental_vacuum(1)"))
+            freed = before - conn.execute(text("PRAGMA freelist_count")).scalar()
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("PRAGMA optimize"))
+    return freed
+
+
+def reap_once(batch_size: int = REAPER_BATCH_SIZE) -> Dict:
+    start = time.perf_counter()
+    db = SessionLocal()
+    try:
+        rows = reap_stale_rows(db, batch_size)
+    finally:
+        db.close()
+    return {"rows": rows, "seconds": time.perf_counter() - start}
+
+
+def sweep_once() -> Dict:
+    start = time.perf_counter()
+    db = SessionLocal()
+    try:
+        rows = sweep_expired_rows(db)
+        rows.update(uploads.collect_stale(db))
+        rows.update(blobstore.collect_orphans(db))
+    finally:
+        db.close()
+    freed_pages = reclaim_space()
+    return {"rows": rows, "freed_pages": freed_pages, "seconds": time.perf_counter() - start}
+
+
+async def run_periodic(name: str, interval: float, fn, *args):
+    """Run fn in the worker pool every `interval` seconds, keeping its last report."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            report = await run_db(fn, *args)
+        except Exception:
+            logger.exception("%s pass failed", name)
+            continue
+        report["finished_at"] = datetime.datetime.utcnow().isoformat()
+        last_reports[name] = report
+        if any(report["rows"].values()) or report.get("freed_pages"):
+            logger.info("%s: %s", name, report)
+
+
+def start_background_tasks() -> List[asyncio.Task]:
+    tasks = []
+    if REAPER_INTERVAL > 0:
+        tasks.append(asyncio.create_task(run_periodic("reaper", REAPER_INTERVAL, reap_once)))
+    if SWEEP_INTERVAL > 0:
+        tasks.append(asyncio.create_task(run_periodic("sweeper", SWEEP_INTERVAL, sweep_once)))
+    if COMPACT_INTERVAL > 0:
+        tasks.append(asyncio.create_task(run_periodic("compactor", COMPACT_INTERVAL, compact_once)))
+    return tasks
@@ -0,0 +1,64 @@
+"""
+Move encrypted content out of the SQLite database into the blob store.
+
+Rows written before the blob store existed keep their ciphertext in
+File.content and BackupStorage.backup_content. This copies each one into
+the blob store, points the row at the blob and clears the column, a batch
+at a time. Backups holding the same ciphertext as their file end up
+sharing one blob.
+
+    python -m backend.migrate_blobs [--batch-size 100] [--vacuum]
+"""
+
+import argparse
+
+from sqlalchemy import text
+
+from . import blobstore
+from .migrations import run_migrations
+from .models import SessionLocal, engine, File, BackupStorage
+
+
+def _migrate_table(db, model, column, batch_size: int) -> int:
+    moved = 0
+    while True:
+        rows = db.query(model).filter(column.isnot(None)).limit(batch_size).all()
+        if not rows:
+            return moved
+        for row in rows:
+            row.blob_hash = blobstore.put_bytes(db, getattr(row, column.key))
+            setattr(row, column.key, None)
+        db.commit()
+        moved += len(rows)
+        print(f"{model.__tablename__}: moved {moved} rows")
+
+
+def migrate(batch_size: int = 100, vacuum: bool = False):
+    # The blob_hash columns may not exist yet on an old database
+    run_migrations(engine)
+    db = SessionLocal()
+    try:
+        files = _migrate_table(db, File, File.content, batch_size)
+        backups = _migrate_table(db, BackupStorage, BackupStorage.backup_content, batch_size)
+    finally:
+        db.close()
+
+    if vacuum:
+        # Give the freed pages back to the filesystem
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+    return files, backups
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move LargeBinary content into the blob store")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--vacuum", action="store_true", help="run VACUUM afterwards to shrink the database file")
+    args = parser.parse_args()
+
+    files, backups = migrate(args.batch_size, args.vacuum)
+    print(f"Done: {files} files and {backups} backups moved to {blobstore.BLOB_DIR}/")
+
+
+if __name__ == "__main__":
+    main()
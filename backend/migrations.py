@@ -0,0 +1,224 @@
+"""
+Versioned schema migrations.
+
+`Base.metadata.create_all` only creates missing tables; it never adds
+columns or indexes to tables that already exist. Changes to existing
+databases go here instead: each migration runs once, in order, in its own
+transaction, and is recorded in the `schema_migrations` table. Migrations
+are written to be idempotent, so a fresh database (already created at the
+latest schema) simply records them all as applied.
+
+    python -m backend.migrations            # apply pending migrations
+    python -m backend.migrations --status   # list applied / pending
+
+tests/test_query_plans.py checks that every query the app issues uses an
+index on the migrated schema.
+"""
+
+import argparse
+import datetime
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import Session
+
+from .models import Base, engine as default_engine
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Connection], None]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, name: str):
+    def register(fn):
+        MIGRATIONS.append(Migration(version, name, fn))
+        return fn
+    return register
+
+
+def add_missing_columns(conn: Connection):
+    """ALTER TABLE ADD COLUMN for every model column the table lacks."""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                col_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+
+
+def create_indexes(conn: Connection, *names: str):
+    """Create the named model indexes if they don't exist yet."""
+    wanted = set(names)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in wanted:
+                # Reflection skips expression indexes, so checkfirst would miss them
+                conn.execute(CreateIndex(index, if_not_exists=True))
+                wanted.discard(index.name)
+    if wanted:
+        raise LookupError(f"No such index on the models: {', '.join(sorted(wanted))}")
+
+
+@migration(1, "add columns introduced since the first release")
+def _columns_since_first_release(conn):
+    # Blob store, versioned backups, key table and segmented encryption
+    add_missing_columns(conn)
+
+
+@migration(2, "index file listings by owner and update time")
+def _file_listing_index(conn):
+    create_indexes(conn, "ix_files_owner_updated")
+
+
+@migration(3, "move file keys out of temp storage")
+def _temp_storage_keys(conn):
+    from .keystore import migrate_temp_storage_keys
+    with Session(bind=conn) as db:
+        migrate_temp_storage_keys(db)
+
+
+@migration(4, "index the per-user and per-file lookups")
+def _lookup_indexes(conn):
+    create_indexes(
+        conn,
+        "ix_temp_storage_user_file",
+        "ix_backup_storage_file_user_version",
+        "ix_emails_user_id",
+        "ix_emails_recipient",
+        "ix_user_sessions_user_active",
+        "ix_chess_moves_user_id",
+    )
+
+
+@migration(5, "per-user session and key epochs")
+def _epochs(conn):
+    add_missing_columns(conn)
+    for table, column in (("users", "session_epoch"), ("users", "key_epoch"), ("user_sessions", "epoch"),
+                          ("temp_storage", "epoch"), ("file_keys", "user_epoch")):
+        conn.execute(text(f"UPDATE {table} SET {column} = 0 WHERE {column} IS NULL"))
+
+
+@migration(6, "index expiry columns for the TTL sweeper")
+def _expiry_indexes(conn):
+    create_indexes(conn, "ix_temp_storage_last_accessed", "ix_user_sessions_expires_at")
+
+
+@migration(7, "store chess sequences as keyed digests")
+def _chess_sequence_digests(conn):
+    from .chess_auth import sequence_digest
+    add_missing_columns(conn)
+    rows = conn.execute(text("SELECT id, move_sequence FROM chess_moves WHERE move_sequence IS NOT NULL")).fetchall()
+    if rows:
+        conn.execute(
+            text("UPDATE chess_moves SET sequence_digest = :digest, move_sequence = NULL WHERE id = :id"),
+            [{"id": row_id, "digest": sequence_digest(sequence)} for row_id, sequence in rows],
+        )
+    conn.execute(text("DROP INDEX IF EXISTS ix_chess_moves_move_sequence"))
+    create_indexes(conn, "ix_chess_moves_sequence_digest")
+
+
+@migration(8, "room chat history")
+def _room_chat(conn):
+    add_missing_columns(conn)
+    create_indexes(conn, "ix_chat_messages_room_sent")
+
+
+@migration(9, "document operation log")
+def _document_ops(conn):
+    # The document_ops table itself is new, so create_all has made it
+    add_missing_columns(conn)
+    conn.execute(text("UPDATE files SET op_seq = 0 WHERE op_seq IS NULL"))
+
+
+@migration(10, "compression before encryption")
+def _compression(conn):
+    # NULL compression is raw ciphertext, which is what every existing row holds
+    add_missing_columns(conn)
+
+
+@migration(11, "resumable upload sessions")
+def _upload_sessions(conn):
+    # Both tables are new, so create_all has made them; their indexes come with them
+    create_indexes(conn, "ix_upload_sessions_user", "ix_upload_sessions_last_activity")
+
+
+@migration(12, "file key epoch on the file row")
+def _file_key_epoch(conn):
+    add_missing_columns(conn)
+    conn.execute(text(
+        "UPDATE files SET key_epoch = coalesce((SELECT epoch FROM file_keys WHERE file_keys.file_id = files.id), 0)"
+    ))
+
+
+@migration(13, "index file listings by creation time and name")
+def _file_listing_sort_indexes(conn):
+    create_indexes(conn, "ix_files_owner_created", "ix_files_owner_filename")
+
+
+@migration(14, "owner key epoch on backup versions")
+def _backup_epochs(conn):
+    add_missing_columns(conn)
+    # A file whose key is still live was last written under that key's epoch; the rest are dead
+    conn.execute(text(
+        "UPDATE backup_storage SET user_epoch = coalesce("
+        "(SELECT user_epoch FROM file_keys WHERE file_keys.file_id = backup_storage.file_id), 0) "
+        "WHERE user_epoch IS NULL"
+    ))
+    create_indexes(conn, "ix_backup_storage_user")
+
+
+def _ensure_table(conn: Connection):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at DATETIME NOT NULL)"
+    ))
+
+
+def applied_versions(engine: Engine = default_engine) -> set:
+    with engine.begin() as conn:
+        _ensure_table(conn)
+        return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def run_migrations(engine: Engine = default_engine) -> List[Migration]:
+    """Apply pending migrations in version order; returns the ones applied."""
+    Base.metadata.create_all(bind=engine)
+    done = applied_versions(engine)
+    applied = []
+    for item in sorted(MIGRATIONS):
+        if item.version in done:
+            continue
+        with engine.begin() as conn:
+            item.apply(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                {"v": item.version, "n": item.name, "t": datetime.datetime.utcnow()},
+            )
+        applied.append(item)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations")
+    parser.add_argument("--status", action="store_true", help="list migrations without applying them")
+    args = parser.parse_args()
+
+    if args.status:
+        done = applied_versions()
+        for item in sorted(MIGRATIONS):
+            print(f"{item.version:4}  {'applied' if item.version in done else 'pending':8} {item.name}")
+        return
+    for item in run_migrations():
+        print(f"Applied {item.version}: {item.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,22 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, LargeBinary, Boolean, DateTime, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, LargeBinary, Boolean, DateTime, Text, Index, func, literal_column
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import relationship, sessionmaker, deferred
 import datetime
 import os
 
+from .engine import DATABASE_URL, make_engines
+
 Base = declarative_base()
 
 # Database connection - Using SQLite instead of PostgreSQL
 # Create a directory for the database if it doesn't exist
 os.makedirs("database", exist_ok=True)
-DATABASE_URL = "sqlite:///database/secureplus.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Tuning profile and pool sizes come from the environment (see backend/engine.py)
+engine, read_engine = make_engines(DATABASE_URL)
+# Objects stay loaded after commit so they can be serialised outside the worker thread
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+# Read-only connections; under the production profile these never wait for the writer
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=read_engine)
 
 class User(Base):
     __tablename__ = "users"
@@ -24,6 +28,9 @@ class User(Base):
     disabled = Column(Boolean, default=False)
     mfa_secret = Column(String, nullable=True)
     last_login = Column(DateTime, default=datetime.datetime.utcnow)
+    # Bumped on logout / clear-traces; sessions, tokens and keys from older epochs are dead
+    session_epoch = Column(Integer, default=0)
+    key_epoch = Column(Integer, default=0)
     
     files = relationship("File", back_populates="owner")
     emails = relationship("Email", back_populates="user")
@@ -34,22 +41,37 @@ class File(Base):
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String)
     file_type = Column(String)  # docx, xlsx, etc.
-    content = Column(LargeBinary)  # Encrypted content
+    content = deferred(Column(LargeBinary))  # Encrypted content; only loaded when accessed
+    blob_hash = Column(String(64), ForeignKey("blobs.hash"), nullable=True)  # Encrypted content in the blob store
+    op_seq = Column(Integer, default=0)  # Last operation-log push the content includes, see backend/oplog.py
+    compression = Column(String, nullable=True)  # Codec applied before encryption, see backend/compression.py
+    content_size = Column(Integer, nullable=True)  # Plaintext size; NULL on rows written before compression
+    key_epoch = Column(Integer, default=0)  # Mirrors FileKey.epoch, so cached keys can be checked against the row
     owner_id = Column(Integer, ForeignKey("users.id"))
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     
     owner = relationship("User", back_populates="files")
     
+    # Keyset pagination of a user's listing walks one of these indexes in order
+    __table_args__ = (Index("ix_files_owner_updated", "owner_id", "updated_at", "id"),
+                      Index("ix_files_owner_created", "owner_id", "created_at", "id"))
+
+# Listing order by name: NULL sorts as "" so keyset comparisons stay total. The "" is a
+# literal, not a bound parameter, or SQLite would not match queries to the expression index
+FILE_NAME_SORT_KEY = func.coalesce(File.filename, literal_column("''"))
+Index("ix_files_owner_filename", File.owner_id, FILE_NAME_SORT_KEY, File.id)
+    
 class Email(Base):
     __tablename__ = "emails"
     
     id = Column(Integer, primary_key=True, index=True)
     subject = Column(String)
     content = Column(LargeBinary)  # Encrypted content
-    user_id = Column(Integer, ForeignKey("users.id"))
+    compression = Column(String, nullable=True)  # Codec applied before encryption
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     sender = Column(String)
-    recipient = Column(String)
+    recipient = Column(String, index=True)
     sent_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     user = relationship("User", back_populates="emails")
@@ -63,6 +85,54 @@ class ChatMessage(Base):
     content = Column(LargeBinary)  # Encrypted content
     sent_at = Column(DateTime, default=datetime.datetime.utcnow)
     read = Column(Boolean, default=False)
+    room_id = Column(String)  # Chess game chat; see backend/chat_history.py
+    sender_name = Column(String)
+    iv = Column(LargeBinary)
+    
+    __table_args__ = (Index("ix_chat_messages_room_sent", "room_id", "sent_at", "id"),)
+    
+class DocumentOp(Base):
+    __tablename__ = "document_ops"
+    
+    id = Column(Integer, primary_key=True)
+    file_id = Column(Integer, ForeignKey("files.id"), nullable=False)
+    seq = Column(Integer, nullable=False)  # One per push, in order
+    user_id = Column(Integer, ForeignKey("users.id"))
+    payload = Column(LargeBinary)  # Encrypted JSON list of operations
+    iv = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    
+    __table_args__ = (Index("ix_document_ops_file_seq", "file_id", "seq", unique=True),)
+    
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+    
+    id = Column(String(32), primary_key=True)  # Random token, also the chunk directory name
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    filename = Column(String)
+    file_type = Column(String)
+    size = Column(Integer, nullable=False)  # Declared plaintext size
+    chunk_size = Column(Integer, nullable=False)
+    key = Column(LargeBinary)  # The file's key once finalized; chunks are encrypted with it on arrival
+    iv = Column(LargeBinary)
+    epoch = Column(Integer, default=0)  # Owner's key_epoch when created
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    last_activity = Column(DateTime, default=datetime.datetime.utcnow)
+    
+    __table_args__ = (Index("ix_upload_sessions_user", "user_id"),
+                      Index("ix_upload_sessions_last_activity", "last_activity"))
+    
+class UploadChunk(Base):
+    __tablename__ = "upload_chunks"
+    
+    session_id = Column(String(32), ForeignKey("upload_sessions.id"), primary_key=True)
+    chunk_index = Column(Integer, primary_key=True)
+    length = Column(Integer)  # Plaintext length
+    hash = Column(String(64))  # SHA-256 of the ciphertext, its file name and later its blob digest
+    stored_size = Column(Integer)
+    iv = Column(LargeBinary)
+    mac = Column(LargeBinary)
+    codec = Column(String, nullable=True)
     
 class TempStorage(Base):
     __tablename__ = "temp_storage"
@@ -71,8 +141,22 @@ class TempStorage(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     file_id = Column(Integer, ForeignKey("files.id"))
     temp_content = Column(LargeBinary)  # Encrypted content in memory
-    last_accessed = Column(DateTime, default=datetime.datetime.utcnow)
+    last_accessed = Column(DateTime, default=datetime.datetime.utcnow, index=True)
     session_id = Column(String, unique=True)
+    epoch = Column(Integer, default=0)  # Owner's key_epoch when stored
+    
+    __table_args__ = (Index("ix_temp_storage_user_file", "user_id", "file_id"),)
+    
+class FileKey(Base):
+    __tablename__ = "file_keys"
+    
+    file_id = Column(Integer, ForeignKey("files.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    key = Column(LargeBinary(32))  # AES-256 key
+    iv = Column(LargeBinary(16))
+    epoch = Column(Integer, default=0)  # Bumped every time the file is re-keyed
+    segment_size = Column(Integer, default=0)  # 0: one CFB stream, else independently keyed segments
+    user_epoch = Column(Integer, default=0)  # Owner's key_epoch when stored
     
 class BackupStorage(Base):
     __tablename__ = "backup_storage"
@@ -81,7 +165,27 @@ class BackupStorage(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     file_id = Column(Integer, ForeignKey("files.id"))
     backup_content = Column(LargeBinary)  # Encrypted backup content
+    blob_hash = Column(String(64), ForeignKey("blobs.hash"), nullable=True)  # Encrypted backup in the blob store
     backup_at = Column(DateTime, default=datetime.datetime.utcnow)
+    version = Column(Integer, nullable=True)  # Position in the file's version chain
+    is_snapshot = Column(Boolean, default=True)  # Full copy, or a delta against the previous version
+    backup_key = Column(LargeBinary, nullable=True)
+    backup_iv = Column(LargeBinary, nullable=True)
+    content_size = Column(Integer, nullable=True)  # Plaintext size of this version
+    segment_size = Column(Integer, default=0)  # Cipher layout of backup_key/backup_iv, as in FileKey
+    compression = Column(String, nullable=True)  # Codec applied before encryption, as in File
+    user_epoch = Column(Integer, default=0)  # Owner's key_epoch when written; older rows are dead
+    
+    __table_args__ = (Index("ix_backup_storage_file_user_version", "file_id", "user_id", "version"),
+                      Index("ix_backup_storage_user", "user_id"))
+    
+class Blob(Base):
+    __tablename__ = "blobs"
+    
+    hash = Column(String(64), primary_key=True)  # SHA-256 of the ciphertext
+    size = Column(Integer)
+    refcount = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
 class UserSession(Base):
     __tablename__ = "user_sessions"
@@ -90,16 +194,20 @@ class UserSession(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     session_id = Column(String, unique=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    expires_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
     is_active = Column(Boolean, default=True)
+    epoch = Column(Integer, default=0)  # User's session_epoch at login
+    
+    __table_args__ = (Index("ix_user_sessions_user_active", "user_id", "is_active"),)
     
 class ChessMove(Base):
     __tablename__ = "chess_moves"
     
     id = Column(Integer, primary_key=True, index=True)
-    move_sequence = Column(Text)  # Store the sequence of moves that triggers login
-    user_id = Column(Integer, ForeignKey("users.id"))
+    move_sequence = Column(Text)  # Plaintext sequence from before digests; cleared by migration
+    sequence_digest = Column(String(64), index=True)  # HMAC of the canonical sequence, see chess_auth
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
-# Create all tables
+# Create all tables; existing databases are brought up to date by backend/migrations.py
 Base.metadata.create_all(bind=engine)
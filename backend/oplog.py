@@ -0,0 +1,306 @@
+"""
+Operation log for collaboratively edited documents.
+
+Instead of re-uploading the whole document on every save, an editor pushes
+a small batch of operations against the sequence number it last saw:
+
+    {"op": "insert", "pos": 10, "text": "abc"}
+    {"op": "delete", "pos": 10, "len": 3}
+    {"op": "cell", "row": 2, "col": 0, "value": "=A1+1"}
+
+Positions count characters of the decrypted document text; cell edits
+apply to documents whose text is a JSON array of rows (the spreadsheet
+format) and grow it as needed. A push applies to the document as of
+`base`; if someone else got there first the push is refused with the
+current sequence number and the client rebases and retries.
+
+Each accepted push is appended as one `DocumentOp` row, encrypted with the
+file's key and a fresh IV, so saving costs one small insert however large
+the document is. `File.op_seq` is the last push the stored blob already
+contains; the current text is that blob with the later rows replayed, and
+is kept in an LRU cache keyed by the file's id and creation time (ids are
+reused after a delete). Other workers push too, so every read first asks
+the database for the file's latest push, one probe of the unique (file_id,
+seq) index, and replays whatever the cached text lacks. The compactor (a
+maintenance task) folds the log back into the blob through
+FileWriteService once a document has SECUREPLUS_OPLOG_COMPACT_OPS pushes
+pending or its oldest pending push is SECUREPLUS_OPLOG_COMPACT_AGE seconds
+old, which also records one backup version per compaction rather than one
+per save.
+
+Every push also touches its File row, conditional on `op_seq`, in the same
+transaction. That takes the write lock before the insert and refuses the
+push if a compaction or full upload replaced the blob (and its key) in
+another worker since this one loaded the document.
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import storage
+from .cache import LRUCache
+from .crypto import decrypt_data, encrypt_data
+from .file_service import FileWriteService
+from .keystore import key_store
+from .models import DocumentOp, File, SessionLocal
+
+COMPACT_OPS = int(os.environ.get("SECUREPLUS_OPLOG_COMPACT_OPS", 200))
+COMPACT_AGE = float(os.environ.get("SECUREPLUS_OPLOG_COMPACT_AGE", 300))
+COMPACT_INTERVAL = float(os.environ.get("SECUREPLUS_OPLOG_COMPACT_INTERVAL", 60))
+CACHE_SIZE = int(os.environ.get("SECUREPLUS_OPLOG_CACHE_SIZE", 256))
+CACHE_TTL = float(os.environ.get("SECUREPLUS_OPLOG_CACHE_TTL", 600))
+MAX_OPS_PER_PUSH = 1000
+LOCK_STRIPES = 64
+
+
+class InvalidOperation(ValueError):
+    pass
+
+
+class SequenceConflict(Exception):
+    """The push was based on an older sequence number than the document's."""
+
+    def __init__(self, seq: int):
+        super().__init__(f"Document is at sequence {seq}")
+        self.seq = seq
+
+
+class DocumentState(NamedTuple):
+    text: str
+    seq: int           # last push applied
+    snapshot_seq: int  # last push the stored blob contains
+    key: bytes         # file key the pushes since the snapshot are encrypted with
+
+
+def _cell(sheet: List, row: Any, col: Any, value: Any):
+    if not isinstance(row, int) or not isinstance(col, int) or row < 0 or col < 0:
+        raise InvalidOperation("cell row and col must be non-negative integers")
+    while len(sheet) <= row:
+        sheet.append([])
+    cells = sheet[row]
+    if not isinstance(cells, list):
+        raise InvalidOperation(f"row {row} is not a list")
+    while len(cells) <= col:
+        cells.append("")
+    cells[col] = "" if value is None else str(value)
+
+
+def apply_ops(text: str, ops: List[Dict[str, Any]]) -> str:
+    """The document after `ops`, in order. Raises InvalidOperation."""
+    sheet = None  # runs of cell edits share one parse
+    for op in ops:
+        if not isinstance(op, dict):
+            raise InvalidOperation("each operation must be an object")
+        kind = op.get("op")
+        if kind == "cell":
+            if sheet is None:
+                try:
+                    sheet = json.loads(text) if text.strip() else []
+                except ValueError:
+                    raise InvalidOperation("cell edits need a JSON spreadsheet document")
+                if not isinstance(sheet, list):
+                    raise InvalidOperation("cell edits need a JSON spreadsheet document")
+            _cell(sheet, op.get("row"), op.get("col"), op.get("value"))
+            continue
+        if sheet is not None:
+            text, sheet = json.dumps(sheet), None
+        pos = op.get("pos")
+        if not isinstance(pos, int) or not 0 <= pos <= len(text):
+            raise InvalidOperation(f"position {pos!r} outside the document (length {len(text)})")
+        if kind == "insert":
+            inserted = op.get("text")
+            if not isinstance(inserted, str):
+                raise InvalidOperation("insert needs a text string")
+            text = text[:pos] + inserted + text[pos:]
+        elif kind == "delete":
+            length = op.get("len")
+            if not isinstance(length, int) or length < 0 or pos + length > len(text):
+                raise InvalidOperation(f"delete of {length!r} characters at {pos} runs past the document")
+            text = text[:pos] + text[pos + length:]
+        else:
+            raise InvalidOperation(f"unknown operation {kind!r}")
+    if sheet is not None:
+        text = json.dumps(sheet)
+    return text
+
+
+def _cache_key(file: File):
+    # A deleted file's id is reused by the next file created
+    return file.id, file.created_at
+
+
+class DocumentLog:
+    def __init__(self, cache_size: int = CACHE_SIZE, cache_ttl: float = CACHE_TTL):
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        # Striped: documents sharing a stripe serialise, but the lock table never grows
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def lock(self, file_id: int) -> threading.Lock:
+        return self._locks[file_id % LOCK_STRIPES]
+
+    def forget(self, file_id: int):
+        self.cache.discard_where(lambda key, state: key[0] == file_id)
+
+    def latest_seq(self, db: Session, file: File) -> int:
+        """The file's last push, whichever worker took it."""
+        latest = db.query(func.max(DocumentOp.seq)).filter(DocumentOp.file_id == file.id).scalar()
+        return max(latest or 0, file.op_seq or 0)
+
+    def _load(self, db: Session, file: File) -> DocumentState:
+        key = _cache_key(file)
+        state = self.cache.get(key)
+        snapshot_seq = file.op_seq or 0
+        if state is None or state.snapshot_seq != snapshot_seq:
+            material = key_store.get(db, file, file.owner_id)
+            if material is None:
+                raise LookupError(f"No key material for file {file.id}")
+            content = storage.read_decrypted(file.blob_hash, file.content, material.key, material.iv,
+                                             material.segment_size, file.compression)
+            try:
+                text = content.decode("utf-8")
+            except UnicodeDecodeError:
+                raise InvalidOperation("Binary files cannot be edited with operations")
+            state = DocumentState(text, snapshot_seq, snapshot_seq, material.key)
+        elif state.seq == self.latest_seq(db, file):
+            return state
+        # Replay what the cached text lacks: pushes since the snapshot, or since this worker last looked
+        rows = (db.query(DocumentOp)
+                .filter(DocumentOp.file_id == file.id, DocumentOp.seq > state.seq)
+                .order_by(DocumentOp.seq).all())
+        text, seq = state.text, state.seq
+        for row in rows:
+            text = apply_ops(text, json.loads(decrypt_data(row.payload, state.key, row.iv)))
+            seq = row.seq
+        state = state._replace(text=text, seq=seq)
+        self.cache.put(key, state)
+        return state
+
+    def has_pending(self, db: Session, file: File) -> bool:
+        return self.latest_seq(db, file) > (file.op_seq or 0)
+
+    def content(self, db: Session, file: File) -> Optional[DocumentState]:
+        """The current document if it has pushes not yet compacted, else None (read the blob)."""
+        if not self.has_pending(db, file):
+            return None
+        with self.lock(file.id):
+            return self._load(db, file)
+
+    def push(self, db: Session, file: File, user_id: int, base: int, ops: List[Dict[str, Any]]) -> int:
+        """Apply a batch of operations made against `base`; returns the new sequence number."""
+        if not ops or len(ops) > MAX_OPS_PER_PUSH:
+            raise InvalidOperation(f"A push carries 1 to {MAX_OPS_PER_PUSH} operations")
+        with self.lock(file.id):
+            state = self._load(db, file)
+            if base != state.seq:
+                raise SequenceConflict(state.seq)
+            text = apply_ops(state.text, ops)
+            seq = state.seq + 1
+            encrypted = encrypt_data(json.dumps(ops, separators=(",", ":")).encode(), state.key)
+            # Takes the write lock and checks no other worker replaced the blob meanwhile
+            touched = db.query(File).filter(File.id == file.id, File.op_seq == state.snapshot_seq).update(
+                {File.op_seq: File.op_seq}, synchronize_session=False
+            )
+            if touched != 1:
+                db.rollback()
+                self.forget(file.id)
+                raise SequenceConflict(state.seq)
+            db.add(DocumentOp(file_id=file.id, seq=seq, user_id=user_id,
+                              payload=encrypted["encrypted_data"], iv=encrypted["iv"]))
+            try:
+                db.commit()
+            except IntegrityError:
+                # Another worker appended this sequence number first
+                db.rollback()
+                self.forget(file.id)
+                raise SequenceConflict(state.seq)
+            self.cache.put(_cache_key(file), state._replace(text=text, seq=seq))
+            return seq
+
+    def since(self, db: Session, file: File, seq: int) -> Optional[List[Dict[str, Any]]]:
+        """Pushes after `seq`, oldest first, or None if they were already compacted away."""
+        if seq < (file.op_seq or 0):
+            return None
+        material = key_store.get(db, file, file.owner_id)
+        if material is None:
+            return None
+        rows = (db.query(DocumentOp)
+                .filter(DocumentOp.file_id == file.id, DocumentOp.seq > seq)
+                .order_by(DocumentOp.seq).all())
+        return [{"seq": row.seq, "user_id": row.user_id,
+                 "ops": json.loads(decrypt_data(row.payload, material.key, row.iv))} for row in rows]
+
+    def _fold(self, db: Session, file: File, content: bytes, op_seq: int):
+        """Write `content` as the file's blob containing every push up to `op_seq`, then drop those pushes."""
+        file.op_seq = op_seq
+        FileWriteService(db).replace_content(file, file.owner_id, content)
+        db.query(DocumentOp).filter(DocumentOp.file_id == file.id, DocumentOp.seq <= op_seq).delete(
+            synchronize_session=False
+        )
+        db.commit()
+
+    def compact(self, db: Session, file: File) -> int:
+        """Fold pending pushes into an encrypted snapshot; returns how many were folded."""
+        with self.lock(file.id):
+            state = self._load(db, file)
+            folded = state.seq - state.snapshot_seq
+            if folded == 0:
+                return 0
+            self._fold(db, file, state.text.encode("utf-8"), state.seq)
+            self.cache.put(_cache_key(file), DocumentState(state.text, state.seq, state.seq,
+                                                           key_store.get(db, file, file.owner_id).key))
+            return folded
+
+    def replace(self, db: Session, file: File, content: bytes) -> File:
+        """A full upload: replaces the document and supersedes any pending pushes."""
+        with self.lock(file.id):
+            latest = db.query(func.max(DocumentOp.seq)).filter(DocumentOp.file_id == file.id).scalar()
+            # Counts as a step, so pushes based on the old text are refused
+            op_seq = max(latest or 0, file.op_seq or 0) + 1
+            self.forget(file.id)
+            self._fold(db, file, content, op_seq)
+            return file
+
+
+document_log = DocumentLog()
+
+
+def compact_due(db: Session, min_ops: int = COMPACT_OPS, max_age: float = COMPACT_AGE) -> List[int]:
+    """Files with enough pending pushes, or pushes pending long enough, to compact."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+    rows = (db.query(DocumentOp.file_id)
+            .join(File, File.id == DocumentOp.file_id)
+            .filter(DocumentOp.seq > func.coalesce(File.op_seq, 0))
+            .group_by(DocumentOp.file_id)
+            .having((func.count() >= min_ops) | (func.min(DocumentOp.created_at) < cutoff))
+            .all())
+    return [file_id for file_id, in rows]
+
+
+def compact_once() -> Dict:
+    start = time.monotonic()
+    documents = pushes = 0
+    db = SessionLocal()
+    try:
+        for file_id in compact_due(db):
+            file = db.query(File).filter(File.id == file_id).first()
+            if file is None:
+                continue
+            try:
+                folded = document_log.compact(db, file)
+            except (LookupError, InvalidOperation):
+                # Keys gone (owner logged out) or not a text document; retried next pass
+                db.rollback()
+                continue
+            documents += folded > 0
+            pushes += folded
+    finally:
+        db.close()
+    return {"rows": {"documents": documents, "pushes": pushes}, "seconds": round(time.monotonic() - start, 3)}
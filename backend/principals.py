@@ -0,0 +1,186 @@
+"""
+Cache of authenticated principals.
+
+Every authenticated request used to decode its JWT and then SELECT the user
+row. The token → user snapshot mapping is stable for the life of the token
+unless the user is disabled, changes role or logs out (bumping their
+epochs), so it is cached in a bounded LRU/TTL cache shared by the FastAPI
+and Flask entry points.
+
+Entries are dropped explicitly when a user logs out and, through SQLAlchemy
+events, when a commit changes `User.disabled`, `User.role` or an epoch, or
+deletes the user. Bulk `query(...).update()` calls bypass attribute events;
+code that changes those columns in bulk must call
+`principal_cache.invalidate_user`.
+
+Each process has its own cache, so an invalidation also bumps the user's
+revocation generation, shared by every process on the host: a fixed array
+of SECUREPLUS_PRINCIPAL_GENERATION_SLOTS 64-bit counters, indexed by a
+hash of the username, in the memory-mapped
+SECUREPLUS_PRINCIPAL_GENERATION_FILE (every process must agree on the
+slot count). Entries are stamped with their user's generation, read before
+the user row was, and a hit from an older generation is revalidated
+against the database. A logout in one worker therefore takes effect in all
+of them (and in the Flask server) on their next request, while other users'
+entries stay cached (barring a shared slot), and a lookup racing the
+logout can never write a stale principal back that outlives it. The file
+never grows past its slot array.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Hashable, NamedTuple, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.base import NO_VALUE
+
+from .cache import LRUCache
+from .models import User
+
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("SECUREPLUS_PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("SECUREPLUS_PRINCIPAL_CACHE_TTL", 60))
+GENERATION_FILE = os.environ.get("SECUREPLUS_PRINCIPAL_GENERATION_FILE",
+                                 os.path.join("database", "principals.generation"))
+GENERATION_SLOTS = int(os.environ.get("SECUREPLUS_PRINCIPAL_GENERATION_SLOTS", 4096))
+
+_SLOT = struct.Struct("<Q")
+
+
+class Principal(NamedTuple):
+    id: int
+    username: str
+    role: str
+    disabled: bool
+    session_epoch: int = 0
+    key_epoch: int = 0
+
+    @classmethod
+    def from_user(cls, user: User) -> "Principal":
+        return cls(user.id, user.username, user.role, bool(user.disabled),
+                   user.session_epoch or 0, user.key_epoch or 0)
+
+
+class Generations:
+    """Per-username revocation counters in a memory-mapped file shared across processes."""
+
+    def __init__(self, path: str = GENERATION_FILE, slots: int = GENERATION_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    def _mapped(self) -> mmap.mmap:
+        if self._map is None:
+            with self._lock:
+                if self._map is None:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    size = self.slots * _SLOT.size
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    try:
+                        # Only ever extended (zero-filled), so concurrent creators agree
+                        if os.fstat(fd).st_size < size:
+                            os.ftruncate(fd, size)
+                        self._map = mmap.mmap(fd, size)
+                    finally:
+                        os.close(fd)
+        return self._map
+
+    def _offset(self, username: str) -> int:
+        # crc32 rather than hash(): every process must pick the same slot
+        return zlib.crc32(username.encode()) % self.slots * _SLOT.size
+
+    def get(self, username: str) -> int:
+        return _SLOT.unpack_from(self._mapped(), self._offset(username))[0]
+
+    def bump(self, username: str):
+        # Racing bumps may both write the same value; either way it differs from
+        # what entries loaded before them were stamped with
+        mapped, offset = self._mapped(), self._offset(username)
+        _SLOT.pack_into(mapped, offset, _SLOT.unpack_from(mapped, offset)[0] + 1)
+
+
+class PrincipalCache:
+    def __init__(self, cache: LRUCache, generations: Optional[Generations] = None):
+        self.cache = cache
+        self.generations = generations or Generations()
+
+    def generation(self, username: str) -> int:
+        """The user's host-wide revocation generation; read it before loading their row."""
+        return self.generations.get(username)
+
+    def get(self, token: Hashable) -> Optional[Principal]:
+        entry = self.cache.get(token)
+        if entry is None:
+            return None
+        principal, expires_at, generation = entry
+        # The cache TTL may outlive the token itself; a revocation anywhere outdates the user's entries
+        if (expires_at is not None and expires_at <= time.time()) or \
+                generation != self.generation(principal.username):
+            self.cache.pop(token)
+            return None
+        return principal
+
+    def put(self, token: Hashable, principal: Principal, expires_at: Optional[float] = None,
+            generation: Optional[int] = None):
+        """Cache a principal loaded under `generation` (by default the user's current one)."""
+        if generation is None:
+            generation = self.generation(principal.username)
+        self.cache.put(token, (principal, expires_at, generation))
+
+    def invalidate_user(self, user_id: int, username: str) -> int:
+        # Other processes see the new generation; this one can drop the entries outright
+        self.generations.bump(username)
+        return self.cache.discard_where(lambda token, entry: entry[0].id == user_id)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+principal_cache = PrincipalCache(LRUCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL))
+
+_CHANGED = "principals_changed"
+
+
+def _mark_changed(user: User):
+    session = object_session(user)
+    if session is None:
+        if user.id is not None:
+            principal_cache.invalidate_user(user.id, user.username)
+        return
+    # Capture the username now; after the commit the row may be expired or deleted
+    session.info.setdefault(_CHANGED, set()).add((user.id, user.username))
+
+
+@event.listens_for(User.disabled, "set")
+@event.listens_for(User.role, "set")
+@event.listens_for(User.session_epoch, "set")
+@event.listens_for(User.key_epoch, "set")
+def _on_principal_attribute_set(target, value, oldvalue, initiator):
+    if oldvalue is NO_VALUE or value != oldvalue:
+        _mark_changed(target)
+
+
+@event.listens_for(User, "after_delete")
+def _on_user_delete(mapper, connection, target):
+    _mark_changed(target)
+
+
+# Invalidate only once the change is visible to other sessions; dropping the
+# entry earlier would let a concurrent request re-cache the old row
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    for user_id, username in session.info.pop(_CHANGED, ()):
+        if user_id is not None:
+            principal_cache.invalidate_user(user_id, username)
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop(_CHANGED, None)
@@ -0,0 +1,105 @@
+"""
+Socket.IO client manager that fans events out across local worker processes.
+
+The default manager only knows the clients connected to its own process,
+so `emit(..., room=game_id)` misses players whose socket landed on another
+worker. SQLiteQueueManager is a python-socketio PubSubManager (the base of
+its Redis and Kombu managers) whose channel is an append-only table in a
+small SQLite file: `_publish` inserts a row, and each worker's listener
+polls for rows past the last id it has seen and replays them locally.
+Enabled with SECUREPLUS_SOCKETIO_MANAGER=sqlite; every worker on the
+machine must point SECUREPLUS_SOCKETIO_QUEUE_URL at the same file.
+
+The listener polls again at once while messages keep arriving and backs
+off to SECUREPLUS_SOCKETIO_POLL_INTERVAL seconds when the queue is idle,
+which bounds the added delivery latency. Rows older than
+SECUREPLUS_SOCKETIO_RETENTION seconds are deleted by whichever listener's
+turn it is to trim; a worker that stalls for longer misses them, as it
+would messages sent while a Redis subscriber is disconnected.
+"""
+
+import os
+import time
+
+from socketio import PubSubManager
+from sqlalchemy import text
+
+from .engine import make_engines
+
+SOCKETIO_MANAGER = os.environ.get("SECUREPLUS_SOCKETIO_MANAGER", "local")
+SOCKETIO_QUEUE_URL = os.environ.get("SECUREPLUS_SOCKETIO_QUEUE_URL", "sqlite:///database/socketio.db")
+POLL_INTERVAL = float(os.environ.get("SECUREPLUS_SOCKETIO_POLL_INTERVAL", 0.01))
+RETENTION = float(os.environ.get("SECUREPLUS_SOCKETIO_RETENTION", 60))
+FETCH_BATCH = 500
+
+
+class SQLiteQueueManager(PubSubManager):
+    name = 'sqlitequeue'
+
+    def __init__(self, url=SOCKETIO_QUEUE_URL, channel='socketio', write_only=False, logger=None,
+                 json=None, poll_interval=POLL_INTERVAL, retention=RETENTION):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.engine = make_engines(url, "production").write
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS socketio_messages ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " channel TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " created_at REAL NOT NULL"
+                ")"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_socketio_messages_created_at ON socketio_messages (created_at)"
+            ))
+
+    def _sleep(self, seconds):
+        # Cooperative under eventlet/gevent when attached to a server
+        if self.server is not None:
+            self.server.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _publish(self, data):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO socketio_messages (channel, payload, created_at) VALUES (:channel, :payload, :now)"),
+                {"channel": self.channel, "payload": self.json.dumps(data), "now": time.time()},
+            )
+
+    def _trim(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM socketio_messages WHERE created_at < :cutoff"),
+                         {"cutoff": time.time() - self.retention})
+
+    def _listen(self):
+        # Only messages published from now on, like a pub/sub subscription
+        with self.engine.connect() as conn:
+            last_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM socketio_messages")).scalar()
+        next_trim = time.monotonic() + self.retention
+        while True:
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    text("SELECT id, payload FROM socketio_messages WHERE id > :last_id AND channel = :channel "
+                         "ORDER BY id LIMIT :limit"),
+                    {"last_id": last_id, "channel": self.channel, "limit": FETCH_BATCH},
+                ).all()
+            for row in rows:
+                last_id = row.id
+                yield row.payload
+            if time.monotonic() >= next_trim:
+                next_trim = time.monotonic() + self.retention
+                self._trim()
+            if not rows:
+                self._sleep(self.poll_interval)
+
+
+def make_client_manager(manager: str = SOCKETIO_MANAGER):
+    """The client_manager to pass to SocketIO, or None for the default in-process one."""
+    if manager == "local":
+        return None
+    if manager == "sqlite":
+        return SQLiteQueueManager()
+    raise ValueError(f"Unknown Socket.IO manager {manager!r}; expected local or sqlite")
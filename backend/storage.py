@@ -0,0 +1,252 @@
+"""
+Encrypted file content I/O.
+
+Uploads are read and encrypted in fixed-size chunks and the ciphertext is
+streamed straight into the blob store, so memory use stays bounded by the
+chunk size instead of growing with the file. Reads go through the same
+chunked path and can start at any offset. Large files may be stored as
+independently keyed segments (see crypto.py); every reader here takes the
+file's segment size, 0 meaning a single CFB stream. Chunked files (see
+chunkstore.py) are read through their manifest, which these functions
+detect on their own, so callers treat both layouts alike. Content may be
+compressed before encryption (see compression.py); readers take the codec
+recorded with it and decompress as they go.
+"""
+
+import asyncio
+import collections
+import io
+import os
+from typing import Iterator, Optional
+
+from . import blobstore, chunkstore, compression as codecs
+from .crypto import (
+    new_cipher, segment_params, crypt_segment, decrypt_payload, run_crypto,
+    crypto_executor, CRYPTO_WORKERS
+)
+
+# Size of the blocks read from the request body and fed to the cipher
+CHUNK_SIZE = int(os.environ.get("SECUREPLUS_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+# AES block size; CFB decryption can be restarted on any multiple of it
+BLOCK_SIZE = 16
+
+
+async def _read_segment(upload, size: int) -> bytes:
+    parts = []
+    remaining = size
+    while remaining > 0:
+        chunk = await upload.read(remaining)
+        if not chunk:
+            break
+        parts.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(parts)
+
+
+async def encrypt_upload(upload, key: bytes, iv: bytes, segment_size: int = 0,
+                         chunk_size: int = CHUNK_SIZE, compression: Optional[str] = None) -> "blobstore.BlobWriter":
+    """Encrypt an UploadFile chunk by chunk into a pending blob.
+
+    Encryption and disk writes run on the crypto pool, never on the event
+    loop. With a segment size, up to CRYPTO_WORKERS segments are encrypted
+    in parallel and written back in order; with a codec, each chunk is
+    compressed on its way into a single CFB stream (segments are laid out
+    on plaintext offsets, so the two don't combine). The caller commits the
+    returned writer (a database operation) or discards it; its
+    `content_size` is the plaintext size.
+    """
+    if compression and segment_size:
+        raise ValueError("Compressed uploads are encrypted as a single stream")
+    loop = asyncio.get_running_loop()
+    writer = blobstore.BlobWriter()
+    writer.content_size = 0
+    try:
+        if segment_size:
+            pending = collections.deque()
+            index = 0
+            while True:
+                segment = await _read_segment(upload, segment_size)
+                writer.content_size += len(segment)
+                if segment:
+                    pending.append(loop.run_in_executor(crypto_executor, crypt_segment, segment, key, iv, index))
+                    index += 1
+                # Keep at most one segment per worker in flight to bound memory
+                while pending and (not segment or len(pending) >= CRYPTO_WORKERS):
+                    await loop.run_in_executor(crypto_executor, writer.write, await pending.popleft())
+                if not segment:
+                    break
+        else:
+            encryptor = new_cipher(key, iv).encryptor()
+            compressor = codecs.get_codec(compression).compressor() if compression else None
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                writer.content_size += len(chunk)
+                await run_crypto(_encrypt_and_write, encryptor, writer, chunk, compressor, size=len(chunk))
+            if compressor is not None:
+                writer.write(encryptor.update(compressor.flush()))
+            writer.write(encryptor.finalize())
+        return writer
+    except BaseException:
+        writer.discard()
+        raise
+
+
+async def encrypt_upload_chunked(upload, key: bytes, file_type: Optional[str] = None,
+                                 chunk_size: int = chunkstore.CHUNK_SIZE) -> "chunkstore.ManifestWriter":
+    """Encrypt an UploadFile into pending manifest chunks, each compressed on its own.
+
+    Up to CRYPTO_WORKERS chunks are compressed and encrypted in parallel.
+    The caller commits the returned writer or discards it, as with
+    encrypt_upload().
+    """
+    loop = asyncio.get_running_loop()
+    writer = chunkstore.ManifestWriter(key, file_type)
+    pending = collections.deque()
+    try:
+        while True:
+            chunk = await _read_segment(upload, chunk_size)
+            if chunk:
+                pending.append(loop.run_in_executor(crypto_executor, writer.encrypt, chunk))
+            while pending and (not chunk or len(pending) >= CRYPTO_WORKERS):
+                writer.append(await pending.popleft())
+            if not chunk:
+                break
+        return writer
+    except BaseException:
+        # Chunks still being encrypted leave files behind too
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if not isinstance(result, BaseException):
+                writer.append(result)
+        writer.discard()
+        raise
+
+
+def _encrypt_and_write(encryptor, writer, chunk: bytes, compressor=None):
+    if compressor is not None:
+        chunk = compressor.compress(chunk)
+    writer.write(encryptor.update(chunk))
+
+
+def _iter_stream_range(f, key: bytes, iv: bytes, base: int, start: int, length: int,
+                       chunk_size: int) -> Iterator[bytes]:
+    # CFB decryption restarts at any block boundary with the previous
+    # ciphertext block as the IV; `base` is where this CFB stream begins
+    block = start // BLOCK_SIZE
+    if block == 0:
+        block_iv = iv
+    else:
+        f.seek(base + (block - 1) * BLOCK_SIZE)
+        block_iv = f.read(BLOCK_SIZE)
+    f.seek(base + block * BLOCK_SIZE)
+    decryptor = new_cipher(key, block_iv).decryptor()
+
+    skip = start - block * BLOCK_SIZE
+    remaining = length
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining + skip))
+        if not chunk:
+            break
+        plain = decryptor.update(chunk)
+        if skip:
+            plain = plain[skip:]
+            skip = 0
+        plain = plain[:remaining]
+        remaining -= len(plain)
+        yield plain
+
+
+def iter_decrypted_range(f, key: bytes, iv: bytes, start: int, length: int, segment_size: int = 0,
+                         chunk_size: int = CHUNK_SIZE, compression: Optional[str] = None) -> Iterator[bytes]:
+    """Yield `length` plaintext bytes starting at `start` from a ciphertext file object.
+
+    In CFB mode each block is decrypted with the previous ciphertext block as
+    its input, so decryption can begin at any block boundary by using the
+    preceding ciphertext block as the IV; nothing before it is decrypted.
+    Segmented files do the same inside the segment holding `start`; chunked
+    files decrypt only the chunks the range covers. A compressed stream has
+    no such entry points: it is decrypted and decompressed from the start,
+    still chunk by chunk, and the bytes before `start` are skipped. Only
+    files under chunkstore.CHUNKED_THRESHOLD are stored that way; larger
+    compressible content is chunked, with a codec per chunk.
+    """
+    if isinstance(f, chunkstore.Manifest):
+        yield from f.iter_range(key, start, length)
+        return
+    if compression:
+        size = f.seek(0, io.SEEK_END)
+        plain = codecs.iter_decompressed(
+            compression, iter_decrypted_range(f, key, iv, 0, size, segment_size, chunk_size)
+        )
+        yield from _slice_stream(plain, start, length)
+        return
+    if not segment_size:
+        yield from _iter_stream_range(f, key, iv, 0, start, length, chunk_size)
+        return
+    position = start
+    end = start + length
+    while position < end:
+        index = position // segment_size
+        base = index * segment_size
+        take = min(end, base + segment_size) - position
+        segment_key, segment_iv = segment_params(key, iv, index)
+        yield from _iter_stream_range(f, segment_key, segment_iv, base, position - base, take, chunk_size)
+        position += take
+
+
+def _slice_stream(chunks: Iterator[bytes], start: int, length: int) -> Iterator[bytes]:
+    for chunk in chunks:
+        if length <= 0:
+            break
+        if start >= len(chunk):
+            start -= len(chunk)
+            continue
+        piece = chunk[start:start + length]
+        start = 0
+        length -= len(piece)
+        yield piece
+
+
+def iter_decrypted(f, key: bytes, iv: bytes, segment_size: int = 0, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield the plaintext of a ciphertext file object chunk by chunk."""
+    if isinstance(f, chunkstore.Manifest):
+        return f.iter_range(key, 0, f.size)
+    size = f.seek(0, io.SEEK_END)
+    f.seek(0)
+    return iter_decrypted_range(f, key, iv, 0, size, segment_size, chunk_size)
+
+
+def open_ciphertext(blob_hash: Optional[str], content: Optional[bytes]):
+    """Open stored ciphertext for reading, whether it is in the blob store or inline.
+
+    A chunked file comes back as its Manifest, which the readers above accept.
+    """
+    if blob_hash:
+        f = blobstore.open_blob(blob_hash)
+        if f.read(len(chunkstore.MAGIC)) == chunkstore.MAGIC:
+            with f:
+                return chunkstore.Manifest.decode(chunkstore.MAGIC + f.read())
+        f.seek(0)
+        return f
+    return io.BytesIO(content or b"")
+
+
+def ciphertext_size(blob_hash: Optional[str], content: Optional[bytes]) -> int:
+    # CFB is a stream mode, so the plaintext is exactly as long as the ciphertext
+    if blob_hash:
+        manifest = chunkstore.load(blob_hash)
+        return manifest.size if manifest else blobstore.blob_size(blob_hash)
+    return len(content or b"")
+
+
+def read_decrypted(blob_hash: Optional[str], content: Optional[bytes], key: bytes, iv: bytes,
+                   segment_size: int = 0, compression: Optional[str] = None) -> bytes:
+    """Decrypt (and decompress) a whole stored file into memory, in parallel when it is segmented."""
+    if blob_hash:
+        content = blobstore.read_blob(blob_hash)
+        if content.startswith(chunkstore.MAGIC):
+            # Chunks record their own codecs
+            return chunkstore.Manifest.decode(content).read(key)
+    return codecs.decompress(compression, decrypt_payload(content or b"", key, iv, segment_size))
@@ -0,0 +1,241 @@
+"""
+Resumable, parallel chunked uploads.
+
+A client opens a session with the file's name and size, then PUTs the
+chunks by index, in any order and over as many connections as it likes,
+each with the SHA-256 of its plaintext, and finally asks for the session to
+be finalized. A dropped connection costs one chunk: GET on the session
+lists what has arrived, and re-sending a chunk simply replaces it.
+
+The session holds the file's key from the start, so each chunk is checked
+against its checksum and encrypted as it arrives, exactly as chunkstore.py
+encrypts a chunk (own IV, keyed MAC, compressed first where that pays). The
+ciphertext waits under UPLOAD_DIR/<session>/, named by its SHA-256, with a
+row in `upload_chunks`. Finalizing moves those files into the blob store
+as they are and writes a chunk manifest over them, so the file is never
+read back, decrypted or held in memory whole, and later edits of it only
+rewrite the chunks they touch.
+
+Sessions idle for SECUREPLUS_UPLOAD_SESSION_TTL seconds, and directories no
+session owns, are deleted by the sweeper (backend/maintenance.py); logging
+out makes a user's open sessions unusable at once through the key epoch,
+like their other keys.
+"""
+
+import datetime
+import hashlib
+import os
+import secrets
+import shutil
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import blobstore, chunkstore
+from .crypto import generate_iv, generate_key
+from .file_service import FileWriteService
+from .models import Blob, File, UploadChunk, UploadSession, User
+
+UPLOAD_DIR = os.environ.get("SECUREPLUS_UPLOAD_TEMP_DIR", os.path.join("temp_storage", "uploads"))
+SESSION_TTL = float(os.environ.get("SECUREPLUS_UPLOAD_SESSION_TTL", 24 * 3600))
+MAX_SESSIONS = int(os.environ.get("SECUREPLUS_UPLOAD_MAX_SESSIONS", 16))  # open at once, per user
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = int(os.environ.get("SECUREPLUS_UPLOAD_MAX_CHUNK_SIZE", 16 * 1024 * 1024))
+ORPHAN_GRACE = 300  # seconds before a directory without a session counts as garbage
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UploadIncomplete(Exception):
+    """Finalize was asked for before every chunk arrived."""
+
+    def __init__(self, missing: List[int]):
+        super().__init__(f"{len(missing)} chunks missing")
+        self.missing = missing
+
+
+def session_dir(session_id: str) -> str:
+    return os.path.join(UPLOAD_DIR, session_id)
+
+
+def chunk_count(session: UploadSession) -> int:
+    return -(-session.size // session.chunk_size)
+
+
+def expected_length(session: UploadSession, index: int) -> int:
+    return min(session.chunk_size, session.size - index * session.chunk_size)
+
+
+def describe(db: Session, session: UploadSession) -> Dict:
+    received = [index for index, in db.query(UploadChunk.chunk_index)
+                .filter(UploadChunk.session_id == session.id).order_by(UploadChunk.chunk_index)]
+    return {"upload_id": session.id, "filename": session.filename, "size": session.size,
+            "chunk_size": session.chunk_size, "chunk_count": chunk_count(session), "received": received}
+
+
+def create_session(db: Session, user: User, filename: str, size: int,
+                   chunk_size: Optional[int] = None) -> UploadSession:
+    chunk_size = chunk_size or chunkstore.CHUNK_SIZE
+    if size < 0:
+        raise UploadError("size must not be negative")
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise UploadError(f"chunk_size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE}")
+    open_sessions = db.query(func.count(UploadSession.id)).filter(UploadSession.user_id == user.id).scalar()
+    if open_sessions >= MAX_SESSIONS:
+        raise UploadError(f"At most {MAX_SESSIONS} uploads may be open at once")
+    session = UploadSession(
+        id=secrets.token_hex(16),
+        user_id=user.id,
+        filename=filename,
+        file_type=filename.split('.')[-1] if '.' in filename else '',
+        size=size,
+        chunk_size=chunk_size,
+        key=generate_key(),
+        iv=generate_iv(),
+        epoch=user.key_epoch or 0,
+    )
+    db.add(session)
+    db.commit()
+    os.makedirs(session_dir(session.id), exist_ok=True)
+    return session
+
+
+def get_session(db: Session, session_id: str, user: User) -> Optional[UploadSession]:
+    """The user's session, unless it predates their current key epoch (they logged out since)."""
+    return db.query(UploadSession).filter(
+        UploadSession.id == session_id,
+        UploadSession.user_id == user.id,
+        func.coalesce(UploadSession.epoch, 0) >= (user.key_epoch or 0),
+    ).first()
+
+
+def store_chunk(session: UploadSession, index: int, data: bytes, checksum: str) -> UploadChunk:
+    """Check, encrypt and write one chunk to the session directory (no database access)."""
+    if not 0 <= index < chunk_count(session):
+        raise UploadError(f"chunk index must be between 0 and {chunk_count(session) - 1}")
+    if len(data) != expected_length(session, index):
+        raise UploadError(f"chunk {index} must be {expected_length(session, index)} bytes, got {len(data)}")
+    if hashlib.sha256(data).hexdigest() != checksum.strip().lower():
+        raise UploadError(f"chunk {index} does not match its checksum")
+    ciphertext, chunk = chunkstore.encrypt_chunk(session.key, chunkstore.derive_mac_key(session.key), data,
+                                                 session.file_type)
+    digest = hashlib.sha256(ciphertext).hexdigest()
+    path = os.path.join(session_dir(session.id), digest)
+    with open(path + ".part", "wb") as f:
+        f.write(ciphertext)
+    os.replace(path + ".part", path)
+    return UploadChunk(session_id=session.id, chunk_index=index, length=chunk.length, hash=digest,
+                       stored_size=len(ciphertext), iv=chunk.iv, mac=chunk.mac, codec=chunk.codec)
+
+
+def record_chunk(db: Session, chunk: UploadChunk):
+    """Make a stored chunk part of its session, replacing an earlier copy of the same index."""
+    # Touching the session takes the write lock before anything is read
+    touched = db.query(UploadSession).filter(UploadSession.id == chunk.session_id).update(
+        {UploadSession.last_activity: datetime.datetime.utcnow()}, synchronize_session=False
+    )
+    if not touched:
+        # Finalized, aborted or collected while this chunk was on its way
+        db.rollback()
+        _remove(os.path.join(session_dir(chunk.session_id), chunk.hash))
+        raise LookupError(chunk.session_id)
+    previous = db.query(UploadChunk.hash).filter(UploadChunk.session_id == chunk.session_id,
+                                                 UploadChunk.chunk_index == chunk.chunk_index).scalar()
+    db.merge(chunk)
+    db.commit()
+    if previous and previous != chunk.hash:
+        _remove(os.path.join(session_dir(chunk.session_id), previous))
+
+
+def finalize(db: Session, session: UploadSession) -> File:
+    """Turn a complete session into a file; the chunk files become its blobs without being read."""
+    # Deleting the session row first claims it: it takes the write lock, so chunk
+    # uploads still in flight either landed already or will find no session
+    if not db.query(UploadSession).filter(UploadSession.id == session.id).delete(synchronize_session=False):
+        db.rollback()
+        raise LookupError(session.id)
+    rows = (db.query(UploadChunk).filter(UploadChunk.session_id == session.id)
+            .order_by(UploadChunk.chunk_index).all())
+    missing = sorted(set(range(chunk_count(session))) - {row.chunk_index for row in rows})
+    if missing:
+        db.rollback()
+        raise UploadIncomplete(missing)
+    db.query(UploadChunk).filter(UploadChunk.session_id == session.id).delete(synchronize_session=False)
+
+    directory = session_dir(session.id)
+    moved = []
+    try:
+        chunks = []
+        for row in rows:
+            blobstore.put_file(db, os.path.join(directory, row.hash), row.hash, row.stored_size)
+            moved.append(row.hash)
+            chunks.append(chunkstore.Chunk(row.hash, row.length, row.iv, row.mac, row.codec))
+        manifest_hash = chunkstore.store_manifest(db, chunkstore.Manifest(chunks))
+        file = FileWriteService(db).create(session.user_id, session.filename, session.file_type, manifest_hash,
+                                           session.key, session.iv, content_size=session.size)
+    except BaseException:
+        db.rollback()
+        # The session is intact again; put its chunks back so it can be retried. A chunk
+        # identical to a blob stored before keeps that copy, which is still referenced
+        live = {digest for digest, in db.query(Blob.hash).filter(Blob.hash.in_(moved))} if moved else set()
+        db.rollback()
+        for digest in moved:
+            if not os.path.exists(blobstore.blob_path(digest)):
+                continue
+            if digest in live:
+                shutil.copyfile(blobstore.blob_path(digest), os.path.join(directory, digest))
+            else:
+                os.replace(blobstore.blob_path(digest), os.path.join(directory, digest))
+        raise
+    # Whatever is left is chunks superseded by a re-sent copy
+    shutil.rmtree(directory, ignore_errors=True)
+    return file
+
+
+def abort(db: Session, session: UploadSession):
+    db.query(UploadChunk).filter(UploadChunk.session_id == session.id).delete(synchronize_session=False)
+    db.query(UploadSession).filter(UploadSession.id == session.id).delete(synchronize_session=False)
+    db.commit()
+    shutil.rmtree(session_dir(session.id), ignore_errors=True)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def collect_stale(db: Session, ttl: float = SESSION_TTL, now: Optional[datetime.datetime] = None) -> Dict[str, int]:
+    """Delete idle sessions, chunk rows whose session is gone, and directories no session owns."""
+    now = now or datetime.datetime.utcnow()
+    stale = [session_id for session_id, in db.query(UploadSession.id).filter(
+        UploadSession.last_activity < now - datetime.timedelta(seconds=ttl))]
+    if stale:
+        db.query(UploadChunk).filter(UploadChunk.session_id.in_(stale)).delete(synchronize_session=False)
+        db.query(UploadSession).filter(UploadSession.id.in_(stale)).delete(synchronize_session=False)
+    # Sessions the reaper removed after a logout leave their chunk rows behind
+    db.query(UploadChunk).filter(
+        ~UploadChunk.session_id.in_(db.query(UploadSession.id))
+    ).delete(synchronize_session=False)
+    db.commit()
+
+    for session_id in stale:
+        shutil.rmtree(session_dir(session_id), ignore_errors=True)
+    removed = len(stale)
+    # A session's directory is made just after its row is committed, hence the grace period
+    names = [name for name in (os.listdir(UPLOAD_DIR) if os.path.isdir(UPLOAD_DIR) else [])
+             if time.time() - os.path.getmtime(os.path.join(UPLOAD_DIR, name)) >= ORPHAN_GRACE]
+    for start in range(0, len(names), 500):
+        batch = names[start:start + 500]
+        live = {session_id for session_id, in db.query(UploadSession.id).filter(UploadSession.id.in_(batch))}
+        for name in batch:
+            if name not in live:
+                shutil.rmtree(os.path.join(UPLOAD_DIR, name), ignore_errors=True)
+                removed += 1
+    db.commit()
+    return {"upload_sessions": len(stale), "upload_dirs": removed}
@@ -0,0 +1,259 @@
+"""
+Versioned backup history for files.
+
+Every write to a file appends a BackupStorage row to that file's version
+chain. Most versions are stored as an encrypted binary delta against the
+previous version; every SNAPSHOT_INTERVAL versions a full snapshot is taken
+instead, which simply shares the file's own blob. Restoring a version walks
+back to the nearest snapshot and replays the deltas after it, so the cost
+is bounded by the snapshot interval rather than the history length.
+
+Old versions are thinned by a RetentionPolicy (keep last N / hourly / daily)
+a snapshot group at a time: a snapshot goes together with the deltas that
+depend on it, so pruning never has to decrypt or re-encode anything.
+Deltas are compressed before encryption when that pays; snapshots sharing
+the file's blob carry the file's codec.
+
+Each version holds its own key, so like FileKey rows it is stamped with the
+owner's key_epoch. After logout or clear-traces older versions are
+invisible here (not listed, reconstructed or restored), and the reaper
+deletes them and releases their blobs.
+"""
+
+import datetime
+import os
+from typing import List, Optional, Set
+
+from sqlalchemy.orm import Session
+
+from . import blobstore, compression, storage
+from .crypto import encrypt_data
+from .delta import make_delta, apply_delta
+from .keystore import user_key_epoch
+from .models import BackupStorage
+
+SNAPSHOT_INTERVAL = int(os.environ.get("SECUREPLUS_BACKUP_SNAPSHOT_INTERVAL", 10))
+
+
+class RetentionPolicy:
+    """Which versions of a file to keep.
+
+    The newest `keep_last` versions are always kept, plus the newest version
+    in each of the last `keep_hourly` hours and `keep_daily` days.
+    """
+
+    def __init__(self, keep_last: int = 10, keep_hourly: int = 24, keep_daily: int = 7):
+        self.keep_last = keep_last
+        self.keep_hourly = keep_hourly
+        self.keep_daily = keep_daily
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            keep_last=int(os.environ.get("SECUREPLUS_BACKUP_KEEP_LAST", 10)),
+            keep_hourly=int(os.environ.get("SECUREPLUS_BACKUP_KEEP_HOURLY", 24)),
+            keep_daily=int(os.environ.get("SECUREPLUS_BACKUP_KEEP_DAILY", 7)),
+        )
+
+    def select(self, rows: List[BackupStorage], now: datetime.datetime) -> Set[int]:
+        """Return the version numbers to keep; `rows` is ordered oldest first."""
+        keep = {row.version for row in rows[-max(self.keep_last, 1):]}
+        hours = set()
+        days = set()
+        for row in reversed(rows):
+            hour = row.backup_at.replace(minute=0, second=0, microsecond=0)
+            if now - hour < datetime.timedelta(hours=self.keep_hourly) and hour not in hours:
+                hours.add(hour)
+                keep.add(row.version)
+            day = row.backup_at.date()
+            if (now.date() - day).days < self.keep_daily and day not in days:
+                days.add(day)
+                keep.add(row.version)
+        return keep
+
+
+def list_versions(db: Session, file_id: int, user_id: int, key_epoch: Optional[int] = None) -> List[BackupStorage]:
+    """The file's live versions, oldest first; those from before the user's key epoch are dead."""
+    if key_epoch is None:
+        key_epoch = user_key_epoch(db, user_id)
+    return db.query(BackupStorage).filter(
+        BackupStorage.file_id == file_id,
+        BackupStorage.user_id == user_id,
+        BackupStorage.version.isnot(None),
+        BackupStorage.user_epoch >= key_epoch
+    ).order_by(BackupStorage.version).all()
+
+
+def adopt_legacy_backups(db: Session, file, user_id: int, key: bytes, iv: bytes, segment_size: int = 0):
+    """Turn the single pre-versioning backup of a file into version 1 of its chain.
+
+    The old code always backed up exactly the file's current ciphertext, so
+    the file's key decrypts it. Anything that no longer matches the file
+    cannot be decrypted and is dropped.
+    """
+    legacy = db.query(BackupStorage).filter(
+        BackupStorage.file_id == file.id,
+        BackupStorage.user_id == user_id,
+        BackupStorage.version.is_(None)
+    ).all()
+    key_epoch = user_key_epoch(db, user_id)
+    adopted = bool(list_versions(db, file.id, user_id, key_epoch))
+    for row in legacy:
+        matches = (row.blob_hash is not None and row.blob_hash == file.blob_hash) or \
+            (row.backup_content is not None and row.backup_content == file.content)
+        if matches and not adopted:
+            row.version = 1
+            row.is_snapshot = True
+            row.backup_key = key
+            row.backup_iv = iv
+            row.segment_size = segment_size
+            row.compression = file.compression
+            row.user_epoch = key_epoch
+            row.content_size = file.content_size if file.content_size is not None else \
+                storage.ciphertext_size(row.blob_hash, row.backup_content)
+            adopted = True
+        else:
+            blobstore.release(db, row.blob_hash)
+            db.delete(row)
+    db.flush()
+
+
+def _read_row(row: BackupStorage) -> bytes:
+    return storage.read_decrypted(row.blob_hash, row.backup_content, row.backup_key, row.backup_iv,
+                                  row.segment_size or 0, row.compression)
+
+
+def _reconstruct(rows: List[BackupStorage], index: int) -> bytes:
+    start = index
+    while not rows[start].is_snapshot:
+        start -= 1
+    content = _read_row(rows[start])
+    for row in rows[start + 1:index + 1]:
+        content = apply_delta(content, _read_row(row))
+    return content
+
+
+def reconstruct(db: Session, file_id: int, user_id: int, version: int,
+                key_epoch: Optional[int] = None) -> Optional[bytes]:
+    """Plaintext of one version of a file, or None if it does not exist or predates `key_epoch`."""
+    rows = list_versions(db, file_id, user_id, key_epoch)
+    for index, row in enumerate(rows):
+        if row.version == version:
+            return _reconstruct(rows, index)
+    return None
+
+
+def _store_delta(db: Session, row: BackupStorage, base: bytes, content: bytes):
+    _store_encoded_delta(db, row, make_delta(base, content))
+
+
+def _store_encoded_delta(db: Session, row: BackupStorage, delta: bytes):
+    _store_payload(db, row, delta)
+    row.is_snapshot = False
+
+
+def _store_payload(db: Session, row: BackupStorage, data: bytes):
+    payload, row.compression = compression.pack(data)
+    encryption_result = encrypt_data(payload)
+    row.blob_hash = blobstore.put_bytes(db, encryption_result["encrypted_data"])
+    row.backup_key = encryption_result["key"]
+    row.backup_iv = encryption_result["iv"]
+    row.segment_size = 0
+
+
+def record_version(
+    db: Session,
+    file,
+    user_id: int,
+    key: bytes,
+    iv: bytes,
+    content: Optional[bytes] = None,
+    previous_content: Optional[bytes] = None,
+    policy: Optional[RetentionPolicy] = None,
+    segment_size: int = 0,
+    delta: Optional[bytes] = None,
+    compression: Optional[str] = None,
+    key_epoch: Optional[int] = None,
+) -> BackupStorage:
+    """Append the file's current content (already written, encrypted with key/iv) to its chain.
+
+    `content` is the new plaintext; without it a snapshot is taken.
+    `previous_content` saves reconstructing the previous version when the
+    caller already has it, and `delta` (from the previous version to
+    `content`) saves computing one, e.g. from a chunked write's splice.
+    `compression` is the codec of the file's blob, which a snapshot shares.
+    Dead versions from before the owner's key epoch are not built on; the
+    chain restarts with a snapshot.
+    """
+    if key_epoch is None:
+        key_epoch = user_key_epoch(db, user_id)
+    rows = list_versions(db, file.id, user_id, key_epoch)
+    since_snapshot = 0
+    for row in reversed(rows):
+        since_snapshot += 1
+        if row.is_snapshot:
+            break
+
+    row = BackupStorage(
+        user_id=user_id,
+        file_id=file.id,
+        version=rows[-1].version + 1 if rows else 1,
+        backup_at=datetime.datetime.utcnow(),
+        user_epoch=key_epoch,
+        content_size=len(content) if content is not None else file.content_size if file.content_size is not None
+        else storage.ciphertext_size(file.blob_hash, file.content),
+    )
+
+    if content is None or not rows or since_snapshot >= SNAPSHOT_INTERVAL:
+        # Full snapshot: share the file's blob and key rather than copying it
+        if file.blob_hash:
+            blobstore.acquire(db, file.blob_hash)
+            row.blob_hash = file.blob_hash
+        else:
+            row.backup_content = file.content
+        row.backup_key = key
+        row.backup_iv = iv
+        row.segment_size = segment_size
+        row.compression = compression
+        row.is_snapshot = True
+    elif delta is not None:
+        _store_encoded_delta(db, row, delta)
+    else:
+        if previous_content is None:
+            previous_content = _reconstruct(rows, len(rows) - 1)
+        _store_delta(db, row, previous_content, content)
+
+    db.add(row)
+    db.flush()
+    apply_retention(db, file.id, user_id, policy, key_epoch=key_epoch)
+    return row
+
+
+def apply_retention(db: Session, file_id: int, user_id: int, policy: Optional[RetentionPolicy] = None,
+                    now: Optional[datetime.datetime] = None, key_epoch: Optional[int] = None):
+    """Drop the snapshot groups holding no version the policy wants.
+
+    A group is a snapshot and the deltas that depend on it. Groups go
+    whole, oldest first, once a later snapshot is kept, so nothing is ever
+    re-encoded here; versions the policy would drop inside a kept group
+    stay until the whole group can go.
+    """
+    policy = policy or RetentionPolicy.from_env()
+    rows = list_versions(db, file_id, user_id, key_epoch)
+    keep = policy.select(rows, now or datetime.datetime.utcnow())
+    if len(keep) == len(rows):
+        return
+
+    groups: List[List[BackupStorage]] = []
+    for row in rows:
+        if row.is_snapshot or not groups:
+            groups.append([])
+        groups[-1].append(row)
+    # The newest group always holds the newest version, so it is always kept
+    for group in groups[:-1]:
+        if any(row.version in keep for row in group):
+            continue
+        for row in group:
+            blobstore.release(db, row.blob_hash)
+            db.delete(row)
+    db.flush()
@@ -0,0 +1,67 @@
+"""
+Authenticated-request throughput with and without the principal cache.
+
+Hits GET /users/me with a pool of user tokens and counts the queries against
+the users table. Runs against a throwaway database in a temporary directory.
+
+    python -m benchmarks.auth_throughput --requests 2000 --users 20
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("frontend", exist_ok=True)
+
+    from fastapi.testclient import TestClient
+    from backend.cache import LRUCache
+    from backend.main import app
+    from backend.models import read_engine
+    from backend.principals import principal_cache
+
+    user_queries = 0
+
+    def count_user_query(conn, cursor, statement, parameters, context, executemany):
+        nonlocal user_queries
+        if "FROM users" in statement:
+            user_queries += 1
+
+    event.listen(read_engine, "before_cursor_execute", count_user_query)
+
+    with TestClient(app) as client:
+        tokens = []
+        for i in range(args.users):
+            client.post("/register", json={"username": f"bench{i}", "password": "pw"})
+            response = client.post("/token", data={"username": f"bench{i}", "password": "pw"})
+            tokens.append({"Authorization": f"Bearer {response.json()['access_token']}"})
+
+        for label, cache in (("no cache", LRUCache(maxsize=0)), ("cached", principal_cache.cache)):
+            cache.clear()
+            cache.hits = cache.misses = 0
+            original, principal_cache.cache = principal_cache.cache, cache
+            user_queries = 0
+            start = time.perf_counter()
+            for i in range(args.requests):
+                client.get("/users/me", headers=tokens[i % len(tokens)]).raise_for_status()
+            elapsed = time.perf_counter() - start
+            principal_cache.cache = original
+            print(f"{label:>9}: {args.requests / elapsed:8.1f} req/s  "
+                  f"{user_queries / args.requests:5.3f} users queries/request  "
+                  f"hit ratio {cache.stats()['hit_ratio']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
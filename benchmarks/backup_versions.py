@@ -0,0 +1,99 @@
+"""
+Storage savings and restore latency of the versioned backup chain.
+
+Simulates a document that is edited repeatedly (a few small inserts and
+deletes per save), records a version per save and compares the bytes
+stored for the history against keeping a full copy of every version.
+Runs against a throwaway database in a temporary directory.
+
+    python -m benchmarks.backup_versions --size 200000 --edits 200
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=200_000, help="initial document size in bytes")
+    parser.add_argument("--edits", type=int, default=200, help="number of saves")
+    parser.add_argument("--snapshot-interval", type=int, default=10)
+    args = parser.parse_args()
+
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, repo)
+    os.chdir(tempfile.mkdtemp())
+    os.environ["SECUREPLUS_BACKUP_SNAPSHOT_INTERVAL"] = str(args.snapshot_interval)
+
+    from backend import blobstore, versioning
+    from backend.crypto import encrypt_data
+    from backend.models import SessionLocal, User, File, Blob
+
+    keep_all = versioning.RetentionPolicy(keep_last=args.edits + 1, keep_hourly=0, keep_daily=0)
+    random.seed(0)
+    words = [bytes(random.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(random.randint(2, 9)))
+             for _ in range(2000)]
+    document = bytearray(b" ".join(random.choice(words) for _ in range(args.size // 6))[:args.size])
+
+    db = SessionLocal()
+    user = User(username="bench", hashed_password="x")
+    db.add(user)
+    db.commit()
+    file = File(filename="bench.txt", file_type="txt", owner_id=user.id)
+    db.add(file)
+
+    def save(previous):
+        encryption_result = encrypt_data(bytes(document))
+        blob_hash = blobstore.put_bytes(db, encryption_result["encrypted_data"])
+        blobstore.release(db, file.blob_hash)
+        file.blob_hash = blob_hash
+        db.flush()
+        versioning.record_version(db, file, user.id, encryption_result["key"], encryption_result["iv"],
+                                  content=bytes(document), previous_content=previous, policy=keep_all)
+        db.commit()
+
+    save(None)
+    full_bytes = len(document)
+    start = time.perf_counter()
+    for _ in range(args.edits):
+        previous = bytes(document)
+        for _ in range(random.randint(1, 3)):
+            pos = random.randrange(len(document))
+            if random.random() < 0.6:
+                document[pos:pos] = b" " + random.choice(words)
+            else:
+                del document[pos:pos + random.randint(1, 40)]
+        save(previous)
+        full_bytes += len(document)
+    write_time = time.perf_counter() - start
+
+    rows = versioning.list_versions(db, file.id, user.id)
+    stored = 0
+    for row in rows:
+        if row.blob_hash and row.blob_hash != file.blob_hash:
+            stored += db.query(Blob).filter(Blob.hash == row.blob_hash).one().size
+    snapshots = sum(1 for row in rows if row.is_snapshot)
+
+    latencies = []
+    for row in rows:
+        t0 = time.perf_counter()
+        versioning.reconstruct(db, file.id, user.id, row.version)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    latencies.sort()
+
+    print(f"versions: {len(rows)} ({snapshots} snapshots, interval {args.snapshot_interval})")
+    print(f"full copies: {full_bytes / 1e6:8.2f} MB")
+    print(f"chain:       {stored / 1e6:8.2f} MB  ({100 * stored / full_bytes:.1f}% of full copies, "
+          f"live file blob shared by the latest snapshot not counted)")
+    print(f"save:        {1000 * write_time / args.edits:8.2f} ms/version")
+    print(f"restore:     p50 {statistics.median(latencies):.2f} ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms  max {latencies[-1]:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
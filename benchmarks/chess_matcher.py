@@ -0,0 +1,80 @@
+"""
+Per-move cost of chess auth-sequence matching.
+
+Compares the trie matcher (one cursor step per move) with the old check,
+which rescanned the game's whole move list against every sequence for its
+position on each move.
+
+    python -m benchmarks.chess_matcher --sequences 1,100,5000 --games 200 --moves 40
+"""
+
+import argparse
+import random
+import time
+
+from backend.chess_matcher import SequenceMatcher
+
+START = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+FILES = "abcdefgh"
+
+
+def random_move(rng):
+    return f"{rng.choice(FILES)}{rng.randint(1, 8)}-{rng.choice(FILES)}{rng.randint(1, 8)}"
+
+
+def rescan_matches(moves, sequences):
+    for sequence in sequences:
+        if len(moves) >= len(sequence) and all(moves[i] == move for i, move in enumerate(sequence)):
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sequences", default="1,100,5000")
+    parser.add_argument("--games", type=int, default=200)
+    parser.add_argument("--moves", type=int, default=40, help="moves per game")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for count in (int(n) for n in args.sequences.split(",")):
+        # Sequences share openings, as real ones do
+        openings = [[random_move(rng) for _ in range(2)] for _ in range(max(1, count // 50))]
+        sequences = [rng.choice(openings) + [random_move(rng) for _ in range(4)] for _ in range(count)]
+        matcher = SequenceMatcher()
+        for sequence in sequences:
+            matcher.add(START, sequence)
+
+        # Half the games play a registered sequence first, the rest play at random
+        games = []
+        for g in range(args.games):
+            prefix = list(rng.choice(sequences)) if g % 2 else []
+            games.append(prefix + [random_move(rng) for _ in range(args.moves - len(prefix))])
+        total_moves = sum(len(game) for game in games)
+
+        start = time.perf_counter()
+        trie_hits = 0
+        for game in games:
+            cursor = matcher.start(START)
+            for move in game:
+                cursor = matcher.advance(cursor, move)
+                trie_hits += matcher.matched(cursor) is not None
+        trie = (time.perf_counter() - start) / total_moves
+
+        # The rescan is quadratic; time a sample of games
+        sample = games[:max(1, min(len(games), 20000 // count))]
+        sample_moves = sum(len(game) for game in sample)
+        start = time.perf_counter()
+        for game in sample:
+            played = []
+            for move in game:
+                played.append(move)
+                rescan_matches(played, sequences)
+        rescan = (time.perf_counter() - start) / sample_moves
+
+        print(f"{count:>6} sequences: trie {1e6 * trie:8.2f} us/move   rescan {1e6 * rescan:10.2f} us/move   "
+              f"({rescan / trie:7.1f}x)  {trie_hits} matching moves")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Chess-sequence verification throughput with many registered users.
+
+Registers --users users with a random six-move sequence each (bulk inserted
+straight into a throwaway database), then calls POST /chess/verify-sequence
+for random users. For comparison it also times the old lookup, a plaintext
+compare against an unindexed column.
+
+    python -m benchmarks.chess_verify --users 100000 --requests 2000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+FILES = "abcdefgh"
+
+
+def random_sequence(rng):
+    return ", ".join(
+        f"{rng.choice(FILES)}{rng.randint(1, 8)}-{rng.choice(FILES)}{rng.randint(1, 8)}" for _ in range(6)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("frontend", exist_ok=True)
+
+    from fastapi.testclient import TestClient
+    from sqlalchemy import text
+    from backend.chess_auth import sequence_digest
+    from backend.main import app
+    from backend.models import engine
+
+    rng = random.Random(0)
+    sequences = [random_sequence(rng) for _ in range(args.users)]
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users (id, username, hashed_password, role, disabled) "
+                          "VALUES (:id, :name, 'x', 'user', 0)"),
+                     [{"id": i + 1, "name": f"user{i}"} for i in range(args.users)])
+        conn.execute(text("INSERT INTO chess_moves (user_id, sequence_digest) VALUES (:id, :digest)"),
+                     [{"id": i + 1, "digest": sequence_digest(s)} for i, s in enumerate(sequences)])
+        # Baseline: the plaintext column, unindexed as it used to be
+        conn.execute(text("CREATE TABLE plain_moves (user_id INTEGER, move_sequence TEXT)"))
+        conn.execute(text("INSERT INTO plain_moves VALUES (:id, :seq)"),
+                     [{"id": i + 1, "seq": s} for i, s in enumerate(sequences)])
+    print(f"seeded {args.users} users in {time.perf_counter() - start:.1f}s")
+
+    picks = [rng.randrange(args.users) for _ in range(args.requests)]
+    with TestClient(app) as client:
+        start = time.perf_counter()
+        for i in picks:
+            response = client.post("/chess/verify-sequence", json={"move_sequence": sequences[i]})
+            assert response.json()["username"] == f"user{i}"
+        elapsed = time.perf_counter() - start
+    print(f"  digest endpoint: {args.requests / elapsed:8.1f} verifies/s")
+
+    scans = min(args.requests, 200)
+    with engine.connect() as conn:
+        start = time.perf_counter()
+        for i in picks[:scans]:
+            conn.execute(text("SELECT user_id FROM plain_moves WHERE move_sequence = :s"),
+                         {"s": sequences[i]}).fetchall()
+        plain = (time.perf_counter() - start) / scans
+        start = time.perf_counter()
+        for i in picks[:scans]:
+            conn.execute(text("SELECT user_id FROM chess_moves WHERE sequence_digest = :d"),
+                         {"d": sequence_digest(sequences[i])}).fetchall()
+        digest = (time.perf_counter() - start) / scans
+    print(f"  plaintext scan : {1000 * plain:8.3f} ms/lookup")
+    print(f"  digest index   : {1000 * digest:8.3f} ms/lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Cost of small edits to large files, chunked against whole-blob storage.
+
+For each file size, makes --saves small edits (an in-place overwrite, an
+insert and an append, in turn) through FileWriteService.replace_content,
+once with chunking disabled (every save decrypts the old version for the
+backup delta, then re-encrypts and rewrites the whole file) and once
+chunked. Reports time per save and bytes written to the blob store per
+save, file and backup deltas included. Retention runs with the default
+policy, and --warmup saves go first so the timed ones are in the steady
+state where every save also prunes the history. Runs against a throwaway
+database in a temporary directory.
+
+    python -m benchmarks.chunked_updates --sizes 8,32,128 --saves 20 --warmup 25
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="8,32,128", help="file sizes in MiB")
+    parser.add_argument("--saves", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=25,
+                        help="untimed saves first, enough for retention to start pruning")
+    parser.add_argument("--chunk-size", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, repo)
+    os.chdir(tempfile.mkdtemp())
+    os.environ["SECUREPLUS_STORAGE_CHUNK_SIZE"] = str(args.chunk_size)
+
+    from backend import blobstore, chunkstore
+    from backend.file_service import FileWriteService
+    from backend.migrations import run_migrations
+    from backend.models import BackupStorage, SessionLocal, User
+
+    run_migrations()
+    db = SessionLocal()
+    user = User(username="bench", hashed_password="x")
+    db.add(user)
+    db.commit()
+
+    written = [0]
+    put_bytes = blobstore.put_bytes
+
+    def counting_put_bytes(session, data):
+        written[0] += len(data)
+        return put_bytes(session, data)
+
+    blobstore.put_bytes = counting_put_bytes
+
+    def edit(content, n, rng):
+        pos = rng.randrange(len(content))
+        if n % 3 == 0:
+            return content[:pos] + b"EDIT" + content[pos + 4:]
+        if n % 3 == 1:
+            return content[:pos] + b"inserted text " + content[pos:]
+        return content + b"appended line\n"
+
+    for size in (int(n) * 1024 * 1024 for n in args.sizes.split(",")):
+        results = {}
+        for mode, threshold in (("whole blob", float("inf")), ("chunked", 0)):
+            chunkstore.CHUNKED_THRESHOLD = threshold
+            rng = random.Random(size)
+            content = rng.randbytes(size)
+            file = FileWriteService(db).create_from_bytes(user.id, f"{mode}.bin", "bin", content)
+            # The first chunked save converts the file; leave it and the history's growth out of the timing
+            for n in range(args.warmup):
+                content = edit(content, n, rng)
+                FileWriteService(db).replace_content(file, user.id, content)
+            written[0] = 0
+            start = time.perf_counter()
+            for n in range(args.saves):
+                content = edit(content, n, rng)
+                FileWriteService(db).replace_content(file, user.id, content)
+            results[mode] = ((time.perf_counter() - start) / args.saves, written[0] / args.saves)
+            versions = db.query(BackupStorage).filter(BackupStorage.file_id == file.id).count()
+            print(f"{size >> 20:>5} MiB {mode}: {versions} versions kept after {args.warmup + args.saves + 1}")
+
+        (whole, whole_bytes), (chunked, chunked_bytes) = results["whole blob"], results["chunked"]
+        print(f"{size >> 20:>5} MiB: whole blob {1000 * whole:8.1f} ms {whole_bytes / 2**20:8.2f} MiB written   "
+              f"chunked {1000 * chunked:7.1f} ms {chunked_bytes / 2**20:6.2f} MiB written   "
+              f"({whole / chunked:5.1f}x faster, {whole_bytes / max(chunked_bytes, 1):6.1f}x less written)")
+
+
+if __name__ == "__main__":
+    main()
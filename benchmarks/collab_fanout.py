@@ -0,0 +1,140 @@
+"""
+Load test for /ws/document fan-out with hundreds of editors per document.
+
+Simulated sockets stand in for the network: each `send_text` takes a few
+hundred microseconds, and a share of the editors are slow consumers that
+take --slow-ms per message. A few editors type at --rate messages per
+second each; every message fans out to the rest of the room.
+
+Reports how long the sender's receive loop is held per message (what
+stalled every peer before), delivered messages per second, send latency,
+drops and peak queue depth, for the old sequential broadcast loop and the
+room manager under each policy.
+
+    python -m benchmarks.collab_fanout --editors 300 --senders 5 --messages 50 --rate 10 --slow 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import deque
+
+# Importing the backend opens its database in the working directory; keep that throwaway
+os.chdir(tempfile.mkdtemp())
+
+from backend.collab import POLICIES, RoomManager
+from backend.principals import Principal
+
+
+class FakeSocket:
+    def __init__(self, delay):
+        self.delay = delay
+        self.received = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data):
+        await asyncio.sleep(self.delay)
+        self.received += 1
+
+    async def close(self):
+        pass
+
+
+def make_sockets(args, rng):
+    return [FakeSocket(args.slow_ms / 1000 if rng.random() < args.slow else args.fast_ms / 1000)
+            for _ in range(args.editors)]
+
+
+def message(sender, n):
+    # Every fourth message is a cursor move, which the coalesce policy may merge
+    kind = "cursor" if n % 4 else "insert"
+    return json.dumps({"type": kind, "user_id": sender, "pos": n})
+
+
+async def run_sequential(args):
+    sockets = make_sockets(args, random.Random(0))
+    holds = []
+    start = time.perf_counter()
+
+    async def sender(index):
+        for n in range(args.messages):
+            began = time.perf_counter()
+            data = message(index, n)
+            for i, socket in enumerate(sockets):
+                if i != index:
+                    await socket.send_text(data)
+            holds.append(time.perf_counter() - began)
+            await asyncio.sleep(1 / args.rate)
+
+    await asyncio.gather(*(sender(i) for i in range(args.senders)))
+    elapsed = time.perf_counter() - start
+    delivered = sum(socket.received for socket in sockets)
+    print(f"{'sequential':>12}: hold p50 {1000 * statistics.median(holds):8.2f} ms  max {1000 * max(holds):8.1f} ms  "
+          f"delivered {delivered:>7} ({delivered / elapsed:8.0f}/s)  in {elapsed:5.1f}s")
+
+
+async def run_rooms(args, policy):
+    # Every editor may edit the document; access checks are not what is measured
+    manager = RoomManager(queue_size=args.queue_size, policy=policy, authorize=lambda principal, file_id: True)
+    manager.latencies = deque()  # keep every sample, not just the recent window /metrics serves
+    sockets = make_sockets(args, random.Random(0))
+    peers = [await manager.join(1, socket, Principal(i, f"editor{i}", "user", False))
+             for i, socket in enumerate(sockets)]
+    holds, peak = [], 0
+    start = time.perf_counter()
+
+    async def sender(index):
+        nonlocal peak
+        for n in range(args.messages):
+            began = time.perf_counter()
+            manager.broadcast(1, message(index, n), sender=peers[index])
+            holds.append(time.perf_counter() - began)
+            peak = max(peak, manager.stats()["queue_depth_max"]) if n % 20 == 0 else peak
+            await asyncio.sleep(1 / args.rate)
+
+    await asyncio.gather(*(sender(i) for i in range(args.senders)))
+    # Let the queues drain
+    while any(peer.queue for peer in peers) and time.perf_counter() - start < 120:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    stats = manager.stats()
+    for peer in peers:
+        await manager.leave(peer)
+    delivered = sum(socket.received for socket in sockets)
+    latency = stats["send_latency_ms"] or {"p50": 0, "p99": 0}
+    print(f"{policy:>12}: hold p50 {1000 * statistics.median(holds):8.2f} ms  max {1000 * max(holds):8.1f} ms  "
+          f"delivered {delivered:>7} ({delivered / elapsed:8.0f}/s)  in {elapsed:5.1f}s  "
+          f"latency p50 {latency['p50']:7.1f} p99 {latency['p99']:7.1f} ms  dropped {stats['dropped']:>6}  "
+          f"coalesced {stats['coalesced']:>6}  disconnected {stats['disconnected']:>3}  peak depth {peak}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--editors", type=int, default=300)
+    parser.add_argument("--senders", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=50, help="per sender")
+    parser.add_argument("--rate", type=float, default=10, help="messages per second per sender")
+    parser.add_argument("--slow", type=float, default=0.05, help="share of slow consumers")
+    parser.add_argument("--slow-ms", type=float, default=50)
+    parser.add_argument("--fast-ms", type=float, default=0.2)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--skip-sequential", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{args.editors} editors, {args.senders} senders x {args.messages} messages at {args.rate}/s, "
+          f"{args.slow:.0%} slow ({args.slow_ms} ms/send)")
+    if not args.skip_sequential:
+        asyncio.run(run_sequential(args))
+    for policy in POLICIES:
+        asyncio.run(run_rooms(args, policy))
+
+
+if __name__ == "__main__":
+    main()
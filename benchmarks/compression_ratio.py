@@ -0,0 +1,94 @@
+"""
+Compression ratio and CPU cost of each codec, per file type.
+
+Generates a sample of each kind of content the server stores (the XML the
+document editor saves, plain text, CSV, JSON, email bodies, and already
+compressed PNG-like and zip payloads), then for every registered codec
+times compress + encrypt against encrypt alone, and decrypt + decompress
+against decrypt alone. Also shows what the default policy would choose for
+the type, since skipped types are never compressed in practice.
+
+    python -m benchmarks.compression_ratio --size 2000000 --repeat 3
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+import zlib
+
+from backend import compression
+from backend.crypto import decrypt_data, encrypt_data
+
+
+def samples(size, rng):
+    words = ["secure", "plus", "document", "the", "of", "and", "report", "quarter", "total", "user",
+             "revenue", "meeting", "draft", "review", "project", "status", "update", "budget"]
+
+    def sentence():
+        return " ".join(rng.choice(words) for _ in range(rng.randrange(5, 15))).capitalize() + "."
+
+    def fill(make):
+        parts, total = [], 0
+        while total < size:
+            part = make()
+            parts.append(part)
+            total += len(part)
+        return "".join(parts).encode()[:size]
+
+    yield "xml", fill(lambda: f"<p style=\"margin:0\"><span>{sentence()}</span></p>\n")
+    yield "txt", fill(lambda: sentence() + (" " if rng.random() < 0.8 else "\n"))
+    yield "csv", fill(lambda: f"{rng.randrange(10 ** 6)},{rng.choice(words)},{rng.random() * 1000:.2f},"
+                              f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}\n")
+    yield "json", fill(lambda: json.dumps({"id": rng.randrange(10 ** 6), "name": rng.choice(words),
+                                           "tags": rng.sample(words, 3), "score": rng.random()}) + ",\n")
+    yield "email", fill(lambda: sentence() + ("\n\n" if rng.random() < 0.1 else " "))
+    # Already compressed payloads look random to a compressor
+    yield "png", b"\x89PNG\r\n\x1a\n" + zlib.compress(os.urandom(size), 1)[:size - 8]
+    yield "zip", b"PK\x03\x04" + os.urandom(size - 4)
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2_000_000, help="bytes per sample")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'type':>6} {'policy':>7} {'codec':>6} {'ratio':>7} {'write MB/s':>11} {'raw write':>10} "
+          f"{'read MB/s':>10} {'raw read':>9}")
+    for file_type, data in samples(args.size, rng):
+        mb = len(data) / 1e6
+        raw_write, encrypted = timed(lambda: encrypt_data(data), args.repeat)
+        raw_read, _ = timed(lambda: decrypt_data(encrypted["encrypted_data"], encrypted["key"], encrypted["iv"]),
+                            args.repeat)
+        policy = compression.choose_codec(file_type, data[:compression.SAMPLE_BYTES], len(data)) or "raw"
+        for name in compression.CODECS:
+            def write():
+                packed = compression.compress(name, data)
+                return packed, encrypt_data(packed)
+
+            write_time, (packed, result) = timed(write, args.repeat)
+
+            def read():
+                plain = decrypt_data(result["encrypted_data"], result["key"], result["iv"])
+                return compression.decompress(name, plain)
+
+            read_time, restored = timed(read, args.repeat)
+            assert restored == data
+            print(f"{file_type:>6} {policy:>7} {name:>6} {len(packed) / len(data):7.3f} {mb / write_time:11.1f} "
+                  f"{mb / raw_write:10.1f} {mb / read_time:10.1f} {mb / raw_read:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Latency of GET /files while large uploads are in flight.
+
+Drives the ASGI app in-process with httpx, so any blocking call on the
+event loop shows up directly as listing latency. Run it on two revisions
+to compare before/after:
+
+    python -m benchmarks.concurrency --uploads 4 --upload-mb 50 --requests 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+async def run(args):
+    import httpx
+    from backend.main import app
+    from backend.db import configure_threadpool
+
+    configure_threadpool()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        await client.post("/register", json={"username": "bench", "password": "pw"})
+        token = (await client.post("/token", data={"username": "bench", "password": "pw"})).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        payload = os.urandom(args.upload_mb * 1024 * 1024)
+
+        async def uploader(n):
+            for i in range(args.rounds):
+                await client.post("/files/upload", files={"file": (f"big{n}-{i}.bin", payload)}, headers=headers)
+
+        async def lister():
+            latencies = []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                await client.get("/files", headers=headers)
+                latencies.append((time.perf_counter() - start) * 1000)
+                await asyncio.sleep(args.interval)
+            return latencies
+
+        async def measure(with_load):
+            tasks = [asyncio.create_task(uploader(n)) for n in range(args.uploads)] if with_load else []
+            latencies = await lister()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            latencies.sort()
+            return latencies
+
+        for label, with_load in (("idle", False), ("under upload load", True)):
+            latencies = await measure(with_load)
+            p99 = latencies[max(int(len(latencies) * 0.99) - 1, 0)]
+            print(f"GET /files {label:>18}: p50 {statistics.median(latencies):8.2f} ms  "
+                  f"p99 {p99:8.2f} ms  max {latencies[-1]:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=4, help="concurrent uploaders")
+    parser.add_argument("--upload-mb", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=100, help="uploads per uploader (cancelled when listing ends)")
+    parser.add_argument("--requests", type=int, default=200, help="GET /files samples")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between samples")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("frontend", exist_ok=True)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
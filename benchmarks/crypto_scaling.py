@@ -0,0 +1,46 @@
+"""
+Throughput of segmented parallel encryption by worker count.
+
+    python -m benchmarks.crypto_scaling --size-mb 512 --workers 1,2,4,8
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import crypto
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--segment-mb", type=int, default=crypto.SEGMENT_SIZE // (1024 * 1024) or 4)
+    parser.add_argument("--workers", default=",".join(str(n) for n in (1, 2, 4, 8, os.cpu_count()) if n <= (os.cpu_count() or 1)) or "1")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = os.urandom(args.size_mb * 1024 * 1024)
+    segment_size = args.segment_mb * 1024 * 1024
+    print(f"{os.cpu_count()} CPUs, {args.size_mb} MB payload, {args.segment_mb} MB segments")
+
+    start = time.perf_counter()
+    crypto.encrypt_data(data)
+    single = args.size_mb / (time.perf_counter() - start)
+    print(f"{'single stream':>14}: {single:8.1f} MB/s")
+
+    for workers in sorted({int(w) for w in args.workers.split(",")}):
+        crypto.CRYPTO_WORKERS = workers
+        crypto.crypto_executor = ThreadPoolExecutor(max_workers=workers)
+        best = 0.0
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = crypto.encrypt_payload(data, segment_size=segment_size)
+            best = max(best, args.size_mb / (time.perf_counter() - start))
+        assert crypto.decrypt_payload(result["encrypted_data"], result["key"], result["iv"], segment_size) == data
+        crypto.crypto_executor.shutdown()
+        print(f"{workers:>6} workers: {best:8.1f} MB/s  ({best / single:4.2f}x single stream)")
+
+
+if __name__ == "__main__":
+    main()
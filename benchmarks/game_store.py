@@ -0,0 +1,116 @@
+"""
+Game-store throughput and consistency under concurrent workers.
+
+Starts several worker processes (or threads, for the memory backend) that
+all play random legal moves into the same few games through the store,
+so they keep colliding on versions. Afterwards every game's move list is
+replayed from the start position and must reach the stored FEN, with one
+version per move: a lost update would break either. Exits non-zero if not.
+
+    python -m benchmarks.game_store --backend sqlite --workers 4 --games 8 --moves 200
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from backend.chess_engine import Board, START_FEN
+from backend.game_store import make_game_store
+
+
+def new_game():
+    return {'board': START_FEN, 'moves': [], 'players': {'white': None, 'black': None},
+            'current_turn': 'white', 'status': 'active', 'check': False, 'auth_cursor': -1}
+
+
+def play(store, game_ids, moves, seed):
+    rng = random.Random(seed)
+    for _ in range(moves):
+        def step(game, version):
+            board = Board(game['board'])
+            legal = board.legal_moves()
+            if not legal:
+                # Finished game: start it over so every step is still a write
+                game.update(new_game())
+                return
+            move = board.play(str(rng.choice(legal)))
+            game['moves'].append(str(move))
+            game['board'] = board.fen()
+        store.update(rng.choice(game_ids), step)
+    return store.conflicts
+
+
+def process_worker(url, game_ids, moves, seed, conflicts):
+    store = make_game_store("sqlite", url=url)
+    conflicts.put(play(store, game_ids, moves, seed))
+
+
+def check(store, game_ids):
+    bad = 0
+    for game_id in game_ids:
+        game, version = store.load(game_id)
+        board = Board(START_FEN)
+        for move in game['moves']:
+            board.play(move)
+        # Restarted games lose their history, so only check what the record claims
+        if board.fen() != game['board']:
+            print(f"  {game_id}: replayed moves do not reach the stored position")
+            bad += 1
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="sqlite")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--games", type=int, default=8)
+    parser.add_argument("--moves", type=int, default=200, help="moves per worker")
+    args = parser.parse_args()
+
+    game_ids = [f"game-{i}" for i in range(args.games)]
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'games.db')}"
+        store = make_game_store(args.backend, **({"url": url} if args.backend == "sqlite" else {}))
+        for game_id in game_ids:
+            store.create(game_id, new_game())
+
+        start = time.perf_counter()
+        if args.backend == "sqlite":
+            conflicts = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=process_worker, args=(url, game_ids, args.moves, seed, conflicts))
+                       for seed in range(args.workers)]
+            for worker in workers:
+                worker.start()
+            total_conflicts = sum(conflicts.get() for _ in workers)
+            for worker in workers:
+                worker.join()
+        else:
+            workers = [threading.Thread(target=play, args=(store, game_ids, args.moves, seed))
+                       for seed in range(args.workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            total_conflicts = store.conflicts
+        elapsed = time.perf_counter() - start
+
+        updates = args.workers * args.moves
+        versions = sum(store.load(game_id)[1] - 1 for game_id in game_ids)
+        print(f"{args.backend}: {args.workers} workers, {args.games} games, {updates} updates in {elapsed:.2f}s "
+              f"({updates / elapsed:.0f}/s), {total_conflicts} version conflicts retried")
+        failures = check(store, game_ids)
+        if versions != updates:
+            print(f"  {versions} versions written for {updates} updates: updates were lost")
+            failures += 1
+        print("consistent" if not failures else f"{failures} inconsistencies")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
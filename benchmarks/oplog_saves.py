@@ -0,0 +1,71 @@
+"""
+Save cost of operation pushes against full-document uploads.
+
+For each document size, makes the same small edit (one short insert) per
+save, either through FileWriteService.replace_content (re-encrypt and
+rewrite the whole blob plus a backup version, what PUT /files/{id} does)
+or as an operation-log push, then times one compaction of the pushes.
+Runs against a throwaway database in a temporary directory.
+
+    python -m benchmarks.oplog_saves --sizes 10000,100000,1000000 --saves 50
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="document sizes in characters")
+    parser.add_argument("--saves", type=int, default=50)
+    args = parser.parse_args()
+
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, repo)
+    os.chdir(tempfile.mkdtemp())
+    os.environ["SECUREPLUS_OPLOG_COMPACT_INTERVAL"] = "0"
+
+    from backend.file_service import FileWriteService
+    from backend.migrations import run_migrations
+    from backend.models import SessionLocal, User
+    from backend.oplog import document_log
+
+    run_migrations()
+    db = SessionLocal()
+    user = User(username="bench", hashed_password="x")
+    db.add(user)
+    db.commit()
+    rng = random.Random(0)
+
+    for size in (int(n) for n in args.sizes.split(",")):
+        text = "".join(rng.choice("abcdefghij ") for _ in range(size))
+
+        file = FileWriteService(db).create_from_bytes(user.id, "full.txt", "txt", text.encode())
+        start = time.perf_counter()
+        for _ in range(args.saves):
+            pos = rng.randrange(len(text))
+            text = text[:pos] + "edit " + text[pos:]
+            FileWriteService(db).replace_content(file, user.id, text.encode())
+        full = (time.perf_counter() - start) / args.saves
+
+        file = FileWriteService(db).create_from_bytes(user.id, "ops.txt", "txt", text.encode())
+        seq = 0
+        start = time.perf_counter()
+        for _ in range(args.saves):
+            seq = document_log.push(db, file, user.id, seq,
+                                    [{"op": "insert", "pos": rng.randrange(len(text)), "text": "edit "}])
+        pushed = (time.perf_counter() - start) / args.saves
+        start = time.perf_counter()
+        document_log.compact(db, file)
+        compaction = time.perf_counter() - start
+
+        print(f"{size:>9} chars: full save {1000 * full:8.2f} ms   push {1000 * pushed:6.2f} ms "
+              f"({full / pushed:6.1f}x)   compaction of {args.saves} pushes {1000 * compaction:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Perft for the bitboard chess engine: move-generation correctness and speed.
+
+Counts leaf nodes of the legal move tree for the standard test positions,
+compares them with the published counts and reports nodes per second.
+Exits non-zero on any mismatch; tests/test_chess_perft.py checks the same
+counts on every test run.
+
+    python -m benchmarks.perft [--max-depth 4]
+"""
+
+import argparse
+import sys
+import time
+
+from backend.chess_engine import Board, START_FEN
+
+POSITIONS = [
+    ("startpos", START_FEN, [20, 400, 8902, 197281]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862]),
+    ("position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238]),
+    ("position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467]),
+    ("position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379]),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-depth", type=int, default=4)
+    args = parser.parse_args()
+
+    failures = 0
+    total_nodes, total_time = 0, 0.0
+    for name, fen, expected in POSITIONS:
+        board = Board(fen)
+        for depth, count in enumerate(expected[:args.max_depth], start=1):
+            start = time.perf_counter()
+            nodes = board.perft(depth)
+            elapsed = time.perf_counter() - start
+            total_nodes += nodes
+            total_time += elapsed
+            ok = nodes == count
+            failures += not ok
+            print(f"{name:>10} depth {depth}: {nodes:>8} nodes  {'ok' if ok else f'EXPECTED {count}':>14}  "
+                  f"{nodes / elapsed if elapsed else 0:10.0f} nodes/s")
+        assert board.fen() == fen, "perft left the board changed"
+    print(f"total: {total_nodes} nodes, {total_nodes / total_time:.0f} nodes/s")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
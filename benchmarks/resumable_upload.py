@@ -0,0 +1,99 @@
+"""
+Upload throughput: one streamed POST against resumable chunked sessions.
+
+Uploads the same file through /files/upload and through /uploads with 1
+and --workers parallel chunk PUTs, then finalizes, and reports time and
+throughput for each. Also reports what a dropped connection costs: the
+resumable upload is interrupted half way and completed from the session's
+list of received chunks, so only the missing half is sent again. Runs
+in-process against a throwaway database in a temporary directory.
+
+    python -m benchmarks.resumable_upload --size 64 --chunk-size 1048576 --workers 4
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=64, help="file size in MiB")
+    parser.add_argument("--chunk-size", type=int, default=1024 * 1024)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, repo)
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("frontend", exist_ok=True)
+
+    from fastapi.testclient import TestClient
+    from backend.main import app
+
+    client = TestClient(app)
+    client.post("/register", json={"username": "bench", "password": "bench"})
+    token = client.post("/token", data={"username": "bench", "password": "bench"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    size = args.size * 1024 * 1024
+    # Half text, half noise, so compression is exercised without dominating
+    data = (b"quarterly report draft, revenue and budget review\n" * (size // 100))[:size // 2]
+    data += os.urandom(size - len(data))
+    chunk_size = args.chunk_size
+    checksums = [hashlib.sha256(data[i:i + chunk_size]).hexdigest() for i in range(0, size, chunk_size)]
+
+    def open_session():
+        response = client.post("/uploads", json={"filename": "bench.txt", "size": size, "chunk_size": chunk_size},
+                               headers=headers)
+        return response.json()["upload_id"]
+
+    def put_chunk(upload_id, index):
+        part = data[index * chunk_size:(index + 1) * chunk_size]
+        response = client.put(f"/uploads/{upload_id}/chunks/{index}", content=part,
+                              headers={**headers, "X-Chunk-SHA256": checksums[index]})
+        assert response.status_code == 200, response.text
+
+    def resumable(workers, indexes=None, upload_id=None):
+        upload_id = upload_id or open_session()
+        indexes = range(len(checksums)) if indexes is None else indexes
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda index: put_chunk(upload_id, index), indexes))
+        return upload_id
+
+    def finalize(upload_id):
+        response = client.post(f"/uploads/{upload_id}/finalize", headers=headers)
+        assert response.status_code == 200, response.text
+        return response.json()["id"]
+
+    def report(label, seconds, sent):
+        print(f"{label:>28}: {seconds:7.2f} s  {size / 2**20 / seconds:7.1f} MiB/s  {sent / 2**20:7.1f} MiB sent")
+
+    start = time.perf_counter()
+    response = client.post("/files/upload", files={"file": ("bench.txt", data)}, headers=headers)
+    assert response.status_code == 200, response.text
+    report("single POST", time.perf_counter() - start, size)
+
+    for workers in sorted({1, args.workers}):
+        start = time.perf_counter()
+        file_id = finalize(resumable(workers))
+        report(f"chunked, {workers} worker(s)", time.perf_counter() - start, size)
+    assert client.get(f"/files/{file_id}/download", headers=headers).content == data
+
+    # A connection drops half way; the client asks what arrived and sends the rest
+    upload_id = resumable(args.workers, range(0, len(checksums), 2))
+    start = time.perf_counter()
+    received = set(client.get(f"/uploads/{upload_id}", headers=headers).json()["received"])
+    missing = [index for index in range(len(checksums)) if index not in received]
+    resumable(args.workers, missing, upload_id)
+    finalize(upload_id)
+    report("resume after drop", time.perf_counter() - start,
+           sum(min(chunk_size, size - index * chunk_size) for index in missing))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Uploads per second for small files.
+
+Each upload writes a file row, its keys and its first backup version; with
+the unit of work that is one commit (one journal flush) per upload. Runs
+against a throwaway database in a temporary directory.
+
+    python -m benchmarks.small_uploads --count 500 --size 4096
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--size", type=int, default=4096, help="bytes per file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("frontend", exist_ok=True)
+
+    from fastapi.testclient import TestClient
+    from backend.main import app
+    from backend.models import engine
+
+    commits = 0
+
+    def count_commit(conn):
+        nonlocal commits
+        commits += 1
+
+    event.listen(engine, "commit", count_commit)
+
+    with TestClient(app) as client:
+        client.post("/register", json={"username": "bench", "password": "pw"})
+        token = client.post("/token", data={"username": "bench", "password": "pw"}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        payload = os.urandom(args.size)
+
+        commits = 0
+        start = time.perf_counter()
+        for i in range(args.count):
+            response = client.post("/files/upload", files={"file": (f"f{i}.txt", payload)}, headers=headers)
+            response.raise_for_status()
+        elapsed = time.perf_counter() - start
+
+    print(f"{args.count} uploads of {args.size} B: {args.count / elapsed:8.1f} uploads/s  "
+          f"{1000 * elapsed / args.count:6.2f} ms each  {commits / args.count:.1f} commits/upload")
+
+
+if __name__ == "__main__":
+    main()
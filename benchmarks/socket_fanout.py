@@ -0,0 +1,100 @@
+"""
+Cross-process Socket.IO fan-out through the SQLite queue manager.
+
+Starts N worker processes sharing one queue file. Each publishes its
+share of room broadcasts, stamped with the send time, through
+`_publish` (what an `emit(..., room=...)` costs the sender) and consumes
+the channel through `_listen` (what every worker's listener thread does),
+recording the delivery latency of messages sent by the other workers.
+Reports publish rate, delivered messages per second across all workers
+and latency percentiles.
+
+    python -m benchmarks.socket_fanout --workers 2,4,8 --messages 2000 --rate 500
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from backend.socket_queue import SQLiteQueueManager
+
+
+def worker(url, index, workers, messages, rate, poll_interval, ready, start, results):
+    manager = SQLiteQueueManager(url=url, poll_interval=poll_interval)
+    expected = messages * (workers - 1)
+    latencies = []
+
+    def listen():
+        for payload in manager._listen():
+            message = json.loads(payload)
+            if message['host_id'] != manager.host_id:
+                latencies.append(time.time() - message['data']['sent'])
+                if len(latencies) >= expected:
+                    return
+
+    listener = threading.Thread(target=listen, daemon=True)
+    listener.start()
+    time.sleep(0.2)  # let the listener take its starting position
+    ready.put(index)
+    start.wait()
+
+    began = time.perf_counter()
+    for n in range(messages):
+        manager._publish({'method': 'emit', 'event': 'game_update', 'namespace': '/', 'room': 'game',
+                          'host_id': manager.host_id, 'data': {'n': n, 'sent': time.time()}})
+        if rate:
+            # Pace to the target rate instead of flooding the queue
+            delay = began + (n + 1) / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    published = time.perf_counter() - began
+    listener.join(timeout=30)
+    results.put((messages / published, latencies, time.perf_counter() - began))
+
+
+def run(workers, messages, rate, poll_interval):
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'socketio.db')}"
+        SQLiteQueueManager(url=url)  # create the table before the workers race to
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        start = multiprocessing.Event()
+        procs = [multiprocessing.Process(target=worker, args=(url, i, workers, messages, rate, poll_interval,
+                                                              ready, start, results))
+                 for i in range(workers)]
+        for proc in procs:
+            proc.start()
+        for _ in procs:
+            ready.get()
+        start.set()
+        outcomes = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+
+    publish_rate = sum(outcome[0] for outcome in outcomes)
+    latencies = sorted(latency for outcome in outcomes for latency in outcome[1])
+    elapsed = max(outcome[2] for outcome in outcomes)
+    expected = workers * messages * (workers - 1)
+    p = lambda q: 1000 * latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+    print(f"{workers:>2} workers: published {publish_rate:8.0f} msg/s  delivered {len(latencies) / elapsed:8.0f} msg/s "
+          f"({len(latencies)}/{expected})  latency p50 {p(0.5):6.1f} ms  p99 {p(0.99):6.1f} ms  "
+          f"mean {1000 * statistics.mean(latencies):6.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="2,4,8")
+    parser.add_argument("--messages", type=int, default=2000, help="messages published per worker")
+    parser.add_argument("--rate", type=float, default=500, help="per-worker publish rate; 0 for as fast as possible")
+    parser.add_argument("--poll-interval", type=float, default=0.01)
+    args = parser.parse_args()
+    for workers in (int(n) for n in args.workers.split(",")):
+        run(workers, args.messages, args.rate, args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Mixed read/write throughput of the SQLite tuning profiles.
+
+Worker threads run a mix of owner listings (through the read engine) and
+single-row inserts with a commit each (through the write engine), against a
+fresh database per profile in a temporary directory.
+
+    python -m benchmarks.sqlite_profiles --threads 16 --ops 400 --write-ratio 0.2
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_profile(profile, args):
+    from sqlalchemy.orm import sessionmaker
+    from backend.engine import make_engines
+    from backend.models import Base, File, User
+
+    path = os.path.join(tempfile.mkdtemp(), f"{profile}.db")
+    engines = make_engines(f"sqlite:///{path}", profile)
+    Base.metadata.create_all(bind=engines.write)
+    WriteSession = sessionmaker(bind=engines.write, expire_on_commit=False)
+    ReadSession = sessionmaker(bind=engines.read, expire_on_commit=False)
+
+    db = WriteSession()
+    users = [User(username=f"u{i}", hashed_password="x") for i in range(args.users)]
+    db.add_all(users)
+    db.flush()
+    db.add_all(File(filename=f"seed{i}", file_type="text/plain", owner_id=users[i % args.users].id)
+               for i in range(args.seed_files))
+    db.commit()
+    user_ids = [u.id for u in users]
+    db.close()
+
+    reads, writes, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        local_reads, local_writes = [], []
+        for i in range(args.ops):
+            owner = rng.choice(user_ids)
+            start = time.perf_counter()
+            try:
+                if rng.random() < args.write_ratio:
+                    session = WriteSession()
+                    session.add(File(filename=f"w{seed}-{i}", file_type="text/plain", owner_id=owner))
+                    session.commit()
+                    session.close()
+                    local_writes.append(time.perf_counter() - start)
+                else:
+                    session = ReadSession()
+                    session.query(File).filter(File.owner_id == owner).all()
+                    session.close()
+                    local_reads.append(time.perf_counter() - start)
+            except Exception as exc:  # "database is locked" under contention
+                with lock:
+                    errors.append(exc)
+        with lock:
+            reads.extend(local_reads)
+            writes.extend(local_writes)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    engines.write.dispose()
+    engines.read.dispose()
+
+    done = len(reads) + len(writes)
+    print(f"{profile:>10}: {done / elapsed:8.1f} ops/s  "
+          f"read p50 {1000 * percentile(reads or [0], 0.5):6.2f} ms p99 {1000 * percentile(reads or [0], 0.99):7.2f} ms  "
+          f"write p50 {1000 * percentile(writes or [0], 0.5):6.2f} ms p99 {1000 * percentile(writes or [0], 0.99):7.2f} ms  "
+          f"{len(errors)} errors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=400, help="operations per thread")
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed-files", type=int, default=5000)
+    parser.add_argument("--profiles", default="legacy,production")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("frontend", exist_ok=True)
+
+    print(f"{args.threads} threads x {args.ops} ops, {args.write_ratio:.0%} writes")
+    for profile in args.profiles.split(","):
+        run_profile(profile, args)
+
+
+if __name__ == "__main__":
+    main()
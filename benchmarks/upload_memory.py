@@ -0,0 +1,77 @@
+"""
+Peak RSS and throughput of the upload encryption pipeline.
+
+Each size runs in a fresh subprocess so ru_maxrss reflects that run only.
+The "buffered" mode reproduces the old read-everything-then-encrypt path
+for comparison.
+
+    python -m benchmarks.upload_memory --sizes 10,100,1000,2000
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+MB = 1024 * 1024
+
+
+def _make_source(path: str, size: int):
+    block = os.urandom(MB)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:min(MB, remaining)])
+            remaining -= MB
+
+
+def _run_one(mode: str, size_mb: int):
+    from starlette.datastructures import UploadFile
+    from backend import storage
+    from backend.crypto import generate_key, generate_iv, encrypt_data
+
+    workdir = tempfile.mkdtemp()
+    src = os.path.join(workdir, "source.bin")
+    _make_source(src, size_mb * MB)
+    storage.UPLOAD_DIR = os.path.join(workdir, "uploads")
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    with open(src, "rb") as f:
+        upload = UploadFile(file=f, filename="source.bin")
+        if mode == "streaming":
+            stored = asyncio.run(storage.encrypt_upload(upload, generate_key(), generate_iv()))
+            os.remove(stored.path)
+        else:
+            data = asyncio.run(upload.read())
+            encrypt_data(data)
+    elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.remove(src)
+    print(f"{mode:>9} {size_mb:>6} MB  peak RSS {peak / 1024:8.1f} MB "
+          f"(+{(peak - baseline) / 1024:7.1f} MB)  {size_mb / elapsed:8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,2000", help="comma-separated sizes in MB")
+    parser.add_argument("--modes", default="streaming,buffered")
+    parser.add_argument("--run", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        _run_one(args.run[0], int(args.run[1]))
+        return
+
+    for size in args.sizes.split(","):
+        for mode in args.modes.split(","):
+            subprocess.run([sys.executable, "-m", "benchmarks.upload_memory", "--run", mode, size], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,32 @@
 from flask import Flask, request, jsonify, send_from_directory, session
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import os
 import datetime
 import uuid
 import json
+from collections import OrderedDict
 from backend.models import SessionLocal, User, File, Email, TempStorage, BackupStorage, UserSession, ChessMove
+from backend.migrations import run_migrations
+from backend.principals import Principal, principal_cache
+from backend.chess_matcher import SequenceMatcher
+from backend.chess_engine import Board, IllegalMove, WHITE
+from backend.game_store import make_game_store, GameNotFound
+from backend.socket_queue import make_client_manager
+from backend.chat_history import chat_history
+
+# Bring the database schema up to date
+run_migrations()
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY", "your_secret_key_here")
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Room broadcasts reach every worker's clients when SECUREPLUS_SOCKETIO_MANAGER=sqlite
+client_manager = make_client_manager()
+socketio = SocketIO(app, cors_allowed_origins="*",
+                    **({'client_manager': client_manager} if client_manager else {}))
 
 # JWT Configuration
 app.config["JWT_SECRET_KEY"] = os.environ.get("SECRET_KEY", "your_secret_key_here")
@@ -58,14 +72,15 @@ def login_for_access_token():
     request.db.commit()
     
     # Create access token
-    access_token = create_access_token(identity=username)
+    access_token = create_access_token(identity=username, additional_claims={"sep": user.session_epoch or 0})
     
     # Create session
     session_id = str(uuid.uuid4())
     new_session = UserSession(
         user_id=user.id,
         session_id=session_id,
-        expires_at=datetime.datetime.utcnow() + app.config["JWT_ACCESS_TOKEN_EXPIRES"]
+        expires_at=datetime.datetime.utcnow() + app.config["JWT_ACCESS_TOKEN_EXPIRES"],
+        epoch=user.session_epoch or 0
     )
     request.db.add(new_session)
     request.db.commit()
@@ -78,11 +93,21 @@ def login_for_access_token():
 
 # Current user helper
 def get_current_user():
+    # Same principal cache as the FastAPI app, keyed by the token's jti
+    claims = get_jwt()
+    cache_key = ("flask", claims["jti"])
+    principal = principal_cache.get(cache_key)
+    if principal is not None:
+        return principal
     username = get_jwt_identity()
+    generation = principal_cache.generation(username)
     user = request.db.query(User).filter(User.username == username).first()
-    if not user:
+    # Tokens issued before the last logout carry an older session epoch
+    if not user or claims.get("sep", 0) != (user.session_epoch or 0):
         return None
-    return user
+    principal = Principal.from_user(user)
+    principal_cache.put(cache_key, principal, claims.get("exp"), generation)
+    return principal
 
 # Protected endpoint example
 @app.route('/files', methods=['GET'])
@@ -113,27 +138,90 @@ def api_root():
     return jsonify({"message": "Welcome to SecurePlus - The secure Google Drive alternative"})
 
 # Chess game functionality
-active_games = {}
+START_POSITION = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+# Shared by every worker when SECUREPLUS_GAME_STORE=sqlite
+game_store = make_game_store()
 chess_auth_sequences = {
     # Define sequences that will trigger authentication
     # Format: "starting_position": ["e2-e4", "e7-e5", "g1-f3", "b8-c6"]
-    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1": ["e2-e4", "e7-e5", "g1-f3", "b8-c6", "f1-c4", "g8-f6"]
+    START_POSITION: ["e2-e4", "e7-e5", "g1-f3", "b8-c6", "f1-c4", "g8-f6"]
 }
 
+# All sequences in one trie; each game keeps a cursor into it, advanced once per move
+auth_matcher = SequenceMatcher()
+for position, sequence in chess_auth_sequences.items():
+    auth_matcher.add(position, sequence)
+
+# Engine positions this worker has already built, keyed by game and the
+# record version they match; another worker's move bumps the version and
+# the board is rebuilt from the stored FEN
+game_boards = OrderedDict()
+MAX_CACHED_BOARDS = 1024
+GAME_OVER = ('checkmate', 'stalemate', 'draw')
+
+def take_board(game_id, game, version):
+    cached = game_boards.pop(game_id, None)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    return Board(game['board'])
+
+def keep_board(game_id, version, board):
+    game_boards[game_id] = (version, board)
+    if len(game_boards) > MAX_CACHED_BOARDS:
+        game_boards.popitem(last=False)
+
+def apply_move(board, game, move_text):
+    """Validate and play a move, updating the game's FEN, turn and status. Raises IllegalMove."""
+    if game['status'] in GAME_OVER:
+        raise IllegalMove(f"Game is over ({game['status']})")
+    move = board.play(move_text)
+    game['moves'].append(str(move))
+    game['board'] = board.fen()
+    game['current_turn'] = 'white' if board.turn == WHITE else 'black'
+    outcome = board.outcome()
+    game['check'] = outcome in ('check', 'checkmate')
+    if outcome in GAME_OVER:
+        game['status'] = outcome
+    # Keep the auth cursor in step with the move list
+    game['auth_cursor'] = auth_matcher.advance(game['auth_cursor'], str(move))
+    return move
+
+def game_update(game, move, username):
+    """The `game_update` event announcing a move that was just played."""
+    return {
+        'move': move,
+        'username': username,
+        'current_turn': game['current_turn'],
+        'board': game['board'],
+        'status': game['status'],
+        'check': game['check']
+    }
+
+def play_move(game_id, move_text):
+    """Play a move against the stored game, retrying if another worker moved first."""
+    def step(game, version):
+        board = take_board(game_id, game, version)
+        return board, str(apply_move(board, game, move_text))
+    game, version, (board, move) = game_store.update(game_id, step)
+    keep_board(game_id, version, board)
+    return game, move
+
 @app.route('/api/chess/new', methods=['POST'])
 @jwt_required(optional=True)
 def create_new_game():
+    game_store.maybe_evict()
     game_id = str(uuid.uuid4())
-    active_games[game_id] = {
-        'board': "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    game = {
+        'board': START_POSITION,
         'moves': [],
-        'chat': [],
         'players': {
             'white': None,
             'black': None
         },
         'current_turn': 'white',
-        'status': 'waiting'
+        'status': 'waiting',
+        'check': False,
+        'auth_cursor': auth_matcher.start(START_POSITION)
     }
     
     # If user is logged in, assign them as white player
@@ -141,30 +229,27 @@ def create_new_game():
     if username:
         user = request.db.query(User).filter(User.username == username).first()
         if user:
-            active_games[game_id]['players']['white'] = {
+            game['players']['white'] = {
                 'id': user.id,
                 'username': username
             }
-            active_games[game_id]['status'] = 'active'
+            game['status'] = 'active'
+    game_store.create(game_id, game)
     
     return jsonify({
         'game_id': game_id,
-        'status': active_games[game_id]['status'],
-        'board': active_games[game_id]['board']
+        'status': game['status'],
+        'board': game['board']
     })
 
 @app.route('/api/chess/join/<game_id>', methods=['POST'])
 @jwt_required(optional=True)
 def join_game(game_id):
-    if game_id not in active_games:
-        return jsonify({'error': 'Game not found'}), 404
-    
     # If user is logged in, assign them as black player if spot is available
     username = get_jwt_identity()
-    game = active_games[game_id]
+    user = request.db.query(User).filter(User.username == username).first() if username else None
     
-    if username:
-        user = request.db.query(User).filter(User.username == username).first()
+    def seat(game, version):
         if user:
             # If white player slot is empty
             if game['players']['white'] is None:
@@ -184,6 +269,11 @@ def join_game(game_id):
             if game['players']['white'] and game['players']['black']:
                 game['status'] = 'active'
     
+    try:
+        game, _, _ = game_store.update(game_id, seat)
+    except GameNotFound:
+        return jsonify({'error': 'Game not found'}), 404
+    
     return jsonify({
         'game_id': game_id,
         'status': game['status'],
@@ -199,32 +289,22 @@ def make_move():
     game_id = data.get('game_id')
     move = data.get('move')  # e.g., "e2-e4"
     
-    if not game_id or not move or game_id not in active_games:
+    if not game_id or not move:
         return jsonify({'error': 'Invalid request'}), 400
     
-    game = active_games[game_id]
-    game['moves'].append(move)
-    
-    # In a real implementation, validate the move and update the board state
-    # For this example, we'll just assume the move is valid
-    # Update whose turn it is
-    game['current_turn'] = 'black' if game['current_turn'] == 'white' else 'white'
+    try:
+        game, move = play_move(game_id, move)
+    except GameNotFound:
+        return jsonify({'error': 'Invalid request'}), 400
+    except IllegalMove as exc:
+        return jsonify({'error': str(exc)}), 400
     
     # Check for authentication sequence
-    current_position = game['board']
-    if current_position in chess_auth_sequences:
-        if len(game['moves']) >= len(chess_auth_sequences[current_position]):
-            sequence_match = True
-            for i, auth_move in enumerate(chess_auth_sequences[current_position]):
-                if i >= len(game['moves']) or game['moves'][i] != auth_move:
-                    sequence_match = False
-                    break
-            
-            if sequence_match:
-                return jsonify({
-                    'trigger_auth': True,
-                    'message': 'Authentication sequence detected'
-                })
+    if auth_matcher.matched(game['auth_cursor']):
+        return jsonify({
+            'trigger_auth': True,
+            'message': 'Authentication sequence detected'
+        })
     
     # Save move to database if user is authenticated
     username = get_jwt_identity()
@@ -240,28 +320,51 @@ def make_move():
             request.db.add(new_move)
             request.db.commit()
     
+    # The move is played once, here; the room hears it from the server, not from a second client submission
+    socketio.emit('game_update', game_update(game, move, username or 'Anonymous'), room=game_id)
+    
     return jsonify({
         'success': True,
         'board': game['board'],
         'current_turn': game['current_turn'],
-        'moves': game['moves']
+        'moves': game['moves'],
+        'status': game['status'],
+        'check': game['check']
     })
 
 @app.route('/api/chess/reset/<game_id>', methods=['POST'])
 def reset_game(game_id):
-    if game_id not in active_games:
-        return jsonify({'error': 'Game not found'}), 404
+    def restart(game, version):
+        game['board'] = START_POSITION
+        game['moves'] = []
+        game['current_turn'] = 'white'
+        game['check'] = False
+        if game['status'] in GAME_OVER:
+            game['status'] = 'active'
+        game['auth_cursor'] = auth_matcher.start(game['board'])
     
-    active_games[game_id]['board'] = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
-    active_games[game_id]['moves'] = []
-    active_games[game_id]['current_turn'] = 'white'
+    try:
+        game, version, _ = game_store.update(game_id, restart)
+    except GameNotFound:
+        return jsonify({'error': 'Game not found'}), 404
+    keep_board(game_id, version, Board(START_POSITION))
     
     return jsonify({
         'success': True,
-        'board': active_games[game_id]['board'],
+        'board': game['board'],
         'moves': []
     })
 
+@app.route('/api/chess/<game_id>/chat', methods=['GET'])
+def chat_page(game_id):
+    # Older chat, newest first; pass the returned cursor as `before` for the next page
+    try:
+        messages, cursor = chat_history.page(game_id, before=request.args.get('before'),
+                                             limit=request.args.get('limit', 50, type=int))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({'messages': messages, 'next_before': cursor})
+
 # WebSocket for chat and real-time game updates
 @socketio.on('connect')
 def handle_connect():
@@ -277,6 +380,8 @@ def handle_join_game(data):
     if game_id:
         join_room(game_id)
         emit('status', {'msg': 'User joined the game'}, room=game_id)
+        # Recent chat for the joiner only; older pages come from /api/chess/<game_id>/chat
+        emit('chat_history', {'game_id': game_id, 'messages': chat_history.recent(game_id)})
 
 @socketio.on('leave_game')
 def handle_leave_game(data):
@@ -291,13 +396,8 @@ def handle_chat_message(data):
     username = data.get('username', 'Anonymous')
     message = data.get('message')
     
-    if game_id and message and game_id in active_games:
-        chat_entry = {
-            'username': username,
-            'message': message,
-            'timestamp': datetime.datetime.utcnow().isoformat()
-        }
-        active_games[game_id]['chat'].append(chat_entry)
+    if game_id and message and game_id in game_store:
+        chat_entry = chat_history.append(game_id, username, message)
         emit('chat_message', chat_entry, room=game_id)
 
 @socketio.on('game_move')
@@ -306,19 +406,18 @@ def handle_game_move(data):
     move = data.get('move')
     username = data.get('username', 'Anonymous')
     
-    if game_id and move and game_id in active_games:
-        # Process the move (simplistic approach for demonstration)
-        game = active_games[game_id]
-        game['moves'].append(move)
-        game['current_turn'] = 'black' if game['current_turn'] == 'white' else 'white'
+    if game_id and move:
+        try:
+            game, move = play_move(game_id, move)
+        except GameNotFound:
+            return
+        except IllegalMove as exc:
+            # Only the sender hears about an illegal move
+            emit('move_rejected', {'move': move, 'error': str(exc)})
+            return
         
         # Notify all clients in the room about the move
-        emit('game_update', {
-            'move': move,
-            'username': username,
-            'current_turn': game['current_turn'],
-            'board': game['board']  # In a real implementation, update this with the new board state
-        }, room=game_id)
+        emit('game_update', game_update(game, move, username), room=game_id)
 
 if __name__ == '__main__':
     socketio.run(app, debug=True, port=8000)
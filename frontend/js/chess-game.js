@@ -325,13 +325,8 @@ function makeMove(from, to) {
             // Authentication sequence detected
             triggerLoginInterface();
         } else {
-            // Normal move
-            // Also emit the move via socket for real-time updates
-            socket.emit('game_move', {
-                game_id: currentGameId,
-                username: currentUsername,
-                move: move
-            });
+            // Normal move; the server announces it to the room with game_update,
+            // so it must not be submitted again over the socket
             
             // Check special sequence
             checkAuthSequence(move);
@@ -0,0 +1,44 @@
+"""
+Shared fixtures: the app against a throwaway database and blob store.
+
+The backend reads its configuration from the environment and creates its
+engine when first imported, so everything is pointed at a temporary
+directory before anything from `backend` is imported.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+WORKDIR = tempfile.mkdtemp(prefix="secureplus-tests-")
+os.environ.setdefault("SECUREPLUS_DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR, 'secureplus.db')}")
+os.environ.setdefault("SECUREPLUS_BLOB_DIR", os.path.join(WORKDIR, "uploads"))
+os.environ.setdefault("SECUREPLUS_UPLOAD_TEMP_DIR", os.path.join(WORKDIR, "temp_storage", "uploads"))
+# Background tasks would run queries at unpredictable times; tests call them directly
+for task in ("REAPER", "SWEEP", "OPLOG_COMPACT"):
+    os.environ.setdefault(f"SECUREPLUS_{task}_INTERVAL", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(WORKDIR)
+os.makedirs("frontend", exist_ok=True)
+
+
+@pytest.fixture(scope="session")
+def app():
+    from backend.main import app
+    return app
+
+
+@pytest.fixture(scope="session")
+def client(app):
+    from fastapi.testclient import TestClient
+    with TestClient(app) as client:
+        yield client
+
+
+def login(client, username: str, password: str = "pw") -> dict:
+    client.post("/register", json={"username": username, "password": password})
+    token = client.post("/token", data={"username": username, "password": password}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
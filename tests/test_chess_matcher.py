@@ -0,0 +1,45 @@
+"""The auth-sequence trie: a game matches once its moves begin with a registered sequence."""
+
+from backend.chess_matcher import DEAD, SequenceMatcher
+
+START = "start"
+
+
+def walk(matcher, moves):
+    cursor = matcher.start(START)
+    for move in moves:
+        cursor = matcher.advance(cursor, move)
+    return cursor
+
+
+def make_matcher():
+    matcher = SequenceMatcher()
+    matcher.add(START, ["e4", "e5"], "short")
+    matcher.add(START, ["e4", "e5", "Nf3", "Nc6"], "long")
+    return matcher
+
+
+def test_completed_sequence_keeps_matching():
+    matcher = make_matcher()
+    assert matcher.matched(walk(matcher, ["e4", "e5"])) == "short"
+    assert matcher.matched(walk(matcher, ["e4", "e5", "Nf3", "Nc6", "a3", "a6"])) == "long"
+
+
+def test_deviating_from_a_longer_branch_keeps_the_prefix_match():
+    matcher = make_matcher()
+    assert matcher.matched(walk(matcher, ["e4", "e5", "Nf3", "d6"])) == "short"
+
+
+def test_settled_match_ignores_moves_that_happen_to_be_in_the_trie():
+    matcher = make_matcher()
+    # After leaving the trie, Nf3 Nc6 no longer follow e4 e5, so they cannot complete "long"
+    assert matcher.matched(walk(matcher, ["e4", "e5", "d4", "Nf3", "Nc6"])) == "short"
+    assert matcher.matched(walk(matcher, ["e4", "e5", "Nf3", "d6", "Nf3", "Nc6"])) == "short"
+
+
+def test_leaving_before_any_sequence_completes_kills_the_cursor():
+    matcher = make_matcher()
+    assert walk(matcher, ["e4", "d5"]) == DEAD
+    assert walk(matcher, ["e4", "d5", "e5"]) == DEAD
+    assert matcher.matched(walk(matcher, ["e4"])) is None
+    assert matcher.start("elsewhere") == DEAD
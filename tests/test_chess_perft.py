@@ -0,0 +1,37 @@
+"""
+Perft: leaf counts of the legal move tree against the published numbers.
+
+Any move-generation bug (a missed en passant, castling through check, an
+unpromoted pawn, a pinned piece moving) changes some count. The positions
+are the standard suite; benchmarks/perft.py times the same searches.
+"""
+
+import pytest
+
+from backend.chess_engine import Board, START_FEN
+
+POSITIONS = {
+    "startpos": (START_FEN, [20, 400, 8902, 197281]),
+    # Castling both ways, pins, en passant and promotions in one middlegame
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862]),
+    # Rook endgame where en passant can expose the king along the rank
+    "position 3": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238]),
+    # Promotions, including capturing ones, while in check; and its mirror
+    "position 4": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467]),
+    "position 4 mirrored": ("r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1", [6, 264, 9467]),
+    # Promotion to every piece with castling rights still live
+    "position 5": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379]),
+    "position 6": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", [46, 2079, 89890]),
+}
+
+CASES = [(name, depth, count) for name, (_, counts) in POSITIONS.items()
+         for depth, count in enumerate(counts, start=1)]
+
+
+@pytest.mark.parametrize("name,depth,expected", CASES, ids=[f"{name}-d{depth}" for name, depth, _ in CASES])
+def test_perft(name, depth, expected):
+    fen = POSITIONS[name][0]
+    board = Board(fen)
+    assert board.perft(depth) == expected
+    # Every push was undone
+    assert board.fen() == fen
@@ -0,0 +1,51 @@
+"""Codecs decode what they encode, whole or streamed, and the policy stores raw what would not shrink."""
+
+import random
+
+import pytest
+
+from backend import compression
+
+TEXT = b"".join(b"row %d,alice,bob,%d\n" % (n, n * n) for n in range(2000))
+NOISE = random.Random(0).randbytes(64 * 1024)
+
+
+@pytest.mark.parametrize("codec", sorted(compression.CODECS))
+@pytest.mark.parametrize("data", [b"", b"x", TEXT, NOISE], ids=["empty", "one byte", "text", "noise"])
+def test_codec_round_trip(codec, data):
+    packed = compression.compress(codec, data)
+    assert compression.decompress(codec, packed) == data
+    # Streamed in uneven pieces, as downloads decrypt them
+    pieces = [packed[i:i + 7] for i in range(0, len(packed), 7)]
+    assert b"".join(compression.iter_decompressed(codec, pieces)) == data
+
+
+@pytest.mark.parametrize("codec", sorted(compression.CODECS))
+def test_incremental_compressor_matches_whole_payload(codec):
+    compressor = compression.get_codec(codec).compressor()
+    packed = b"".join(compressor.compress(TEXT[i:i + 1000]) for i in range(0, len(TEXT), 1000)) + compressor.flush()
+    assert compression.decompress(codec, packed) == TEXT
+
+
+def test_pack_round_trip():
+    payload, codec = compression.pack(TEXT, "csv")
+    assert codec == compression.DEFAULT_CODEC
+    assert len(payload) < len(TEXT)
+    assert compression.decompress(codec, payload) == TEXT
+
+
+@pytest.mark.parametrize("data,file_type", [
+    (NOISE, "bin"),                      # would not shrink
+    (TEXT, "png"),                       # type is already compressed
+    (b"\x89PNG" + TEXT, None),           # content says it is compressed
+    (TEXT[:compression.MIN_BYTES - 1], "txt"),  # too small to bother
+    (b"", "txt"),
+])
+def test_pack_stores_raw(data, file_type):
+    assert compression.pack(data, file_type) == (data, None)
+    assert compression.decompress(None, data) == data
+
+
+def test_unknown_codec_is_refused():
+    with pytest.raises(ValueError):
+        compression.decompress("no-such-codec", b"data")
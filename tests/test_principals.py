@@ -0,0 +1,45 @@
+"""Revocation generations: a logout outdates that user's cached principals everywhere, and only theirs."""
+
+import os
+
+from backend.cache import LRUCache
+from backend.principals import Generations, Principal, PrincipalCache
+
+ALICE = Principal(1, "alice", "user", False)
+BOB = Principal(2, "bob", "user", False)
+
+
+def make_caches(tmp_path, slots=4096):
+    # Two caches over one file stand in for two worker processes
+    path = str(tmp_path / "principals.generation")
+    return [PrincipalCache(LRUCache(maxsize=100), Generations(path, slots)) for _ in range(2)], path
+
+
+def test_invalidation_reaches_other_processes_for_that_user_only(tmp_path):
+    (worker, other), _ = make_caches(tmp_path)
+    worker.put("alice-token", ALICE)
+    worker.put("bob-token", BOB)
+
+    other.invalidate_user(ALICE.id, ALICE.username)
+
+    assert worker.get("alice-token") is None
+    assert worker.get("bob-token") == BOB
+
+
+def test_principal_loaded_before_a_logout_is_not_served(tmp_path):
+    (worker, other), _ = make_caches(tmp_path)
+    generation = worker.generation(ALICE.username)
+    # The logout commits between reading the generation and caching the row
+    other.invalidate_user(ALICE.id, ALICE.username)
+    worker.put("alice-token", ALICE, generation=generation)
+    assert worker.get("alice-token") is None
+
+
+def test_generation_file_does_not_grow(tmp_path):
+    (worker, _), path = make_caches(tmp_path, slots=64)
+    worker.generation(ALICE.username)
+    size = os.path.getsize(path)
+    for _ in range(1000):
+        worker.invalidate_user(ALICE.id, ALICE.username)
+    assert os.path.getsize(path) == size == 64 * 8
+    assert worker.generation(ALICE.username) == 1000
@@ -0,0 +1,161 @@
+"""
+Every query the endpoints and background tasks issue must use an index.
+
+Rather than keeping copies of the SQL, the test drives the real code paths
+(the HTTP endpoints through the test client, and the maintenance, compaction
+and chat-history entry points directly), records each statement SQLAlchemy
+sends to SQLite together with its parameters, and asks SQLite for its
+EXPLAIN QUERY PLAN. A plan step that scans a table or a whole index, or
+sorts the rows it found in a temporary B-tree (a listing that reads every
+row it might return, however small the page), is a failure unless the
+statement is listed in ALLOWED_SCANS with the reason.
+
+Plans are taken on a fresh database migrated to the same schema: the
+workload's tables hold a handful of rows, and once the sweeper has run
+PRAGMA optimize their statistics would rightly make SQLite prefer scans.
+"""
+
+import hashlib
+import os
+import re
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from conftest import login
+
+# Statements that scan on purpose: (pattern matching the SQL, why it is fine)
+ALLOWED_SCANS = [
+    (r"DELETE FROM upload_chunks WHERE \(upload_chunks\.session_id NOT IN",
+     "sweeper: chunk rows whose session the reaper deleted; the table only holds uploads in flight"),
+    (r"FROM users WHERE users\.session_epoch > \? OR users\.key_epoch > \?",
+     "reaper: its work list, users whose epochs were ever bumped; background only, once per pass"),
+    (r"FROM document_ops JOIN files .* GROUP BY document_ops\.file_id",
+     "compactor: groups all pending pushes, which compaction itself keeps few"),
+]
+
+_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)|^USE TEMP B-TREE")
+
+
+def _plan_scans(conn, statement, parameters):
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+    return [row[3] for row in rows if _SCAN.match(row[3])]
+
+
+@pytest.fixture(scope="module")
+def recorded(app):
+    from backend.models import engine, read_engine
+
+    statements = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        head = statement.lstrip().split(None, 1)[0].upper()
+        if head in ("SELECT", "UPDATE", "DELETE", "WITH") and not executemany:
+            statements.setdefault(statement, parameters)
+
+    for bound in {engine, read_engine}:
+        event.listen(bound, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        for bound in {engine, read_engine}:
+            event.remove(bound, "before_cursor_execute", record)
+
+
+def _exercise(client):
+    from backend import maintenance, oplog, uploads
+    from backend.chat_history import ChatHistory
+    from backend.models import SessionLocal
+    from fastapi.testclient import TestClient
+
+    alice = login(client, "plans-alice")
+    bob = login(client, "plans-bob")
+    client.get("/users/me", headers=alice)
+    client.post("/chess/register-sequence", json={"move_sequence": "e4 e5 Nf3"}, headers=alice)
+    client.post("/chess/verify-sequence", json={"move_sequence": "e4 e5 Nf3"})
+
+    ids = []
+    for n in range(5):
+        response = client.post("/files/upload", files={"file": (f"f{n}.txt", b"plain text " * 50)}, headers=alice)
+        ids.append(response.json()["id"])
+    document = client.post("/documents/create", data={"doc_type": "word", "doc_name": "notes"}, headers=alice).json()
+    for sort in ("updated_at", "created_at", "filename"):
+        for order in ("asc", "desc"):
+            params = {"sort": sort, "order": order, "limit": 2}
+            first = client.get("/files", params=params, headers=alice)
+            client.get("/files", params={**params, "after": first.headers["X-Next-Cursor"]}, headers=alice)
+    client.get("/files", params={"file_type": "txt"}, headers=alice)
+
+    file_id = ids[0]
+    client.get(f"/files/{file_id}", headers=alice)
+    client.get(f"/files/{file_id}/download", headers={**alice, "Range": "bytes=2-20"})
+    client.put(f"/files/{file_id}", files={"file_content": ("x", b"edited text " * 50)}, headers=alice)
+    client.get(f"/files/{file_id}/versions", headers=alice)
+    client.get(f"/files/{file_id}/versions/1", headers=alice)
+    client.post(f"/files/{file_id}/versions/1/restore", headers=alice)
+
+    client.post(f"/files/{document['id']}/ops", json={"base": 0, "ops": [{"op": "insert", "pos": 0, "text": "hi"}]},
+                headers=alice)
+    client.get(f"/files/{document['id']}/ops", params={"since": 0}, headers=alice)
+
+    data = b"resumable " * 10000
+    upload = client.post("/uploads", json={"filename": "r.txt", "size": len(data), "chunk_size": 65536},
+                         headers=alice).json()
+    for index in range(upload["chunk_count"]):
+        part = data[index * 65536:(index + 1) * 65536]
+        client.put(f"/uploads/{upload['upload_id']}/chunks/{index}", content=part,
+                   headers={**alice, "X-Chunk-SHA256": hashlib.sha256(part).hexdigest()})
+    client.get(f"/uploads/{upload['upload_id']}", headers=alice)
+    client.post(f"/uploads/{upload['upload_id']}/finalize", headers=alice)
+    aborted = client.post("/uploads", json={"filename": "a.txt", "size": 10}, headers=alice).json()
+    client.delete(f"/uploads/{aborted['upload_id']}", headers=alice)
+
+    # Email responses fail validation after the queries ran (content is ciphertext, declared str)
+    lenient = TestClient(client.app, raise_server_exceptions=False)
+    lenient.post("/emails/send", json={"subject": "s", "content": "hello", "recipient": "plans-bob"}, headers=alice)
+    lenient.get("/emails", headers=bob)
+
+    history = ChatHistory()
+    for n in range(3):
+        history.append("plans-room", "plans-alice", f"move {n}")
+    history.flush()
+    cold = ChatHistory()
+    entries, cursor = cold.page("plans-room", limit=2)
+    cold.page("plans-room", before=cursor, limit=2)
+
+    client.delete(f"/files/{ids[1]}", headers=alice)
+    client.post("/logout", headers=bob)
+    client.post("/clear-traces", headers=alice)
+
+    db = SessionLocal()
+    try:
+        uploads.collect_stale(db)
+    finally:
+        db.close()
+    oplog.compact_once()
+    maintenance.reap_once()
+    maintenance.sweep_once()
+
+
+@pytest.fixture(scope="module")
+def schema_engine(tmp_path_factory):
+    from backend.migrations import run_migrations
+
+    engine = create_engine(f"sqlite:///{os.path.join(tmp_path_factory.mktemp('plans'), 'schema.db')}")
+    run_migrations(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_every_query_uses_an_index(client, recorded, schema_engine):
+    _exercise(client)
+    assert len(recorded) > 40, "the workload should reach most of the app's queries"
+
+    failures = []
+    with schema_engine.connect() as conn:
+        for statement, parameters in recorded.items():
+            flat = " ".join(statement.split())
+            scans = _plan_scans(conn, statement, parameters)
+            if scans and not any(re.search(pattern, flat) for pattern, _ in ALLOWED_SCANS):
+                failures.append(f"{' | '.join(scans)}\n    {flat}")
+    assert not failures, "full scans:\n" + "\n".join(failures)
@@ -0,0 +1,136 @@
+"""
+Range reads return exactly the requested plaintext bytes, whatever the layout.
+
+Each layout is read at offsets around every boundary it has: AES blocks,
+read chunks, segments and manifest chunks, and the end of the file. Sizes
+are odd on purpose, so the last block, segment or chunk is a short one.
+"""
+
+import io
+import random
+
+import pytest
+
+from conftest import login
+
+SIZE = 4099
+SEGMENT = 1000
+
+
+def payload(size=SIZE, seed=0):
+    # Random bytes: incompressible, so the upload path stores them uncompressed
+    return random.Random(seed).randbytes(size)
+
+
+def ranges(size, boundaries):
+    starts = sorted({max(0, min(size - 1, b + d)) for b in [0, *boundaries, size] for d in (-17, -1, 0, 1, 15)})
+    for start in starts:
+        for length in (1, 16, 17, SEGMENT, SEGMENT + 1, size):
+            yield start, length
+
+
+@pytest.mark.parametrize("segment_size", [0, SEGMENT], ids=["stream", "segmented"])
+def test_stream_range_reads(segment_size):
+    from backend import storage
+    from backend.crypto import encrypt_payload
+
+    data = payload()
+    encrypted = encrypt_payload(data, segment_size=segment_size)
+    boundaries = [*range(16, SIZE, 16 * 31), *range(SEGMENT, SIZE, SEGMENT)]
+    for start, length in ranges(SIZE, boundaries):
+        f = io.BytesIO(encrypted["encrypted_data"])
+        # Odd read chunks put chunk edges off the block grid too
+        read = storage.iter_decrypted_range(f, encrypted["key"], encrypted["iv"], start, length, segment_size,
+                                            chunk_size=37)
+        assert b"".join(read) == data[start:start + length], (start, length)
+
+
+def test_compressed_stream_range_reads():
+    from backend import compression, storage
+    from backend.crypto import encrypt_data
+
+    data = b"".join(b"line %d of a compressible file\n" % n for n in range(200))
+    packed = compression.compress("zlib", data)
+    encrypted = encrypt_data(packed)
+    for start, length in ranges(len(data), [len(data) // 2]):
+        read = storage.iter_decrypted_range(io.BytesIO(encrypted["encrypted_data"]), encrypted["key"],
+                                            encrypted["iv"], start, length, chunk_size=37, compression="zlib")
+        assert b"".join(read) == data[start:start + length], (start, length)
+
+
+def test_manifest_range_reads(client):
+    from backend import chunkstore
+    from backend.crypto import generate_key
+    from backend.models import SessionLocal
+
+    data = payload(seed=1)
+    key = generate_key()
+    db = SessionLocal()
+    try:
+        digest, _ = chunkstore.write(db, key, data, chunk_size=SEGMENT)
+        db.commit()
+        manifest = chunkstore.load(digest)
+        assert len(manifest.chunks) > 2
+        for start, length in ranges(SIZE, manifest.offsets):
+            assert b"".join(manifest.iter_range(key, start, length)) == data[start:start + length], (start, length)
+        assert manifest.read(key) == data
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def owner(client):
+    return login(client, "ranges-owner")
+
+
+def upload(client, headers, name, data):
+    response = client.post("/files/upload", files={"file": (name, data)}, headers=headers)
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def test_download_ranges_on_a_segmented_file(client, owner, monkeypatch):
+    from backend import crypto
+    from backend.models import FileKey, ReadSessionLocal
+
+    # Segment even this small upload
+    monkeypatch.setattr(crypto, "SEGMENT_SIZE", SEGMENT)
+    monkeypatch.setattr(crypto, "PARALLEL_THRESHOLD", 0)
+    data = payload(seed=2)
+    file_id = upload(client, owner, "segments.bin", data)
+    db = ReadSessionLocal()
+    try:
+        assert db.query(FileKey.segment_size).filter(FileKey.file_id == file_id).scalar() == SEGMENT
+    finally:
+        db.close()
+
+    assert client.get(f"/files/{file_id}/download", headers=owner).content == data
+    for start, end in [(SEGMENT - 1, SEGMENT), (SEGMENT - 5, 3 * SEGMENT + 5), (0, SIZE - 1), (4000, SIZE - 1)]:
+        response = client.get(f"/files/{file_id}/download", headers={**owner, "Range": f"bytes={start}-{end}"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes {start}-{end}/{SIZE}"
+        assert response.content == data[start:end + 1]
+
+
+def test_download_ranges_on_an_odd_sized_file(client, owner):
+    data = payload(1001, seed=3)
+    file_id = upload(client, owner, "odd.bin", data)
+    cases = {"bytes=0-0": data[:1], "bytes=500-": data[500:], "bytes=-7": data[-7:],
+             "bytes=999-5000": data[999:], "bytes=-5000": data}
+    for spec, expected in cases.items():
+        response = client.get(f"/files/{file_id}/download", headers={**owner, "Range": spec})
+        assert response.status_code == 206, spec
+        assert response.content == expected, spec
+        assert response.headers["Content-Length"] == str(len(expected))
+    assert client.get(f"/files/{file_id}/download", headers={**owner, "Range": "bytes=1001-"}).status_code == 416
+
+
+def test_empty_file(client, owner):
+    file_id = upload(client, owner, "empty.txt", b"")
+    response = client.get(f"/files/{file_id}/download", headers=owner)
+    assert response.status_code == 200
+    assert response.content == b""
+    assert response.headers["Content-Length"] == "0"
+    response = client.get(f"/files/{file_id}/download", headers={**owner, "Range": "bytes=0-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */0"
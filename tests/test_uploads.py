@@ -0,0 +1,99 @@
+"""Resumable uploads: an interrupted upload picks up where it stopped and finalizes to the exact bytes."""
+
+import hashlib
+import random
+
+import pytest
+
+from conftest import login
+
+CHUNK = 64 * 1024
+
+
+@pytest.fixture
+def owner(client):
+    return login(client, "uploads-owner")
+
+
+def start(client, headers, data, name="resumed.bin"):
+    response = client.post("/uploads", json={"filename": name, "size": len(data), "chunk_size": CHUNK},
+                           headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+
+def put_chunk(client, headers, upload, index, part, checksum=None):
+    return client.put(f"/uploads/{upload['upload_id']}/chunks/{index}", content=part,
+                      headers={**headers, "X-Chunk-SHA256": checksum or hashlib.sha256(part).hexdigest()})
+
+
+def chunk(data, index):
+    return data[index * CHUNK:(index + 1) * CHUNK]
+
+
+def status(client, headers, upload):
+    return client.get(f"/uploads/{upload['upload_id']}", headers=headers)
+
+
+def test_interrupted_upload_resumes(client, owner):
+    # Four chunks, the last one short
+    data = random.Random(0).randbytes(3 * CHUNK + 123)
+    upload = start(client, owner, data)
+    assert upload["chunk_count"] == 4
+    assert upload["received"] == []
+
+    # The connection drops after two chunks, the second out of order
+    put_chunk(client, owner, upload, 0, chunk(data, 0)).raise_for_status()
+    put_chunk(client, owner, upload, 2, chunk(data, 2)).raise_for_status()
+    assert status(client, owner, upload).json()["received"] == [0, 2]
+
+    response = client.post(f"/uploads/{upload['upload_id']}/finalize", headers=owner)
+    assert response.status_code == 409
+    assert response.json()["detail"]["missing"] == [1, 3]
+    # A refused finalize leaves the session to resume
+    assert status(client, owner, upload).json()["received"] == [0, 2]
+
+    # The client resumes from the status: a corrupt or mis-sized chunk is refused, a re-sent one replaces
+    assert put_chunk(client, owner, upload, 1, chunk(data, 1), checksum="0" * 64).status_code == 400
+    assert put_chunk(client, owner, upload, 3, chunk(data, 3)[:-1]).status_code == 400
+    for index in (1, 2, 3):
+        put_chunk(client, owner, upload, index, chunk(data, index)).raise_for_status()
+    assert status(client, owner, upload).json()["received"] == [0, 1, 2, 3]
+
+    response = client.post(f"/uploads/{upload['upload_id']}/finalize", headers=owner)
+    assert response.status_code == 200
+    file_id = response.json()["id"]
+    assert client.get(f"/files/{file_id}/download", headers=owner).content == data
+    ranged = client.get(f"/files/{file_id}/download", headers={**owner, "Range": f"bytes={CHUNK - 3}-{2 * CHUNK + 2}"})
+    assert ranged.content == data[CHUNK - 3:2 * CHUNK + 3]
+
+    # The session is gone once it became a file
+    assert status(client, owner, upload).status_code == 404
+    assert put_chunk(client, owner, upload, 0, chunk(data, 0)).status_code == 404
+
+
+def test_empty_upload(client, owner):
+    upload = start(client, owner, b"", name="empty.txt")
+    assert upload["chunk_count"] == 0
+    response = client.post(f"/uploads/{upload['upload_id']}/finalize", headers=owner)
+    assert response.status_code == 200
+    assert client.get(f"/files/{response.json()['id']}/download", headers=owner).content == b""
+
+
+def test_aborted_upload_cannot_resume(client, owner):
+    data = b"abandoned " * 10000
+    upload = start(client, owner, data)
+    put_chunk(client, owner, upload, 0, chunk(data, 0)).raise_for_status()
+    client.delete(f"/uploads/{upload['upload_id']}", headers=owner).raise_for_status()
+    assert status(client, owner, upload).status_code == 404
+    assert put_chunk(client, owner, upload, 1, chunk(data, 1)).status_code == 404
+    assert client.post(f"/uploads/{upload['upload_id']}/finalize", headers=owner).status_code == 404
+
+
+def test_uploads_are_private(client, owner):
+    data = b"mine " * 100
+    upload = start(client, owner, data)
+    other = login(client, "uploads-other")
+    assert status(client, other, upload).status_code == 404
+    assert put_chunk(client, other, upload, 0, data).status_code == 404
+    client.delete(f"/uploads/{upload['upload_id']}", headers=owner).raise_for_status()
@@ -0,0 +1,92 @@
+"""Backup history: every version reads back exactly, and retention drops whole snapshot groups."""
+
+import pytest
+
+from conftest import login
+
+# Grows, shrinks, empties and refills, so deltas copy, insert and delete
+CONTENTS = [
+    b"first draft of the report\n" * 20,
+    b"first draft of the report\n" * 20 + b"an appended paragraph\n",
+    b"a new opening line\n" + b"first draft of the report\n" * 20 + b"an appended paragraph\n",
+    b"first draft of the report\n" * 5,
+    b"",
+    b"written again from nothing\n" * 30,
+    b"written again from nothing\n" * 30 + b"\x00\xff binary tail",
+    b"short",
+]
+
+
+@pytest.fixture
+def history(client, monkeypatch):
+    from backend import versioning
+
+    # A snapshot every third version, so the history holds several groups
+    monkeypatch.setattr(versioning, "SNAPSHOT_INTERVAL", 3)
+    headers = login(client, "versions-owner")
+    file_id = client.post("/files/upload", files={"file": ("report.txt", CONTENTS[0])}, headers=headers).json()["id"]
+    for content in CONTENTS[1:]:
+        client.put(f"/files/{file_id}", files={"file_content": ("report.txt", content)},
+                   headers=headers).raise_for_status()
+    return headers, file_id
+
+
+def versions(client, headers, file_id):
+    response = client.get(f"/files/{file_id}/versions", headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+
+def test_every_version_reads_back(client, history):
+    headers, file_id = history
+    listed = versions(client, headers, file_id)
+    assert [v["version"] for v in listed] == list(range(1, len(CONTENTS) + 1))
+    assert [v["is_snapshot"] for v in listed] == [n % 3 == 0 for n in range(len(CONTENTS))]
+    assert [v["content_size"] for v in listed] == [len(content) for content in CONTENTS]
+    for version, content in enumerate(CONTENTS, start=1):
+        response = client.get(f"/files/{file_id}/versions/{version}", headers=headers)
+        assert response.status_code == 200
+        assert response.content == content
+    assert client.get(f"/files/{file_id}/versions/{len(CONTENTS) + 1}", headers=headers).status_code == 404
+
+
+def test_restore_appends_a_version(client, history):
+    headers, file_id = history
+    client.post(f"/files/{file_id}/versions/2/restore", headers=headers).raise_for_status()
+    assert client.get(f"/files/{file_id}/download", headers=headers).content == CONTENTS[1]
+    listed = versions(client, headers, file_id)
+    assert listed[-1]["version"] == len(CONTENTS) + 1
+    assert client.get(f"/files/{file_id}/versions/{len(CONTENTS) + 1}", headers=headers).content == CONTENTS[1]
+
+
+def test_retention_drops_whole_groups_and_their_blobs(client, history):
+    from backend import versioning
+    from backend.models import BackupStorage, Blob, SessionLocal
+
+    headers, file_id = history
+    db = SessionLocal()
+    try:
+        rows = db.query(BackupStorage).filter(BackupStorage.file_id == file_id).order_by(BackupStorage.version).all()
+        user_id = rows[0].user_id
+        blobs = {row.version: row.blob_hash for row in rows}
+        dropped = {blobs[2], blobs[3]}
+        assert db.query(Blob).filter(Blob.hash.in_(dropped)).count() == 2
+
+        # Groups are [1, 2, 3], [4, 5, 6], [7, 8]; version 5 keeps its whole group
+        versioning.apply_retention(db, file_id, user_id,
+                                   versioning.RetentionPolicy(keep_last=4, keep_hourly=0, keep_daily=0))
+        db.commit()
+        assert [v["version"] for v in versions(client, headers, file_id)] == [4, 5, 6, 7, 8]
+        # Deltas own their blobs; the pruned ones are gone (snapshots may share the file's)
+        assert not db.query(Blob).filter(Blob.hash.in_(dropped)).count()
+
+        versioning.apply_retention(db, file_id, user_id,
+                                   versioning.RetentionPolicy(keep_last=1, keep_hourly=0, keep_daily=0))
+        db.commit()
+    finally:
+        db.close()
+    assert [v["version"] for v in versions(client, headers, file_id)] == [7, 8]
+    # What is left still reconstructs, including the delta on top of the surviving snapshot
+    for version in (7, 8):
+        assert client.get(f"/files/{file_id}/versions/{version}", headers=headers).content == CONTENTS[version - 1]
+    assert client.get(f"/files/{file_id}/versions/1", headers=headers).status_code == 404